@@ -1,3 +1,5 @@
+import time
+SCRIPT_START_TIME = time.perf_counter() # Para medir el arranque (la importación de TensorFlow domina)
 import tensorflow as tf
 from tensorflow.keras.models import load_model
 from PIL import Image
@@ -5,36 +7,83 @@ import numpy as np
 import os
 import json
 import sys
+from multiprocessing import shared_memory
 
 # --- CONFIGURACIÓN (debe coincidir con la Fase 2) ---
 MODEL_SAVE_PATH = "C:/Users/59174/Desktop/lighting_classifier_model.h5"
 CLASS_MAPPING_FILE = "C:/Users/59174/Desktop/class_mapping.json"
 IMG_HEIGHT, IMG_WIDTH = 128, 128
+NUMPY_MODEL_SCHEMA_VERSION = 1 # Versión del .npz exportado con --export-npz (ver generadorluzblender.py)
 
 # Cargar el modelo y el mapeo de clases UNA VEZ al iniciar el script
 CLASSIFIER_MODEL = None
 CLASS_MAPPING = None
+# Tiempos que se informan a Blender en stderr (ver report_timings)
+TIMINGS = {"import_seconds": time.perf_counter() - SCRIPT_START_TIME, "model_load_seconds": 0.0, "inference_seconds": 0.0}
 
 try:
+    model_load_start = time.perf_counter()
     CLASSIFIER_MODEL = load_model(MODEL_SAVE_PATH)
     with open(CLASS_MAPPING_FILE, 'r') as f:
         CLASS_MAPPING = {int(k): v for k, v in json.load(f).items()}
+    TIMINGS["model_load_seconds"] = time.perf_counter() - model_load_start
     # print("Modelo y mapeo de clases cargados para predicción externa.")
 except Exception as e:
     print(f"ERROR_LOADING_MODEL_OR_MAPPING: {e}", file=sys.stderr) # Enviar error a stderr
     sys.exit(1) # Salir si no se puede cargar lo esencial
 
+def load_image_array(image_path):
+    """Carga una imagen con el mismo preprocesado que el entrenamiento (128x128, 0-1)."""
+    img = Image.open(image_path)
+    img = img.convert("RGB").resize((IMG_WIDTH, IMG_HEIGHT)) # RGBA o escala de grises -> 3 canales
+    return np.array(img).astype(np.float32) / 255.0
+
+def pixels_to_image_array(pixels):
+    """
+    Preprocesa píxeles en memoria (H x W x 3 o 4, float 0-1, ya en sRGB) igual
+    que una imagen leída de disco: se cuantizan a 8 bits y se redimensionan con PIL.
+    """
+    rgb = np.clip(np.asarray(pixels)[:, :, :3] * 255.0 + 0.5, 0, 255).astype(np.uint8)
+    img = Image.fromarray(rgb, "RGB").resize((IMG_WIDTH, IMG_HEIGHT))
+    return np.array(img).astype(np.float32) / 255.0
+
+def classify_array(pixels):
+    """Clasifica un array de píxeles RGB(A) en 0-1 sin pasar por un archivo. Devuelve la clase."""
+    img_array = np.expand_dims(pixels_to_image_array(pixels), axis=0)
+    inference_start = time.perf_counter()
+    predictions = CLASSIFIER_MODEL.predict(img_array, verbose=0)
+    TIMINGS["inference_seconds"] += time.perf_counter() - inference_start
+    return CLASS_MAPPING.get(int(np.argmax(predictions[0])), "Desconocido")
+
+def classify_shared_memory(name, height, width, channels):
+    """
+    Clasifica píxeles float32 que Blender dejó en memoria compartida (filas de
+    abajo arriba, como bpy.types.Image.pixels). Se leen sin copiarlos a disco.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    if os.name == "posix":
+        # El bloque pertenece a Blender: evitar que el resource_tracker de este proceso lo borre al salir
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    try:
+        pixels = np.ndarray((height, width, channels), dtype=np.float32, buffer=shm.buf)
+        # Vista invertida (sin copia): primera fila arriba, como en un archivo
+        return classify_array(pixels[::-1])
+    finally:
+        pixels = None # Liberar la vista antes de cerrar el bloque
+        shm.close()
+
 def classify_image_lighting_external(image_path):
     """
     Clasifica el tipo de iluminación de una imagen usando el modelo cargado.
     """
     try:
-        img = Image.open(image_path)
-        img = img.resize((IMG_WIDTH, IMG_HEIGHT))
-        img_array = np.array(img).astype(np.float32) / 255.0
+        img_array = load_image_array(image_path)
         img_array = np.expand_dims(img_array, axis=0)
 
+        inference_start = time.perf_counter()
         predictions = CLASSIFIER_MODEL.predict(img_array, verbose=0) # verbose=0 para no imprimir progreso
+        TIMINGS["inference_seconds"] += time.perf_counter() - inference_start
         predicted_class_index = np.argmax(predictions[0])
         predicted_class_name = CLASS_MAPPING.get(predicted_class_index, "Desconocido")
         
@@ -44,12 +93,122 @@ def classify_image_lighting_external(image_path):
         print(f"ERROR_PREDICTING: {e}", file=sys.stderr)
         return "ERROR_PREDICTING_IMAGE" # Devolver un mensaje de error claro
 
+def classify_images_lighting_external(image_paths):
+    """
+    Clasifica varias imágenes en una sola llamada al modelo (un único lote).
+    Devuelve {ruta: clase}; las imágenes que no se pueden leer reciben "ERROR_PREDICTING_IMAGE".
+    """
+    results = {}
+    valid_paths = []
+    batch = []
+    for image_path in image_paths:
+        try:
+            batch.append(load_image_array(image_path))
+            valid_paths.append(image_path)
+        except Exception as e:
+            print(f"ERROR_PREDICTING: {image_path}: {e}", file=sys.stderr)
+            results[image_path] = "ERROR_PREDICTING_IMAGE"
+
+    if not batch:
+        return results
+    inference_start = time.perf_counter()
+    try:
+        predictions = CLASSIFIER_MODEL.predict(np.stack(batch), verbose=0)
+    except Exception as e:
+        # Si el lote falla, se predice imagen por imagen para que solo fallen las que no encajan
+        print(f"ERROR_PREDICTING: lote de {len(batch)} imágenes: {e}", file=sys.stderr)
+        predictions = []
+        for image_path, img_array in zip(valid_paths, batch):
+            try:
+                predictions.append(CLASSIFIER_MODEL.predict(np.expand_dims(img_array, axis=0), verbose=0)[0])
+            except Exception as image_error:
+                print(f"ERROR_PREDICTING: {image_path}: {image_error}", file=sys.stderr)
+                predictions.append(None)
+    TIMINGS["inference_seconds"] += time.perf_counter() - inference_start
+    for image_path, prediction in zip(valid_paths, predictions):
+        if prediction is None:
+            results[image_path] = "ERROR_PREDICTING_IMAGE"
+        else:
+            results[image_path] = CLASS_MAPPING.get(int(np.argmax(prediction)), "Desconocido")
+    return results
+
+def report_timings():
+    """Escribe los tiempos en stderr en una línea que generadorluzblender.py separa del resto."""
+    print(f"LIGHTMOOD_TIMING: {json.dumps(TIMINGS)}", file=sys.stderr)
+
+def export_model_npz(output_path, num_reference_inputs=2):
+    """
+    Exporta los pesos del modelo a un .npz para la inferencia en NumPy dentro de
+    Blender (generadorluzblender.py). Incluye entradas aleatorias con sus salidas
+    de Keras para que el add-on compruebe al cargar que su resultado coincide.
+    """
+    arrays = {
+        "schema_version": np.int32(NUMPY_MODEL_SCHEMA_VERSION),
+        "input_shape": np.array(CLASSIFIER_MODEL.input_shape[1:], dtype=np.int32),
+        "class_names": np.array([CLASS_MAPPING.get(i, "Desconocido") for i in range(max(CLASS_MAPPING) + 1)]),
+    }
+    layer_types = []
+    layer_activations = []
+    for layer in CLASSIFIER_MODEL.layers:
+        layer_type = layer.__class__.__name__
+        config = layer.get_config()
+        index = len(layer_types)
+        if layer_type in ("Dropout", "InputLayer"): # Sin efecto en inferencia
+            continue
+        if layer_type == "Conv2D":
+            if config["padding"] != "valid" or tuple(config["strides"]) != (1, 1) or tuple(config["dilation_rate"]) != (1, 1):
+                raise ValueError(f"Capa Conv2D no soportada por la exportación: {layer.name}")
+            arrays[f"layer_{index}_kernel"], arrays[f"layer_{index}_bias"] = layer.get_weights()
+        elif layer_type == "MaxPooling2D":
+            if config["padding"] != "valid" or tuple(config["strides"]) != tuple(config["pool_size"]):
+                raise ValueError(f"Capa MaxPooling2D no soportada por la exportación: {layer.name}")
+            arrays[f"layer_{index}_pool_size"] = np.array(config["pool_size"], dtype=np.int32)
+        elif layer_type == "Dense":
+            arrays[f"layer_{index}_kernel"], arrays[f"layer_{index}_bias"] = layer.get_weights()
+        elif layer_type != "Flatten":
+            raise ValueError(f"Tipo de capa no soportado por la exportación: {layer_type} ({layer.name})")
+        layer_types.append(layer_type)
+        layer_activations.append(config.get("activation", "linear"))
+    arrays["layer_types"] = np.array(layer_types)
+    arrays["layer_activations"] = np.array(layer_activations)
+
+    rng = np.random.default_rng(0)
+    reference_inputs = rng.random((num_reference_inputs,) + tuple(arrays["input_shape"]), dtype=np.float32)
+    arrays["reference_inputs"] = reference_inputs
+    arrays["reference_outputs"] = CLASSIFIER_MODEL.predict(reference_inputs, verbose=0).astype(np.float32)
+
+    # Escritura atómica: Blender puede estar leyendo el archivo anterior
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, output_path)
+    return layer_types
+
 if __name__ == "__main__":
+    # Exportación de los pesos para la inferencia en NumPy: --export-npz modelo.npz
+    if len(sys.argv) > 2 and sys.argv[1] == "--export-npz":
+        exported_layers = export_model_npz(sys.argv[2])
+        print(f"Modelo exportado a '{sys.argv[2]}': {', '.join(exported_layers)}")
+    # Píxeles en memoria compartida: --shm nombre alto ancho canales (ver generadorluzblender.py)
+    elif len(sys.argv) > 5 and sys.argv[1] == "--shm":
+        print(classify_shared_memory(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5])))
+        report_timings()
+    # Modo por lotes: --batch-file lista.txt (una ruta por línea) o --batch ruta1 ruta2 ...
+    # Imprime un único JSON {ruta: clase} en stdout para que Blender lo lea
+    elif len(sys.argv) > 2 and sys.argv[1] in ("--batch", "--batch-file"):
+        if sys.argv[1] == "--batch-file":
+            with open(sys.argv[2], 'r', encoding='utf-8') as f:
+                batch_paths = [line.strip() for line in f if line.strip()]
+        else:
+            batch_paths = sys.argv[2:]
+        print(json.dumps(classify_images_lighting_external(batch_paths)))
+        report_timings()
     # Este script se llamará desde Blender con la ruta de la imagen como argumento
-    if len(sys.argv) > 1:
+    elif len(sys.argv) > 1:
         input_image_path = sys.argv[1]
         result_class = classify_image_lighting_external(input_image_path)
         print(result_class) # Imprime el resultado para que Blender lo lea
+        report_timings()
     else:
         print("ERROR: No se proporcionó la ruta de la imagen.", file=sys.stderr)
         sys.exit(1)
\ No newline at end of file
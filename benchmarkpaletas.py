@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""Benchmark de la extracción de paletas y generador de datasets sintéticos.
+
+Crea carpetas de clases sintéticas con número de imágenes, resolución y
+distribución de colores controlables, ejecuta extract_class_dominant_colors
+(Celda 3 de clusteringpaleta.py) con cada motor de clustering y registra el
+tiempo, la memoria máxima (RSS), los píxeles por segundo y el error de la
+paleta frente a los colores generadores conocidos. El resultado se guarda en
+un reporte JSON comparable entre ejecuciones.
+
+Uso:
+    python benchmarkpaletas.py --classes 3 --images-per-class 50 --width 512 --height 384
+"""
+
+import argparse
+import colorsys
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+try:
+    import resource # Solo disponible en Linux/macOS
+except ImportError:
+    resource = None
+
+NOTEBOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clusteringpaleta.py")
+PALETTE_FUNCTIONS_CELL = "Celda 3"
+DEFAULT_REPORT_FILE = "benchmark_paletas.json"
+REPORT_SCHEMA_VERSION = 1
+ENGINES = ["numpy", "sklearn"]
+DISTRIBUTIONS = ["uniform", "dominant", "dirichlet"]
+
+
+# --- 1. CARGA DE LAS FUNCIONES DEL NOTEBOOK ---
+def load_palette_functions(notebook_path=NOTEBOOK_PATH, cell_title=PALETTE_FUNCTIONS_CELL):
+    """
+    Ejecuta solo la celda de funciones de clusteringpaleta.py (el notebook completo
+    necesita el dataset real) y devuelve su espacio de nombres.
+    """
+    with open(notebook_path, 'r', encoding='utf-8') as f:
+        source = f.read()
+
+    cells = source.split("# @title ")
+    cell_source = next((cell for cell in cells if cell.startswith(cell_title)), None)
+    if cell_source is None:
+        raise ValueError(f"No se encontró la '{cell_title}' en {notebook_path}")
+
+    from kmeansnumpy import kmeans_lloyd
+    from datasetshards import load_index, iter_samples
+    import sketchluminosidad
+    try:
+        from sklearn.cluster import KMeans
+    except ImportError:
+        KMeans = None
+
+    namespace = {
+        "np": np, "Image": Image, "os": os, "json": json, "random": random, "sys": sys,
+        "io": io, "math": math, "KMeans": KMeans, "kmeans_lloyd": kmeans_lloyd,
+        "load_index": load_index, "iter_samples": iter_samples,
+        **{name: getattr(sketchluminosidad, name) for name in (
+            "new_sketch", "add_image", "merge_class_sketches", "summarize_sketch",
+            "save_class_sketches", "load_class_sketches")},
+        "CLASS_PALETTES_FILE": os.devnull, "CLASS_PALETTES_NPZ_FILE": os.devnull,
+        "CLASS_LUMINOSITY_SKETCHES_FILE": os.devnull,
+        "PALETTE_ARTIFACT_SCHEMA_VERSION": 1,
+    }
+    exec(compile("# @title " + cell_source, notebook_path, "exec"), namespace)
+    return namespace
+
+
+# --- 2. GENERACIÓN DEL DATASET SINTÉTICO ---
+def random_chromatic_color(rng):
+    """Color saturado que supera los filtros de gris/brillo del notebook (0-255)."""
+    while True:
+        hue = rng.random()
+        saturation = rng.uniform(0.55, 1.0)
+        value = rng.uniform(0.45, 0.85)
+        color = np.array(colorsys.hsv_to_rgb(hue, saturation, value)) * 255.0
+        if color.max() - color.min() >= 40 and 60 <= color.mean() <= 200:
+            return color
+
+def image_color_weights(rng, num_colors, distribution):
+    """Proporción de píxeles de cada color generador en una imagen."""
+    if distribution == "uniform":
+        return np.full(num_colors, 1.0 / num_colors)
+    if distribution == "dominant":
+        weights = np.full(num_colors, 0.3 / max(num_colors - 1, 1))
+        weights[rng.integers(num_colors)] = 0.7 if num_colors > 1 else 1.0
+        return weights / weights.sum()
+    return rng.dirichlet(np.ones(num_colors))
+
+def generate_synthetic_dataset(output_dir, num_classes, images_per_class, width, height,
+                               colors_per_class, distribution="uniform", noise=6.0,
+                               image_format="png", seed=42):
+    """
+    Crea output_dir/clase_i/img_j.<formato> con píxeles tomados de colores
+    generadores conocidos más ruido gaussiano. Devuelve la verdad de referencia
+    {clase: [colores 0-255]}.
+    """
+    rng = np.random.default_rng(seed)
+    ground_truth = {}
+
+    for class_index in range(num_classes):
+        class_name = f"clase_{class_index}"
+        class_path = os.path.join(output_dir, class_name)
+        os.makedirs(class_path, exist_ok=True)
+        class_colors = np.array([random_chromatic_color(rng) for _ in range(colors_per_class)])
+        ground_truth[class_name] = class_colors.tolist()
+
+        for image_index in range(images_per_class):
+            weights = image_color_weights(rng, colors_per_class, distribution)
+            # Bloques de 8x8 píxeles del mismo color para imitar regiones de la imagen
+            block_h, block_w = (height + 7) // 8, (width + 7) // 8
+            labels = rng.choice(colors_per_class, size=(block_h, block_w), p=weights)
+            labels = np.repeat(np.repeat(labels, 8, axis=0), 8, axis=1)[:height, :width]
+            pixels = class_colors[labels] + rng.normal(0.0, noise, size=(height, width, 3))
+            image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+            image.save(os.path.join(class_path, f"img_{image_index:05d}.{image_format}"))
+
+    return ground_truth
+
+
+# --- 3. MÉTRICAS ---
+def palette_error(extracted_colors, generating_colors):
+    """Distancia RGB (0-255) media de cada color generador al color extraído más cercano."""
+    extracted = np.asarray(extracted_colors, dtype=np.float64).reshape(-1, 3)
+    generating = np.asarray(generating_colors, dtype=np.float64).reshape(-1, 3)
+    if extracted.shape[0] == 0:
+        return None
+    distances = np.linalg.norm(generating[:, np.newaxis, :] - extracted[np.newaxis, :, :], axis=2)
+    return float(distances.min(axis=1).mean())
+
+def peak_rss_mb():
+    """Memoria residente máxima del proceso actual en MB (None si no está disponible)."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa en KB, macOS en bytes
+    return max_rss / (1024.0 * 1024.0) if sys.platform == "darwin" else max_rss / 1024.0
+
+
+# --- 4. EJECUCIÓN DE LOS MOTORES ---
+def run_engine(engine, dataset_path, ground_truth, num_colors, max_images_sample, pixels_per_image):
+    """Ejecuta la extracción de todas las clases con un motor. Pensado para un proceso hijo."""
+    functions = load_palette_functions()
+    if engine == "sklearn" and functions["KMeans"] is None:
+        return {"engine": engine, "error": "scikit-learn no está instalado"}
+
+    random.seed(42)
+    np.random.seed(42)
+    rss_before = peak_rss_mb()
+    per_class = {}
+    total_images = 0
+    start = time.perf_counter()
+    for class_name, generating_colors in ground_truth.items():
+        class_path = os.path.join(dataset_path, class_name)
+        class_start = time.perf_counter()
+        colors, avg_lum, stats = functions["extract_class_dominant_colors"](
+            class_path, num_colors, max_images_sample, engine=engine)
+        num_images = min(len(os.listdir(class_path)), max_images_sample)
+        total_images += num_images
+        per_class[class_name] = {
+            "wall_seconds": time.perf_counter() - class_start,
+            "images": num_images,
+            "palette_error": palette_error(colors, generating_colors),
+            "avg_luminosity": float(avg_lum),
+        }
+    wall_seconds = time.perf_counter() - start
+
+    errors = [c["palette_error"] for c in per_class.values() if c["palette_error"] is not None]
+    return {
+        "engine": engine,
+        "wall_seconds": wall_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_before_mb": rss_before,
+        "pixels_per_second": total_images * pixels_per_image / wall_seconds if wall_seconds > 0 else None,
+        "palette_error_mean": float(np.mean(errors)) if errors else None,
+        "per_class": per_class,
+    }
+
+def run_engine_isolated(engine, *args):
+    """Ejecuta un motor en un proceso nuevo para que el pico de RSS sea solo suyo."""
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(run_engine, (engine,) + args)
+
+
+# --- 5. PUNTO DE ENTRADA ---
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de extracción de paletas de LightMood.")
+    parser.add_argument("--classes", type=int, default=3)
+    parser.add_argument("--images-per-class", type=int, default=50)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=384)
+    parser.add_argument("--colors-per-class", type=int, default=5, help="Colores generadores por clase")
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS, default="uniform")
+    parser.add_argument("--noise", type=float, default=6.0, help="Desviación del ruido gaussiano (0-255)")
+    parser.add_argument("--format", choices=["png", "jpg"], default="png")
+    parser.add_argument("--num-colors", type=int, default=8, help="Colores a extraer (NUM_CLASS_COLORS)")
+    parser.add_argument("--max-images", type=int, default=1000, help="MAX_IMAGES_PER_CLASS_FOR_COLOR_EXTRACTION")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=ENGINES)
+    parser.add_argument("--dataset-dir", default=None, help="Carpeta del dataset (por defecto, temporal)")
+    parser.add_argument("--keep-dataset", action="store_true")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=DEFAULT_REPORT_FILE)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    dataset_path = args.dataset_dir or tempfile.mkdtemp(prefix="lightmood_bench_")
+
+    print(f"Generando dataset sintético en: {dataset_path}")
+    generation_start = time.perf_counter()
+    ground_truth = generate_synthetic_dataset(
+        dataset_path, args.classes, args.images_per_class, args.width, args.height,
+        args.colors_per_class, args.distribution, args.noise, args.format, args.seed)
+    generation_seconds = time.perf_counter() - generation_start
+
+    results = []
+    try:
+        for engine in args.engines:
+            print(f"Ejecutando motor '{engine}'...")
+            result = run_engine_isolated(engine, dataset_path, ground_truth, args.num_colors,
+                                         args.max_images, args.width * args.height)
+            results.append(result)
+            if "error" in result:
+                print(f"  {engine}: {result['error']}", file=sys.stderr)
+            else:
+                print(f"  {engine}: {result['wall_seconds']:.2f} s, "
+                      f"{result['pixels_per_second'] / 1e6:.2f} Mpx/s, "
+                      f"RSS máx. {result['peak_rss_mb']} MB, error de paleta {result['palette_error_mean']}")
+    finally:
+        if not args.keep_dataset and args.dataset_dir is None:
+            shutil.rmtree(dataset_path, ignore_errors=True)
+
+    report = {
+        "schema_version": REPORT_SCHEMA_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": {"python": platform.python_version(), "machine": platform.machine(),
+                     "system": platform.system(), "numpy": np.__version__,
+                     "cpu_count": os.cpu_count()},
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "dataset_dir", "keep_dataset")},
+        "dataset_generation_seconds": generation_seconds,
+        "ground_truth": ground_truth,
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Reporte del benchmark guardado en '{args.output}'")
+    return report
+
+
+if __name__ == "__main__":
+    main()
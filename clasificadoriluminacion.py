@@ -18,10 +18,15 @@ from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Dropout
 import os
+import sys
 import json
+import subprocess
+import time
+import types
 import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image # Para visualizar imágenes
+from datasetshards import load_index, split_shards, count_samples, iter_samples, decode_image # Dataset en fragmentos tar (datasetshards.py)
 
 print("Librerías instaladas y cargadas.")
 print("TensorFlow versión:", tf.__version__)
@@ -32,8 +37,16 @@ print("TensorFlow versión:", tf.__version__)
 # Ajusta esta ruta a donde se encuentre tu carpeta "Agrupados" en Google Drive.
 DATASET_BASE_PATH = "C:/Users/59174/Desktop/Agrupados"
 
-# Asegurarse de que la carpeta exista
-if not os.path.exists(DATASET_BASE_PATH):
+# Opcional: índice del dataset empaquetado en fragmentos tar (python datasetshards.py crear ...).
+# Si se indica, el entrenamiento lee las imágenes en streaming desde los fragmentos.
+DATASET_SHARDS_INDEX = None # p. ej. "C:/Users/59174/Desktop/shards/agrupados-index.json"
+
+# Asegurarse de que la carpeta (o el índice de fragmentos) exista
+if DATASET_SHARDS_INDEX:
+    if not os.path.exists(DATASET_SHARDS_INDEX):
+        raise FileNotFoundError(f"El índice de fragmentos no se encontró en: {DATASET_SHARDS_INDEX}")
+    print(f"Índice de fragmentos verificado: {DATASET_SHARDS_INDEX}")
+elif not os.path.exists(DATASET_BASE_PATH):
     raise FileNotFoundError(f"La carpeta del dataset no se encontró en: {DATASET_BASE_PATH}\n"
                             "Por favor, verifica la ruta o asegúrate de que el dataset esté subido/montado.")
 else:
@@ -158,40 +171,265 @@ print(f"Mapeo de clases guardado en '{CLASS_MAPPING_FILE}'")
 
 # --- CONFIGURACIÓN DE ENTRENAMIENTO ---
 EPOCHS = 15
+SHARD_SHUFFLE_BUFFER = 1000 # Imágenes en el búfer de barajado al leer de fragmentos
+SHARD_SEED = 42
+# Procesos de entrenamiento en paralelo (entrenamientodistribuido.py, junto a este notebook).
+# Con más de 1, BATCH_SIZE es el lote de cada proceso y la tasa de aprendizaje se escala con su número.
+NUM_TRAINING_WORKERS = 1
+# Modo perfil: traza del profiler de TensorFlow para una ventana de pasos y un resumen
+# (espera de entrada frente a cálculo, imágenes/s, FLOPs y tiempo por capa) en <modelo>_profile.json
+PROFILE_TRAINING = False
+PROFILE_BATCH_RANGE = (10, 20) # Pasos (inicio, fin) de la primera época que graba el profiler
+PROFILE_LAYER_REPEATS = 10 # Repeticiones para medir el tiempo de cada capa
+PROFILE_SCHEMA_VERSION = 1
+
+def make_shard_dataset(shards_index, shard_ids, img_height, img_width, batch_size, shuffle, seed=SHARD_SEED,
+                       prefetch=True):
+    """
+    tf.data.Dataset que lee los fragmentos indicados en streaming, con el mismo
+    preprocesado que flow_from_directory (RGB, redimensionado 'nearest', 0-1) y
+    etiquetas one-hot en el orden alfabético de las clases. Si shuffle es True,
+    cada época baraja los fragmentos con una semilla distinta. Con prefetch=False
+    no se adelantan lotes (el modo perfil lo aplica fuera de su medición).
+    """
+    class_names = shards_index["classes"]
+    class_indices = {class_name: i for i, class_name in enumerate(class_names)}
+    epoch_counter = [0]
+
+    def generator():
+        epoch_seed = seed + epoch_counter[0]
+        epoch_counter[0] += 1
+        for class_name, _, data in iter_samples(shards_index, shard_ids, shuffle=shuffle, seed=epoch_seed,
+                                                shuffle_buffer=SHARD_SHUFFLE_BUFFER if shuffle else 0):
+            img = decode_image(data).convert("RGB").resize((img_width, img_height), Image.NEAREST)
+            label = np.zeros(len(class_names), dtype=np.float32)
+            label[class_indices[class_name]] = 1.0
+            yield np.asarray(img, dtype=np.float32) / 255.0, label
+
+    dataset = tf.data.Dataset.from_generator(
+        generator,
+        output_signature=(tf.TensorSpec((img_height, img_width, 3), tf.float32),
+                          tf.TensorSpec((len(class_names),), tf.float32)))
+    dataset = dataset.batch(batch_size)
+    return dataset.prefetch(tf.data.AUTOTUNE) if prefetch else dataset
+
+def profile_paths(model_save_path):
+    """Rutas del resumen JSON y de la carpeta de la traza, junto al modelo."""
+    base_path = os.path.splitext(model_save_path)[0]
+    return base_path + "_profile.json", base_path + "_profile_trace"
+
+def timed_input_dataset(batches, input_timing, img_height, img_width, num_classes):
+    """
+    Envuelve la fuente de lotes (DirectoryIterator o tf.data.Dataset) en un
+    tf.data.Dataset infinito sin prefetch que suma en input_timing el tiempo de
+    obtener cada lote de la fuente y las imágenes servidas. Si la fuente no
+    adelanta lotes es el tiempo de producirlos (lectura y decodificación); si
+    lleva prefetch, la espera que queda tras él.
+    """
+    def generator():
+        while True:
+            iterator = iter(batches.as_numpy_iterator() if isinstance(batches, tf.data.Dataset) else batches)
+            while True:
+                start = time.perf_counter()
+                try:
+                    x, y = next(iterator)
+                except StopIteration:
+                    break
+                input_timing["seconds"] += time.perf_counter() - start
+                input_timing["images"] += len(x)
+                yield x, y
+
+    return tf.data.Dataset.from_generator(
+        generator,
+        output_signature=(tf.TensorSpec((None, img_height, img_width, 3), tf.float32),
+                          tf.TensorSpec((None, num_classes), tf.float32)))
+
+class TrainingProfileCallback(tf.keras.callbacks.Callback):
+    """
+    Reparte el tiempo de cada época entre espera de entrada y cálculo, y anota
+    aparte el tiempo de producir los lotes (production_timing). Sin prefetch
+    ambos tiempos son el mismo.
+    """
 
-def train_lighting_classifier(base_path, img_height, img_width, batch_size, epochs, model_save_path):
+    def __init__(self, input_timing, production_timing=None):
+        super().__init__()
+        self.input_timing = input_timing
+        self.production_timing = input_timing if production_timing is None else production_timing
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.input_timing.update(seconds=0.0, images=0)
+        self.production_timing.update(seconds=0.0, images=0)
+        self.step_seconds = 0.0
+        self.epoch_start = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step_seconds += time.perf_counter() - self.batch_start
+
+    def on_epoch_end(self, epoch, logs=None):
+        # El paso pide el lote sin prefetch intermedio: su tiempo es la espera del lote más el cálculo
+        input_seconds = min(self.input_timing["seconds"], self.step_seconds)
+        self.epochs.append({
+            "epoch": epoch + 1,
+            "epoch_seconds": time.perf_counter() - self.epoch_start, # Incluye la validación
+            "train_step_seconds": self.step_seconds,
+            "input_seconds": input_seconds,
+            "input_wait_seconds": input_seconds,
+            "input_production_seconds": self.production_timing["seconds"],
+            "compute_seconds": self.step_seconds - input_seconds,
+            "input_fraction": input_seconds / self.step_seconds if self.step_seconds > 0 else 0.0,
+            "images": self.input_timing["images"],
+            "images_per_second": self.input_timing["images"] / self.step_seconds if self.step_seconds > 0 else 0.0,
+        })
+
+def layer_flops(layer, input_shape, output_shape):
+    """FLOPs por imagen de la pasada hacia delante (multiplicación y suma cuentan como 2)."""
+    layer_type = layer.__class__.__name__
+    if layer_type == "Conv2D":
+        kernel_height, kernel_width = layer.kernel_size
+        return 2 * kernel_height * kernel_width * input_shape[-1] * int(np.prod(list(output_shape[1:])))
+    if layer_type == "Dense":
+        return 2 * input_shape[-1] * output_shape[-1]
+    if layer_type == "MaxPooling2D":
+        pool_height, pool_width = layer.pool_size
+        return pool_height * pool_width * int(np.prod(list(output_shape[1:])))
+    return 0 # Flatten y Dropout solo reordenan o copian datos
+
+def profile_model_layers(model, batch_size, repeats=PROFILE_LAYER_REPEATS):
+    """Mide cada capa del modelo Sequential por separado con un lote aleatorio (inferencia)."""
+    x = tf.random.uniform((batch_size,) + tuple(model.input_shape[1:]))
+    layers = []
+    for layer in model.layers:
+        layer_call = tf.function(lambda inputs, layer=layer: layer(inputs, training=False))
+        y = layer_call(x) # Trazado y calentamiento
+        start = time.perf_counter()
+        for _ in range(repeats):
+            y = layer_call(x)
+        y.numpy() # Esperar a que terminen las operaciones pendientes
+        forward_ms = (time.perf_counter() - start) / repeats * 1000.0
+        layers.append({
+            "name": layer.name,
+            "type": layer.__class__.__name__,
+            "output_shape": list(y.shape[1:]),
+            "params": int(layer.count_params()),
+            "flops_per_image": int(layer_flops(layer, x.shape, y.shape)),
+            "forward_ms_per_batch": forward_ms,
+        })
+        x = y
+    total_ms = sum(layer["forward_ms_per_batch"] for layer in layers)
+    for layer in layers:
+        layer["time_fraction"] = layer["forward_ms_per_batch"] / total_ms if total_ms > 0 else 0.0
+    return layers
+
+def write_training_profile(profile_callback, model, batch_size, model_save_path, trace_dir, profile_batch):
+    """Guarda el resumen del modo perfil junto al modelo y lo devuelve."""
+    profile_path, _ = profile_paths(model_save_path)
+    layers = profile_model_layers(model, batch_size)
+    epochs = profile_callback.epochs
+    # Se excluye la primera época (trazado del grafo) de las medias si hay más
+    steady = epochs[1:] or epochs
+    step_seconds = sum(e["train_step_seconds"] for e in steady)
+    input_seconds = sum(e["input_seconds"] for e in steady)
+    forward_flops = sum(layer["flops_per_image"] for layer in layers)
+    summary = {
+        "schema_version": PROFILE_SCHEMA_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "tensorflow": tf.__version__,
+        "cpu_count": os.cpu_count(),
+        "batch_size": batch_size,
+        "input_shape": list(model.input_shape[1:]),
+        "trace_dir": trace_dir,
+        "profile_batch": list(profile_batch),
+        "input_prefetched": profile_callback.production_timing is not profile_callback.input_timing,
+        "images_per_second": sum(e["images"] for e in steady) / step_seconds if step_seconds > 0 else 0.0,
+        "input_fraction": input_seconds / step_seconds if step_seconds > 0 else 0.0,
+        "forward_flops_per_image": forward_flops,
+        # Aproximación habitual: la pasada hacia atrás cuesta el doble que la de delante
+        "training_flops_per_image": 3 * forward_flops,
+        "epochs": epochs,
+        "layers": layers,
+    }
+    with open(profile_path, 'w') as f:
+        json.dump(summary, f, indent=4)
+    print(f"Perfil del entrenamiento guardado en '{profile_path}' (traza en '{trace_dir}'): "
+          f"{summary['images_per_second']:.1f} img/s, {summary['input_fraction']:.0%} del tiempo esperando datos")
+    return summary
+
+def train_lighting_classifier_distributed(base_path, batch_size, epochs, model_save_path,
+                                          num_workers, shards_index_path=None):
+    """
+    Entrena en num_workers procesos locales con entrenamientodistribuido.py y
+    devuelve un objeto con .history, igual que model.fit, para la Celda 6.
+    """
+    command = [sys.executable, "entrenamientodistribuido.py", "--workers", str(num_workers),
+               "--model", model_save_path, "--class-mapping", CLASS_MAPPING_FILE,
+               "--epochs", str(epochs), "--batch-size", str(batch_size)]
+    command += ["--shards-index", shards_index_path] if shards_index_path else ["--dataset", base_path]
+    subprocess.run(command, check=True)
+    with open(os.path.splitext(model_save_path)[0] + "_history.json", 'r') as f:
+        return types.SimpleNamespace(history=json.load(f)["history"])
+
+def train_lighting_classifier(base_path, img_height, img_width, batch_size, epochs, model_save_path,
+                              shards_index_path=None, num_workers=1, profile=False):
     """
     Entrena un modelo de clasificación para identificar tipos de iluminación.
+    Con shards_index_path, los datos se leen de los fragmentos del dataset
+    (datasetshards.py); la validación usa un 20% de los fragmentos completos.
+    Con num_workers > 1, el entrenamiento se reparte entre varios procesos.
+    Con profile=True, se graba una traza del profiler (PROFILE_BATCH_RANGE) y se
+    guarda un resumen de tiempos y costes por capa en <modelo>_profile.json.
     """
-    # Usaremos ImageDataGenerator para cargar imágenes desde las carpetas
-    # y aplicar aumentación de datos simple (re-escalado, validación de split)
-    datagen = ImageDataGenerator(
-        rescale=1./255, # Normalizar píxeles a 0-1
-        validation_split=0.2 # 20% de los datos para validación
-    )
-
-    train_generator = datagen.flow_from_directory(
-        base_path,
-        target_size=(img_height, img_width),
-        batch_size=batch_size,
-        class_mode='categorical', # Para clasificación multi-clase
-        subset='training'
-    )
-
-    validation_generator = datagen.flow_from_directory(
-        base_path,
-        target_size=(img_height, img_width),
-        batch_size=batch_size,
-        class_mode='categorical',
-        subset='validation'
-    )
-
-    num_classes = len(train_generator.class_indices)
-    class_names = list(train_generator.class_indices.keys())
+    if num_workers > 1:
+        return train_lighting_classifier_distributed(base_path, batch_size, epochs, model_save_path,
+                                                     num_workers, shards_index_path)
+
+    if shards_index_path:
+        shards_index = load_index(shards_index_path)
+        train_shards, validation_shards = split_shards(shards_index, validation_fraction=0.2, seed=SHARD_SEED)
+        # En modo perfil el prefetch se aplica después de la medición (ver timed_input_dataset)
+        train_generator = make_shard_dataset(shards_index, train_shards, img_height, img_width, batch_size,
+                                             shuffle=True, prefetch=not profile)
+        # Con un solo fragmento no queda ninguno para validación: se entrena sin ella (como entrenamientodistribuido.py)
+        validation_generator = (make_shard_dataset(shards_index, validation_shards, img_height, img_width,
+                                                   batch_size, shuffle=False) if validation_shards else None)
+        class_indices = {class_name: i for i, class_name in enumerate(shards_index["classes"])}
+        num_train_samples = count_samples(shards_index, train_shards)
+        print(f"Fragmentos: {len(train_shards)} de entrenamiento y {len(validation_shards)} de validación")
+    else:
+        # Usaremos ImageDataGenerator para cargar imágenes desde las carpetas
+        # y aplicar aumentación de datos simple (re-escalado, validación de split)
+        datagen = ImageDataGenerator(
+            rescale=1./255, # Normalizar píxeles a 0-1
+            validation_split=0.2 # 20% de los datos para validación
+        )
+
+        train_generator = datagen.flow_from_directory(
+            base_path,
+            target_size=(img_height, img_width),
+            batch_size=batch_size,
+            class_mode='categorical', # Para clasificación multi-clase
+            subset='training'
+        )
+
+        validation_generator = datagen.flow_from_directory(
+            base_path,
+            target_size=(img_height, img_width),
+            batch_size=batch_size,
+            class_mode='categorical',
+            subset='validation'
+        )
+        class_indices = train_generator.class_indices
+        num_train_samples = train_generator.samples
+
+    num_classes = len(class_indices)
+    class_names = list(class_indices.keys())
     print(f"Clases detectadas para clasificación: {class_names}")
 
     # Guardar el mapeo de índice a nombre de clase para usarlo en Blender
-    class_mapping = {v: k for k, v in train_generator.class_indices.items()}
+    class_mapping = {v: k for k, v in class_indices.items()}
     with open(CLASS_MAPPING_FILE, 'w') as f:
         json.dump(class_mapping, f, indent=4)
     print(f"Mapeo de clases guardado en '{CLASS_MAPPING_FILE}'")
@@ -215,13 +453,38 @@ def train_lighting_classifier(base_path, img_height, img_width, batch_size, epoc
                   loss='categorical_crossentropy',
                   metrics=['accuracy'])
 
+    fit_arguments = {}
+    if profile:
+        _, trace_dir = profile_paths(model_save_path)
+        steps_per_epoch = max(1, -(-num_train_samples // batch_size))
+        # La ventana del profiler debe caber en la primera época
+        profile_batch = (min(PROFILE_BATCH_RANGE[0], steps_per_epoch), min(PROFILE_BATCH_RANGE[1], steps_per_epoch))
+        input_timing = {"seconds": 0.0, "images": 0}
+        production_timing = {"seconds": 0.0, "images": 0} if shards_index_path else input_timing
+        if shards_index_path:
+            # Producción (lectura y decodificación) medida antes del prefetch del entrenamiento normal
+            train_generator = timed_input_dataset(train_generator, production_timing, img_height, img_width, num_classes)
+            train_generator = train_generator.prefetch(tf.data.AUTOTUNE)
+        # Espera del paso de entrenamiento por cada lote (tras el prefetch, si lo hay)
+        train_generator = timed_input_dataset(train_generator, input_timing, img_height, img_width, num_classes)
+        profile_callback = TrainingProfileCallback(input_timing, production_timing)
+        fit_arguments = {
+            "steps_per_epoch": steps_per_epoch,
+            "callbacks": [profile_callback,
+                          tf.keras.callbacks.TensorBoard(log_dir=trace_dir, profile_batch=profile_batch)],
+        }
+
     print("Iniciando entrenamiento del modelo...")
     history = model.fit(
         train_generator,
         epochs=epochs,
-        validation_data=validation_generator
+        validation_data=validation_generator,
+        **fit_arguments
     )
 
+    if profile:
+        write_training_profile(profile_callback, model, batch_size, model_save_path, trace_dir, profile_batch)
+
     # Guarda el modelo entrenado
     model.save(model_save_path)
     print(f"Modelo de clasificación de iluminación guardado en '{model_save_path}'")
@@ -234,7 +497,9 @@ print(f"Ejecutando train_lighting_classifier con base_path={DATASET_BASE_PATH},
       f"EPOCHS={EPOCHS}, MODEL_SAVE_PATH='{MODEL_SAVE_PATH}'")
 
 # Guardar el objeto history para la visualización posterior
-history_object = train_lighting_classifier(DATASET_BASE_PATH, IMG_HEIGHT, IMG_WIDTH, BATCH_SIZE, EPOCHS, MODEL_SAVE_PATH)
+history_object = train_lighting_classifier(DATASET_BASE_PATH, IMG_HEIGHT, IMG_WIDTH, BATCH_SIZE, EPOCHS, MODEL_SAVE_PATH,
+                                           shards_index_path=DATASET_SHARDS_INDEX, num_workers=NUM_TRAINING_WORKERS,
+                                           profile=PROFILE_TRAINING)
 
 # @title Celda 6: Visualización de Resultados del Entrenamiento (Pérdida y Precisión)
 
@@ -245,7 +510,8 @@ plt.figure(figsize=(12, 5))
 # Gráfico de Pérdida (Loss)
 plt.subplot(1, 2, 1)
 plt.plot(history_object.history['loss'], label='Pérdida de Entrenamiento')
-plt.plot(history_object.history['val_loss'], label='Pérdida de Validación')
+if 'val_loss' in history_object.history: # Sin validación si el dataset tiene un solo fragmento
+    plt.plot(history_object.history['val_loss'], label='Pérdida de Validación')
 plt.title('Pérdida del Modelo (Loss)')
 plt.xlabel('Época')
 plt.ylabel('Pérdida')
@@ -255,7 +521,8 @@ plt.grid(True)
 # Gráfico de Precisión (Accuracy)
 plt.subplot(1, 2, 2)
 plt.plot(history_object.history['accuracy'], label='Precisión de Entrenamiento')
-plt.plot(history_object.history['val_accuracy'], label='Precisión de Validación')
+if 'val_accuracy' in history_object.history:
+    plt.plot(history_object.history['val_accuracy'], label='Precisión de Validación')
 plt.title('Precisión del Modelo (Accuracy)')
 plt.xlabel('Época')
 plt.ylabel('Precisión')
@@ -267,6 +534,29 @@ plt.show()
 
 print("\nGráficos de pérdida y precisión mostrados.")
 
+# Modo perfil: reparto del tiempo de cada época y coste por capa (ver PROFILE_TRAINING en la Celda 5)
+training_profile_path, _ = profile_paths(MODEL_SAVE_PATH)
+if PROFILE_TRAINING and os.path.exists(training_profile_path):
+    with open(training_profile_path, 'r') as f:
+        training_profile = json.load(f)
+
+    epoch_numbers = [e["epoch"] for e in training_profile["epochs"]]
+    plt.figure(figsize=(12, 4))
+    plt.bar(epoch_numbers, [e["compute_seconds"] for e in training_profile["epochs"]], label='Cálculo')
+    plt.bar(epoch_numbers, [e["input_seconds"] for e in training_profile["epochs"]],
+            bottom=[e["compute_seconds"] for e in training_profile["epochs"]], label='Espera de datos')
+    plt.title(f"Tiempo de entrenamiento por época ({training_profile['images_per_second']:.1f} img/s)")
+    plt.xlabel('Época')
+    plt.ylabel('Segundos')
+    plt.legend()
+    plt.grid(True, axis='y')
+    plt.show()
+
+    print(f"{'Capa':<20}{'Tipo':<14}{'MFLOPs/img':>12}{'ms/lote':>10}{'% tiempo':>10}")
+    for layer in training_profile["layers"]:
+        print(f"{layer['name']:<20}{layer['type']:<14}{layer['flops_per_image'] / 1e6:>12.2f}"
+              f"{layer['forward_ms_per_batch']:>10.2f}{layer['time_fraction']:>10.1%}")
+
 # Opcional: Descargar el modelo y el mapeo de clases si no se guardaron en Drive
 # from google.colab import files
 # print("\nSi tu modelo y mapeo no se guardaron en Google Drive, puedes descargarlos aquí:")
@@ -21,9 +21,15 @@ import glob
 import json
 import random
 import sys
+import io
+import math
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle # Para dibujar swatches de color
 import matplotlib as mpl # Para paletas de colores de matplotlib
+from kmeansnumpy import kmeans_lloyd # Motor K-Means en NumPy (kmeansnumpy.py junto a este notebook)
+from datasetshards import load_index, iter_samples # Dataset en fragmentos tar (datasetshards.py)
+# Resúmenes fusionables de la luminosidad por clase (sketchluminosidad.py)
+from sketchluminosidad import new_sketch, add_image, merge_class_sketches, summarize_sketch, save_class_sketches, load_class_sketches
 
 print("Librerías instaladas y cargadas.")
 
@@ -36,8 +42,16 @@ DATASET_BASE_PATH = "C:/Users/59174/Desktop/Agrupados"
 # Si lo subiste directamente a Colab y descomprimiste, podría ser:
 # DATASET_BASE_PATH = "/content/Agrupados"
 
-# Asegurarse de que la carpeta exista
-if not os.path.exists(DATASET_BASE_PATH):
+# Opcional: índice del dataset empaquetado en fragmentos tar (python datasetshards.py crear ...).
+# Si se indica, las imágenes se leen en streaming desde los fragmentos en lugar de la carpeta.
+DATASET_SHARDS_INDEX = None # p. ej. "C:/Users/59174/Desktop/shards/agrupados-index.json"
+
+# Asegurarse de que la carpeta (o el índice de fragmentos) exista
+if DATASET_SHARDS_INDEX:
+    if not os.path.exists(DATASET_SHARDS_INDEX):
+        raise FileNotFoundError(f"El índice de fragmentos no se encontró en: {DATASET_SHARDS_INDEX}")
+    print(f"Índice de fragmentos verificado: {DATASET_SHARDS_INDEX}")
+elif not os.path.exists(DATASET_BASE_PATH):
     raise FileNotFoundError(f"La carpeta del dataset no se encontró en: {DATASET_BASE_PATH}\n"
                             "Por favor, verifica la ruta o asegúrate de que el dataset esté subido/montado.")
 else:
@@ -46,7 +60,17 @@ else:
 # Ruta de salida para las paletas de colores (se guardará en el entorno de Colab por defecto)
 CLASS_PALETTES_FILE = "C:/Users/59174/Desktop/lighting_class_palettes.json"
 
+# Artefacto binario versionado (.npz) con colores 0-1, pesos y estadísticas de luminosidad.
+# Es el que carga el addon de Blender; el JSON se mantiene como formato de exportación.
+CLASS_PALETTES_NPZ_FILE = os.path.splitext(CLASS_PALETTES_FILE)[0] + ".npz"
+PALETTE_ARTIFACT_SCHEMA_VERSION = 1
+
+# Histogramas de luminosidad por clase (fusionables entre procesos y reconstrucciones)
+CLASS_LUMINOSITY_SKETCHES_FILE = os.path.splitext(CLASS_PALETTES_FILE)[0] + "_luminosidad.npz"
+
 print(f"El archivo de paletas se guardará en: {CLASS_PALETTES_FILE}")
+print(f"El artefacto binario de paletas se guardará en: {CLASS_PALETTES_NPZ_FILE}")
+print(f"Los histogramas de luminosidad se guardarán en: {CLASS_LUMINOSITY_SKETCHES_FILE}")
 print("Rutas configuradas. Listo para definir las funciones de clustering.")
 
 # @title Celda 3: Definición de Funciones de Clustering y Filtrado
@@ -60,6 +84,9 @@ GRAY_COLOR_THRESHOLD = 15
 MIN_BRIGHTNESS_THRESHOLD = 25
 MAX_BRIGHTNESS_THRESHOLD = 230
 
+# Motor de clustering: "numpy" (kmeansnumpy.kmeans_lloyd, float32) o "sklearn" (KMeans)
+KMEANS_ENGINE = "numpy"
+
 # --- Funciones de Utilidad ---
 def get_class_folders(base_path):
     """Obtiene los nombres de las subcarpetas (clases de iluminación)."""
@@ -68,68 +95,80 @@ def get_class_folders(base_path):
     print(f"Clases de iluminación encontradas: {class_folders}")
     return class_folders
 
-def get_image_luminosity(image_path):
-    """Calcula la luminosidad promedio de una imagen."""
-    try:
-        img = Image.open(image_path)
-        img = img.convert("L")
-        img_array = np.array(img)
-        return np.mean(img_array) / 255.0
-    except Exception as e:
-        print(f"Error al calcular luminosidad de {image_path}: {e}", file=sys.stderr)
-        return 0.5
-
-def extract_class_dominant_colors(class_folder_path, num_colors, max_images_sample):
+def filter_chromatic_pixels(pixels):
     """
-    Extrae colores representativos para una clase de iluminación
-    aplicando K-means a una muestra de sus imágenes,
-    excluyendo grises, blancos y negros extremos de forma vectorizada.
+    Devuelve solo los píxeles con color (excluye grises, blancos y negros extremos)
+    de un array (N, 3) en 0-255, de forma vectorizada.
     """
-    all_filtered_pixels = []
-    class_luminosities = []
-    image_paths = [os.path.join(class_folder_path, f) for f in os.listdir(class_folder_path)
-                   if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif'))]
+    max_diff = np.max(pixels, axis=1) - np.min(pixels, axis=1)
+    brightness = np.mean(pixels, axis=1)
 
-    if len(image_paths) > max_images_sample:
-        image_paths = random.sample(image_paths, max_images_sample)
+    is_gray = max_diff < GRAY_COLOR_THRESHOLD
+    is_too_dark = brightness < MIN_BRIGHTNESS_THRESHOLD
+    is_too_bright = brightness > MAX_BRIGHTNESS_THRESHOLD
 
-    print(f"  Procesando {len(image_paths)} imágenes para extraer colores de '{os.path.basename(class_folder_path)}'")
+    mask_keep = ~(is_gray | is_too_dark | is_too_bright)
+    return pixels[mask_keep]
 
-    for i, img_path in enumerate(image_paths):
-        if (i + 1) % 100 == 0:
-            print(f"    Procesando imagen {i+1}/{len(image_paths)}...")
-        try:
-            img = Image.open(img_path)
-            img = img.convert("RGB")
-            img_array = np.array(img, dtype=np.int16)
-
-            pixels = img_array.reshape(-1, 3)
-
-            max_diff = np.max(pixels, axis=1) - np.min(pixels, axis=1)
-            brightness = np.mean(pixels, axis=1)
-
-            is_gray = max_diff < GRAY_COLOR_THRESHOLD
-            is_too_dark = brightness < MIN_BRIGHTNESS_THRESHOLD
-            is_too_bright = brightness > MAX_BRIGHTNESS_THRESHOLD
-
-            mask_keep = ~(is_gray | is_too_dark | is_too_bright)
+def luminosity_stats_from_sketch(luminosity_sketch):
+    """
+    Estadísticas de luminosidad de una clase a partir de su histograma: media,
+    desviación, mínimo y máximo por imagen, percentiles de los píxeles y el
+    contraste entre luz principal y de relleno (ver sketchluminosidad.py).
+    """
+    stats = summarize_sketch(luminosity_sketch)
+    return {
+        "luminosity_std": stats["std"],
+        "luminosity_min": stats["min"],
+        "luminosity_max": stats["max"],
+        "luminosity_percentiles": stats["percentiles"],
+        "key_luminosity": stats["key"],
+        "fill_luminosity": stats["fill"],
+        "key_fill_ratio": stats["key_fill_ratio"],
+    }
+
+def summarize_palette_stats(weights, luminosity_sketch):
+    """Agrupa los pesos de la paleta y las estadísticas de luminosidad de una clase."""
+    return dict({"weights": [float(w) for w in weights]}, **luminosity_stats_from_sketch(luminosity_sketch))
+
+def open_image(image_source):
+    """Abre una imagen desde una ruta o desde los bytes de un miembro de un fragmento."""
+    if isinstance(image_source, bytes):
+        return Image.open(io.BytesIO(image_source))
+    return Image.open(image_source)
+
+def accumulate_image_colors(image_source, all_filtered_pixels, luminosity_sketch, max_pixels=None):
+    """
+    Añade los píxeles de color de una imagen (ruta o bytes) y su histograma de
+    luminosidad a los acumuladores de su clase. La imagen se decodifica una sola
+    vez. max_pixels limita los píxeles que aporta la imagen.
+    """
+    img = open_image(image_source)
+    rgb_img = img.convert("RGB")
+    img_array = np.array(rgb_img, dtype=np.int16)
 
-            current_filtered_pixels = pixels[mask_keep]
+    pixels = img_array.reshape(-1, 3)
 
-            if current_filtered_pixels.size > 0:
-                all_filtered_pixels.append(current_filtered_pixels)
+    current_filtered_pixels = filter_chromatic_pixels(pixels)
+    if max_pixels is not None and current_filtered_pixels.shape[0] > max_pixels:
+        current_filtered_pixels = current_filtered_pixels[
+            np.random.choice(current_filtered_pixels.shape[0], max_pixels, replace=False)]
 
-            lum = get_image_luminosity(img_path)
-            if lum is not None:
-                class_luminosities.append(lum)
+    if current_filtered_pixels.size > 0:
+        all_filtered_pixels.append(current_filtered_pixels)
 
-        except Exception as e:
-            print(f"    Error al cargar/procesar {img_path}: {e}", file=sys.stderr)
-            continue
+    # Canal L a partir de la imagen ya decodificada
+    add_image(luminosity_sketch, np.array(img.convert("L")))
 
+def cluster_class_colors(all_filtered_pixels, luminosity_sketch, num_colors, class_label,
+                         engine=KMEANS_ENGINE, init_colors=None):
+    """
+    Aplica K-means a los píxeles acumulados de una clase.
+    Devuelve (colores 0-255 ordenados por peso, luminosidad promedio, estadísticas).
+    """
     if not all_filtered_pixels:
-        print(f"  No se encontraron píxeles de color válidos para la clase '{os.path.basename(class_folder_path)}' después del filtrado. Retornando paleta vacía y luminosidad por defecto.", file=sys.stderr)
-        return [], 0.5
+        print(f"  No se encontraron píxeles de color válidos para la clase '{class_label}' después del filtrado. Retornando paleta vacía y luminosidad por defecto.", file=sys.stderr)
+        return [], 0.5, summarize_palette_stats([], luminosity_sketch)
 
     pixels_for_kmeans = np.vstack(all_filtered_pixels)
 
@@ -138,45 +177,227 @@ def extract_class_dominant_colors(class_folder_path, num_colors, max_images_samp
         pixels_for_kmeans = pixels_for_kmeans[np.random.choice(pixels_for_kmeans.shape[0], sample_size, replace=False)]
 
     if pixels_for_kmeans.shape[0] < num_colors:
-        print(f"  Advertencia: Pocos píxeles ({pixels_for_kmeans.shape[0]}) para {num_colors} clusters en '{os.path.basename(class_folder_path)}'. Reduciendo el número de clusters.", file=sys.stderr)
+        print(f"  Advertencia: Pocos píxeles ({pixels_for_kmeans.shape[0]}) para {num_colors} clusters en '{class_label}'. Reduciendo el número de clusters.", file=sys.stderr)
         actual_num_colors = pixels_for_kmeans.shape[0] if pixels_for_kmeans.shape[0] > 0 else 1
     else:
         actual_num_colors = num_colors
 
+    avg_luminosity = summarize_sketch(luminosity_sketch)["avg"]
     if actual_num_colors == 0:
-        return [], np.mean(class_luminosities) if class_luminosities else 0.5
+        return [], avg_luminosity, summarize_palette_stats([], luminosity_sketch)
 
 
-    kmeans = KMeans(n_clusters=actual_num_colors, random_state=42, n_init='auto')
-    kmeans.fit(pixels_for_kmeans)
+    if engine == "numpy":
+        result = kmeans_lloyd(pixels_for_kmeans, actual_num_colors, random_state=42, init=init_colors)
+        cluster_centers = result.centroids.astype(np.float64)
+        cluster_counts = result.counts
+    else:
+        kmeans = KMeans(n_clusters=actual_num_colors, random_state=42, n_init='auto')
+        kmeans.fit(pixels_for_kmeans)
+        cluster_centers = kmeans.cluster_centers_
+        cluster_counts = np.bincount(kmeans.labels_, minlength=actual_num_colors)
+
+    # Ordenar los colores de mayor a menor cobertura
+    order = np.argsort(cluster_counts)[::-1]
+    cluster_centers = cluster_centers[order]
+    cluster_weights = cluster_counts[order] / max(cluster_counts.sum(), 1)
 
-    return kmeans.cluster_centers_.tolist(), np.mean(class_luminosities) if class_luminosities else 0.5
+    return (cluster_centers.tolist(), avg_luminosity,
+            summarize_palette_stats(cluster_weights.tolist(), luminosity_sketch))
 
-def generate_class_palettes(base_path, num_colors_per_class, max_images_sample):
+def extract_class_dominant_colors(class_folder_path, num_colors, max_images_sample,
+                                  engine=KMEANS_ENGINE, init_colors=None, luminosity_sketch=None):
+    """
+    Extrae colores representativos para una clase de iluminación
+    aplicando K-means a una muestra de sus imágenes,
+    excluyendo grises, blancos y negros extremos de forma vectorizada.
+    init_colors permite arrancar el motor "numpy" desde una paleta previa (0-255).
+
+    Devuelve (colores 0-255 ordenados por peso, luminosidad promedio, estadísticas),
+    donde las estadísticas incluyen el peso (fracción de píxeles) de cada color,
+    la desviación, mínimo y máximo de la luminosidad por imagen, sus percentiles
+    y el contraste principal/relleno. Si se pasa luminosity_sketch, el histograma
+    de luminosidad de la clase se acumula en él.
+    """
+    all_filtered_pixels = []
+    luminosity_sketch = new_sketch() if luminosity_sketch is None else luminosity_sketch
+    image_paths = [os.path.join(class_folder_path, f) for f in os.listdir(class_folder_path)
+                   if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif'))]
+
+    if len(image_paths) > max_images_sample:
+        image_paths = random.sample(image_paths, max_images_sample)
+
+    print(f"  Procesando {len(image_paths)} imágenes para extraer colores de '{os.path.basename(class_folder_path)}'")
+
+    for i, img_path in enumerate(image_paths):
+        if (i + 1) % 100 == 0:
+            print(f"    Procesando imagen {i+1}/{len(image_paths)}...")
+        try:
+            accumulate_image_colors(img_path, all_filtered_pixels, luminosity_sketch)
+        except Exception as e:
+            print(f"    Error al cargar/procesar {img_path}: {e}", file=sys.stderr)
+            continue
+
+    return cluster_class_colors(all_filtered_pixels, luminosity_sketch, num_colors,
+                                os.path.basename(class_folder_path), engine, init_colors)
+
+def extract_shards_dominant_colors(shards_index, num_colors, max_images_sample,
+                                   engine=KMEANS_ENGINE, previous_palettes=None, luminosity_sketches=None):
+    """
+    Igual que extract_class_dominant_colors, pero para todas las clases a la vez
+    leyendo los fragmentos del dataset en una sola pasada secuencial. Cada imagen
+    se toma con probabilidad max_images_sample / imágenes de su clase (según el
+    índice) y aporta como mucho su parte del millón de píxeles de la clase.
+    Devuelve {clase: (colores, luminosidad promedio, estadísticas)}; los histogramas
+    de luminosidad se acumulan en luminosity_sketches ({clase: resumen}) si se pasa.
+    """
+    class_counts = shards_index["class_counts"]
+    sample_probability = {c: min(1.0, max_images_sample / max(n, 1)) for c, n in class_counts.items()}
+    max_pixels_per_image = {c: int(math.ceil(1000000 / max(min(n, max_images_sample), 1)))
+                            for c, n in class_counts.items()}
+    all_filtered_pixels = {c: [] for c in shards_index["classes"]}
+    luminosity_sketches = {} if luminosity_sketches is None else luminosity_sketches
+    for class_name in shards_index["classes"]:
+        luminosity_sketches.setdefault(class_name, new_sketch())
+
+    print(f"  Leyendo {len(shards_index['shards'])} fragmentos para extraer colores de {len(all_filtered_pixels)} clases")
+
+    processed = 0
+    for class_name, member_name, data in iter_samples(shards_index, sample_probability=sample_probability,
+                                                      seed=random.randrange(2**32)):
+        processed += 1
+        if processed % 100 == 0:
+            print(f"    Procesando imagen {processed}...")
+        try:
+            accumulate_image_colors(data, all_filtered_pixels.setdefault(class_name, []),
+                                    luminosity_sketches.setdefault(class_name, new_sketch()),
+                                    max_pixels_per_image.get(class_name))
+        except Exception as e:
+            print(f"    Error al cargar/procesar {member_name}: {e}", file=sys.stderr)
+            continue
+
+    previous_palettes = previous_palettes or {}
+    results = {}
+    for class_name in all_filtered_pixels:
+        print(f"\nExtrayendo colores y luminosidad para la clase: {class_name} ({luminosity_sketches[class_name]['image_count']} imágenes)")
+        init_colors = previous_palettes.get(class_name, {}).get("colors") or None
+        results[class_name] = cluster_class_colors(all_filtered_pixels[class_name], luminosity_sketches[class_name],
+                                                   num_colors, class_name, engine, init_colors)
+        all_filtered_pixels[class_name] = None # Liberar los píxeles de la clase ya agrupada
+    return results
+
+def generate_class_palettes(base_path, num_colors_per_class, max_images_sample, warm_start=False,
+                            shards_index_path=None, merge_luminosity_from=None):
     """
     Genera y guarda las paletas de colores representativas y la luminosidad
     promedio para cada clase de iluminación.
+    Con warm_start=True, el K-Means de cada clase arranca desde la paleta guardada
+    previamente en CLASS_PALETTES_FILE (si existe).
+    Con shards_index_path, las imágenes se leen de los fragmentos del dataset
+    (datasetshards.py) en lugar de las carpetas de base_path.
+    merge_luminosity_from es una lista de archivos de histogramas de luminosidad
+    (de otros procesos con otras imágenes o de una ejecución anterior) que se
+    fusionan con los de esta ejecución antes de calcular las estadísticas.
     """
-    class_folders = get_class_folders(base_path)
     all_class_data = {}
 
-    for class_name in class_folders:
-        class_path = os.path.join(base_path, class_name)
-        print(f"\nExtrayendo colores y luminosidad para la clase: {class_name}")
-
-        dominant_colors, avg_lum = extract_class_dominant_colors(class_path, num_colors_per_class, max_images_sample)
-
+    previous_palettes = {}
+    if warm_start and os.path.exists(CLASS_PALETTES_FILE):
+        with open(CLASS_PALETTES_FILE, 'r') as f:
+            previous_palettes = json.load(f)
+        print(f"Arranque en caliente desde las paletas previas de '{CLASS_PALETTES_FILE}'")
+
+    luminosity_sketches = {}
+    if shards_index_path:
+        class_results = extract_shards_dominant_colors(
+            load_index(shards_index_path), num_colors_per_class, max_images_sample,
+            previous_palettes=previous_palettes, luminosity_sketches=luminosity_sketches)
+    else:
+        class_results = {}
+        for class_name in get_class_folders(base_path):
+            class_path = os.path.join(base_path, class_name)
+            print(f"\nExtrayendo colores y luminosidad para la clase: {class_name}")
+
+            init_colors = previous_palettes.get(class_name, {}).get("colors") or None
+            luminosity_sketches[class_name] = new_sketch()
+            class_results[class_name] = extract_class_dominant_colors(
+                class_path, num_colors_per_class, max_images_sample, init_colors=init_colors,
+                luminosity_sketch=luminosity_sketches[class_name])
+
+    if merge_luminosity_from:
+        luminosity_sketches = merge_class_sketches(
+            luminosity_sketches, *(load_class_sketches(path) for path in merge_luminosity_from))
+        print(f"Histogramas de luminosidad fusionados con: {merge_luminosity_from}")
+
+    for class_name, (dominant_colors, avg_lum, palette_stats) in class_results.items():
+        if merge_luminosity_from:
+            # Las estadísticas salen del histograma fusionado
+            avg_lum = summarize_sketch(luminosity_sketches[class_name])["avg"]
+            palette_stats = summarize_palette_stats(palette_stats["weights"], luminosity_sketches[class_name])
         all_class_data[class_name] = {
             "colors": dominant_colors,
-            "avg_luminosity": avg_lum
+            "avg_luminosity": float(avg_lum),
+            "weights": palette_stats["weights"],
+            "luminosity_stats": {k: v for k, v in palette_stats.items() if k != "weights"}
         }
 
     with open(CLASS_PALETTES_FILE, 'w') as f:
         json.dump(all_class_data, f, indent=4)
 
-    print(f"\nPaletas de colores y luminosidad por clase guardadas en '{CLASS_PALETTES_FILE}'")
+    save_class_palettes_npz(all_class_data, CLASS_PALETTES_NPZ_FILE)
+    save_class_sketches(luminosity_sketches, CLASS_LUMINOSITY_SKETCHES_FILE)
+
+    print(f"\nPaletas de colores y luminosidad por clase guardadas en '{CLASS_PALETTES_FILE}' y '{CLASS_PALETTES_NPZ_FILE}'")
+    print(f"Histogramas de luminosidad guardados en '{CLASS_LUMINOSITY_SKETCHES_FILE}'")
     return all_class_data
 
+def save_class_palettes_npz(all_class_data, filepath):
+    """
+    Guarda las paletas en un .npz sin comprimir con esquema versionado:
+      - schema_version: versión del formato (int32)
+      - class_names: nombres de las clases
+      - color_offsets: (C+1,) int32, los colores de la clase i son colors[offsets[i]:offsets[i+1]]
+      - colors: (N, 3) float32 en 0-1
+      - weights: (N,) float32, fracción de píxeles de cada color dentro de su clase
+      - luminosity: (C, F) float32 con columnas luminosity_fields (media, desviación,
+        mínimo y máximo por imagen, percentiles de los píxeles y contraste principal/relleno)
+    """
+    class_names = list(all_class_data.keys())
+    luminosity_fields = ["avg", "std", "min", "max", "p5", "p25", "p50", "p75", "p95", "key", "fill", "key_fill_ratio"]
+
+    offsets = [0]
+    colors, weights, luminosity = [], [], []
+    for class_name in class_names:
+        data = all_class_data[class_name]
+        class_colors = np.asarray(data["colors"], dtype=np.float32).reshape(-1, 3) / 255.0
+        class_weights = np.asarray(data.get("weights") or [1.0 / max(len(class_colors), 1)] * len(class_colors),
+                                   dtype=np.float32)
+        colors.append(class_colors)
+        weights.append(class_weights)
+        offsets.append(offsets[-1] + len(class_colors))
+        stats = data.get("luminosity_stats", {})
+        percentiles = stats.get("luminosity_percentiles", {})
+        luminosity.append([data["avg_luminosity"],
+                           stats.get("luminosity_std", 0.0),
+                           stats.get("luminosity_min", data["avg_luminosity"]),
+                           stats.get("luminosity_max", data["avg_luminosity"])] +
+                          [percentiles.get(field[1:], data["avg_luminosity"]) for field in luminosity_fields[4:9]] +
+                          [stats.get("key_luminosity", data["avg_luminosity"]),
+                           stats.get("fill_luminosity", data["avg_luminosity"]),
+                           stats.get("key_fill_ratio", 1.0)])
+
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 schema_version=np.int32(PALETTE_ARTIFACT_SCHEMA_VERSION),
+                 class_names=np.array(class_names, dtype=np.str_),
+                 color_offsets=np.array(offsets, dtype=np.int32),
+                 colors=np.vstack(colors) if colors else np.zeros((0, 3), dtype=np.float32),
+                 weights=np.concatenate(weights) if weights else np.zeros(0, dtype=np.float32),
+                 luminosity=np.array(luminosity, dtype=np.float32).reshape(-1, len(luminosity_fields)),
+                 luminosity_fields=np.array(luminosity_fields, dtype=np.str_))
+    os.replace(tmp_path, filepath) # Reemplazo atómico para no dejar un artefacto a medias
+
 # @title Celda 4: Visualización del K-Means: Muestras de Imágenes y Proceso de Clustering
 
 # --- PARÁMETROS PARA LA VISUALIZACIÓN ---
@@ -253,25 +474,15 @@ try:
 
     pixels_for_plot = img_array_plot.reshape(-1, 3)
 
-    # Filtrar píxeles de la imagen de ejemplo para la visualización
-    filtered_pixels_plot = []
-    for pixel in pixels_for_plot:
-        r, g, b = pixel
-        max_diff = max(abs(r - g), abs(r - b), abs(g - b))
-        brightness = (int(r) + int(g) + int(b)) / 3
-        if not (max_diff < GRAY_COLOR_THRESHOLD or \
-                brightness < MIN_BRIGHTNESS_THRESHOLD or \
-                brightness > MAX_BRIGHTNESS_THRESHOLD):
-            filtered_pixels_plot.append(pixel)
-
-    pixels_for_plot_filtered = np.array(filtered_pixels_plot)
+    # Filtrar píxeles de la imagen de ejemplo para la visualización (vectorizado)
+    pixels_for_plot_filtered = filter_chromatic_pixels(pixels_for_plot)
     if pixels_for_plot_filtered.size == 0:
         print("  No hay píxeles de color válidos en la imagen seleccionada para la visualización después del filtrado. Selecciona otra imagen.")
         raise ValueError("No hay píxeles filtrados para la visualización.")
 
     print(f"  Píxeles filtrados para visualización del clustering: {pixels_for_plot_filtered.shape[0]}")
 
-    X_plot_normalized = pixels_for_plot_filtered / 255.0
+    X_plot_normalized = (pixels_for_plot_filtered / 255.0).astype(np.float32)
 
     # --- FUNCIONES DE VISUALIZACIÓN ADAPTADAS DE TU GUÍA (para 3D RGB) ---
     def plot_pixels_3d(X_pixels_norm, y_labels=None, title="Píxeles de Imagen en Espacio RGB", s=1, cmap="viridis"):
@@ -304,36 +515,34 @@ try:
     # --- Ejecución del K-Means paso a paso para visualización ---
     print("\nVisualizando el proceso de K-Means (iteraciones en espacio RGB 3D)...")
 
-    kmeans_iter1 = KMeans(n_clusters=NUM_CLASS_COLORS, init="k-means++", n_init=1,
-                         algorithm="lloyd", max_iter=1, random_state=42)
-    kmeans_iter2 = KMeans(n_clusters=NUM_CLASS_COLORS, init="k-means++", n_init=1,
-                         algorithm="lloyd", max_iter=2, random_state=42)
-    kmeans_final = KMeans(n_clusters=NUM_CLASS_COLORS, init="k-means++", n_init=1,
-                         algorithm="lloyd", max_iter=10, random_state=42) # Iteraciones para convergencia
+    # Una sola ejecución del motor NumPy: el callback guarda el estado de cada iteración
+    kmeans_steps = {}
+    def store_kmeans_step(iteration, centroids, labels):
+        kmeans_steps[iteration] = (centroids.copy(), labels.copy())
+
+    kmeans_final = kmeans_lloyd(X_plot_normalized, NUM_CLASS_COLORS, max_iter=10, random_state=42,
+                                callback=store_kmeans_step) # Iteraciones para convergencia
 
-    # Ejecutar cada paso y graficar
+    # Graficar cada paso guardado
     print("  Paso 1: Inicialización de centroides y primera asignación...")
-    kmeans_iter1.fit(X_plot_normalized)
-    y_pred_iter1 = kmeans_iter1.predict(X_plot_normalized)
+    y_pred_iter1 = kmeans_steps[1][1]
     plot_pixels_3d(X_plot_normalized, y_pred_iter1, title="K-Means: Asignación tras 1 Iteración (Centros: Azar)", cmap="viridis")
 
     print("  Paso 2: Recálculo de centroides y segunda asignación...")
-    kmeans_iter2.fit(X_plot_normalized)
-    y_pred_iter2 = kmeans_iter2.predict(X_plot_normalized)
+    y_pred_iter2 = kmeans_steps[min(2, kmeans_final.n_iter)][1]
     plot_pixels_3d(X_plot_normalized, y_pred_iter2, title="K-Means: Asignación tras 2 Iteraciones", cmap="viridis")
 
-    print("  Paso Final: Convergencia de K-Means...")
-    kmeans_final.fit(X_plot_normalized)
-    y_pred_final = kmeans_final.predict(X_plot_normalized)
+    print(f"  Paso Final: Convergencia de K-Means ({kmeans_final.n_iter} iteraciones)...")
+    y_pred_final = kmeans_final.labels
     plot_pixels_3d(X_plot_normalized, y_pred_final, title="K-Means: Convergencia Final", cmap="viridis")
 
     print(f"\nCentroides de color finales para la imagen de ejemplo (RGB 0-255):")
-    final_colors_255 = (kmeans_final.cluster_centers_ * 255).astype(int)
+    final_colors_255 = (kmeans_final.centroids * 255).astype(int)
     for i, color in enumerate(final_colors_255):
         print(f"  Cluster {i+1}: RGB({color[0]}, {color[1]}, {color[2]})")
 
     plt.figure(figsize=(NUM_CLASS_COLORS * 1.5, 2))
-    for i, color in enumerate(kmeans_final.cluster_centers_):
+    for i, color in enumerate(np.clip(kmeans_final.centroids, 0, 1)):
         rect = Rectangle((i, 0), 1, 1, facecolor=color)
         plt.gca().add_patch(rect)
     plt.xlim(0, NUM_CLASS_COLORS)
@@ -360,7 +569,8 @@ print("Este proceso puede tardar un tiempo dependiendo del tamaño del dataset y
 
 # Ejecutar la función generate_class_palettes
 generated_palettes_data = generate_class_palettes(
-    DATASET_BASE_PATH, NUM_CLASS_COLORS, MAX_IMAGES_PER_CLASS_FOR_COLOR_EXTRACTION
+    DATASET_BASE_PATH, NUM_CLASS_COLORS, MAX_IMAGES_PER_CLASS_FOR_COLOR_EXTRACTION,
+    shards_index_path=DATASET_SHARDS_INDEX
 )
 
 print(f"\nClustering global completado. Paletas guardadas en: {CLASS_PALETTES_FILE}")
@@ -399,7 +609,8 @@ for ax, (class_name, data) in zip(axes, generated_palettes_data.items()):
     ax.set_xticks([])
     ax.set_yticks([])
     ax.set_aspect('equal')
-    ax.set_title(f"Clase: {class_name} | Luminosidad Promedio: {avg_luminosity:.2f}", fontsize=14)
+    key_fill_ratio = data.get("luminosity_stats", {}).get("key_fill_ratio", 1.0)
+    ax.set_title(f"Clase: {class_name} | Luminosidad Promedio: {avg_luminosity:.2f} | Principal/Relleno: {key_fill_ratio:.1f}:1", fontsize=14)
 
 plt.tight_layout()
 plt.show()
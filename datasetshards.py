@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""Dataset de LightMood en fragmentos (shards) tar con índice y lector en streaming.
+
+Convierte la carpeta "Agrupados" (una subcarpeta por clase) en unos pocos
+archivos .tar de tamaño acotado más un índice JSON, y los lee de forma
+secuencial sin descomprimir nada en disco. La clase de cada imagen sale de la
+ruta del miembro dentro del archivo (clase/imagen.jpg). El orden se baraja a
+nivel de fragmento (y opcionalmente con un búfer en memoria), de modo que en
+almacenamiento de red se hacen pocas lecturas grandes en lugar de millones de
+aperturas de archivos pequeños.
+
+Los consumidores (entrenamiento en clasificadoriluminacion.py, extracción de
+paletas en clusteringpaleta.py y el manifiesto de este módulo) usan
+iter_samples, que también acepta fragmentos .zip con la misma estructura.
+
+Uso:
+    python datasetshards.py crear Agrupados/ shards/ --shard-size-mb 256
+    python datasetshards.py info shards/agrupados-index.json
+    python datasetshards.py manifiesto shards/agrupados-index.json --output manifiesto.csv
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import posixpath
+import random
+import sys
+import tarfile
+import zipfile
+
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+INDEX_SCHEMA_VERSION = 1
+DEFAULT_PREFIX = "agrupados"
+DEFAULT_SHARD_SIZE_MB = 256
+
+
+# --- 1. ÍNDICE ---
+def class_from_member(member_name):
+    """La clase es la carpeta que contiene la imagen dentro del fragmento."""
+    return posixpath.basename(posixpath.dirname(member_name.replace("\\", "/")))
+
+def is_image_member(member_name):
+    return member_name.lower().endswith(IMAGE_EXTENSIONS)
+
+def index_path_for(output_dir, prefix=DEFAULT_PREFIX):
+    return os.path.join(output_dir, f"{prefix}-index.json")
+
+def load_index(index_path):
+    """
+    Lee el índice:
+      - schema_version, format ("tar" o "zip"), classes (ordenadas como flow_from_directory)
+      - class_counts y total_samples
+      - shards: lista de {file, num_samples, class_counts, size_bytes}, con file relativo al índice
+    """
+    with open(index_path, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    if index.get("schema_version", 0) > INDEX_SCHEMA_VERSION:
+        raise ValueError(f"Versión de esquema del índice no soportada: {index['schema_version']}")
+    index["base_dir"] = os.path.dirname(os.path.abspath(index_path))
+    return index
+
+def shard_path(index, shard_id):
+    return os.path.join(index["base_dir"], index["shards"][shard_id]["file"])
+
+def split_shards(index, validation_fraction=0.2, seed=42):
+    """
+    Separa los fragmentos (no las imágenes) en entrenamiento y validación, para
+    que cada lector siga leyendo archivos completos de forma secuencial.
+    Devuelve (ids de entrenamiento, ids de validación).
+    """
+    shard_ids = list(range(len(index["shards"])))
+    random.Random(seed).shuffle(shard_ids)
+    num_validation = int(round(len(shard_ids) * validation_fraction))
+    if validation_fraction > 0 and len(shard_ids) > 1:
+        num_validation = min(max(num_validation, 1), len(shard_ids) - 1)
+    return sorted(shard_ids[num_validation:]), sorted(shard_ids[:num_validation])
+
+def assign_shards(shard_ids, num_workers, worker_index):
+    """Reparto de fragmentos entre procesos (entrenamiento distribuido): cada uno lee los suyos."""
+    return [shard_id for i, shard_id in enumerate(shard_ids) if i % num_workers == worker_index]
+
+def count_samples(index, shard_ids=None, classes=None):
+    shard_ids = range(len(index["shards"])) if shard_ids is None else shard_ids
+    total = 0
+    for shard_id in shard_ids:
+        class_counts = index["shards"][shard_id]["class_counts"]
+        total += sum(count for class_name, count in class_counts.items() if classes is None or class_name in classes)
+    return total
+
+
+# --- 2. LECTURA EN STREAMING ---
+def iter_shard_members(path):
+    """Recorre un fragmento en orden de almacenamiento y devuelve (nombre del miembro, bytes)."""
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and is_image_member(info.filename):
+                    yield info.filename, archive.read(info)
+        return
+    # Modo "r|": lectura estrictamente secuencial, sin saltos hacia atrás
+    with tarfile.open(path, mode="r|*") as archive:
+        for member in archive:
+            if member.isfile() and is_image_member(member.name):
+                yield member.name, archive.extractfile(member).read()
+
+def iter_samples(index, shard_ids=None, shuffle=False, seed=None, classes=None,
+                 sample_probability=None, shuffle_buffer=0):
+    """
+    Devuelve (clase, nombre del miembro, bytes de la imagen) leyendo los fragmentos
+    de uno en uno.
+      - shuffle: baraja el orden de los fragmentos (y usa el búfer si shuffle_buffer > 0)
+      - classes: solo devuelve estas clases
+      - sample_probability: {clase: probabilidad} para submuestrear en una sola pasada
+    """
+    rng = random.Random(seed)
+    shard_ids = list(range(len(index["shards"]))) if shard_ids is None else list(shard_ids)
+    if shuffle:
+        rng.shuffle(shard_ids)
+
+    buffer = []
+    for shard_id in shard_ids:
+        for member_name, data in iter_shard_members(shard_path(index, shard_id)):
+            class_name = class_from_member(member_name)
+            if classes is not None and class_name not in classes:
+                continue
+            if sample_probability is not None and rng.random() >= sample_probability.get(class_name, 1.0):
+                continue
+            sample = (class_name, member_name, data)
+            if not shuffle or shuffle_buffer <= 1:
+                yield sample
+                continue
+            # Búfer de barajado: se emite un elemento al azar cuando está lleno
+            if len(buffer) < shuffle_buffer:
+                buffer.append(sample)
+                continue
+            position = rng.randrange(len(buffer))
+            yield buffer[position]
+            buffer[position] = sample
+    rng.shuffle(buffer)
+    yield from buffer
+
+def decode_image(data):
+    """Decodifica los bytes de un miembro como imagen PIL (sin pasar por disco)."""
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+# --- 3. ESCRITURA DE FRAGMENTOS ---
+def collect_folder_samples(source_dir):
+    """Lista (clase, ruta) de la carpeta del dataset: una subcarpeta por clase, como flow_from_directory."""
+    samples = []
+    for class_name in sorted(os.listdir(source_dir)):
+        class_path = os.path.join(source_dir, class_name)
+        if not os.path.isdir(class_path):
+            continue
+        for filename in sorted(os.listdir(class_path)):
+            if is_image_member(filename):
+                samples.append((class_name, os.path.join(class_path, filename)))
+    return samples
+
+def write_shards(source_dir, output_dir, prefix=DEFAULT_PREFIX, shard_size_mb=DEFAULT_SHARD_SIZE_MB, seed=42):
+    """
+    Empaqueta la carpeta del dataset en fragmentos .tar sin compresión (las
+    imágenes ya están comprimidas) de hasta shard_size_mb cada uno. Las imágenes
+    se barajan antes de repartirlas para que cada fragmento mezcle todas las
+    clases. Escribe el índice y devuelve su ruta.
+    """
+    samples = collect_folder_samples(source_dir)
+    if not samples:
+        raise ValueError(f"No se encontraron imágenes en las subcarpetas de {source_dir}")
+    random.Random(seed).shuffle(samples)
+    os.makedirs(output_dir, exist_ok=True)
+
+    max_bytes = shard_size_mb * 1024 * 1024
+    shards = []
+    archive = None
+    for class_name, image_path in samples:
+        if archive is None or shards[-1]["size_bytes"] >= max_bytes:
+            if archive is not None:
+                archive.close()
+            shard_file = f"{prefix}-{len(shards):05d}.tar"
+            archive = tarfile.open(os.path.join(output_dir, shard_file), mode="w")
+            shards.append({"file": shard_file, "num_samples": 0, "class_counts": {}, "size_bytes": 0})
+        shard = shards[-1]
+        archive.add(image_path, arcname=f"{class_name}/{os.path.basename(image_path)}", recursive=False)
+        shard["num_samples"] += 1
+        shard["class_counts"][class_name] = shard["class_counts"].get(class_name, 0) + 1
+        shard["size_bytes"] += os.path.getsize(image_path)
+    archive.close()
+    for shard in shards:
+        shard["size_bytes"] = os.path.getsize(os.path.join(output_dir, shard["file"]))
+
+    class_counts = {}
+    for class_name, _ in samples:
+        class_counts[class_name] = class_counts.get(class_name, 0) + 1
+    index = {
+        "schema_version": INDEX_SCHEMA_VERSION,
+        "format": "tar",
+        "classes": sorted(class_counts),
+        "class_counts": {class_name: class_counts[class_name] for class_name in sorted(class_counts)},
+        "total_samples": len(samples),
+        "shards": shards,
+    }
+    index_path = index_path_for(output_dir, prefix)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=4)
+    os.replace(tmp_path, index_path)
+    return index_path
+
+def write_manifest(index, output_path):
+    """Escribe un CSV (fragmento, miembro, clase) recorriendo los fragmentos secuencialmente."""
+    count = 0
+    with open(output_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["shard", "member", "class"])
+        for shard_id, shard in enumerate(index["shards"]):
+            for member_name, _ in iter_shard_members(shard_path(index, shard_id)):
+                writer.writerow([shard["file"], member_name, class_from_member(member_name)])
+                count += 1
+    return count
+
+
+# --- 4. PUNTO DE ENTRADA ---
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Dataset de LightMood en fragmentos tar con índice.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    create = subparsers.add_parser("crear", help="Empaqueta la carpeta del dataset en fragmentos")
+    create.add_argument("source_dir", help="Carpeta con una subcarpeta por clase (p. ej. Agrupados)")
+    create.add_argument("output_dir")
+    create.add_argument("--prefix", default=DEFAULT_PREFIX)
+    create.add_argument("--shard-size-mb", type=int, default=DEFAULT_SHARD_SIZE_MB)
+    create.add_argument("--seed", type=int, default=42)
+    info = subparsers.add_parser("info", help="Resume el índice")
+    info.add_argument("index")
+    manifest = subparsers.add_parser("manifiesto", help="Lista las imágenes de todos los fragmentos en un CSV")
+    manifest.add_argument("index")
+    manifest.add_argument("--output", default="manifiesto.csv")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "crear":
+        index_path = write_shards(args.source_dir, args.output_dir, args.prefix, args.shard_size_mb, args.seed)
+        index = load_index(index_path)
+        print(f"{index['total_samples']} imágenes en {len(index['shards'])} fragmentos. Índice: '{index_path}'")
+    elif args.command == "info":
+        index = load_index(args.index)
+        print(f"{index['total_samples']} imágenes, {len(index['shards'])} fragmentos ({index['format']})")
+        for class_name in index["classes"]:
+            print(f"  {class_name}: {index['class_counts'][class_name]}")
+    else:
+        count = write_manifest(load_index(args.index), args.output)
+        print(f"Manifiesto con {count} imágenes guardado en '{args.output}'")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
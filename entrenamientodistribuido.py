@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""Entrenamiento del clasificador de iluminación en varios procesos locales (CPU).
+
+Lanza N procesos trabajadores en esta máquina, cada uno con su TF_CONFIG
+apuntando a localhost, y entrena con tf.distribute.MultiWorkerMirroredStrategy:
+los gradientes se sincronizan (all-reduce) en cada paso y cada trabajador lee
+solo su parte de los datos (fragmentos de datasetshards.py o, sin índice, una
+de cada N imágenes de la carpeta). El lote indicado es por trabajador, así que
+el lote global crece con N; la tasa de aprendizaje se escala linealmente con N
+y se alcanza con un calentamiento de unas épocas. Solo el trabajador 0 (chief)
+guarda el modelo, class_mapping.json y el historial.
+
+El modelo y el preprocesado son los de la Celda 5 de clasificadoriluminacion.py.
+
+Uso:
+    python entrenamientodistribuido.py --workers 4 --dataset Agrupados/ --model modelo.h5
+    python entrenamientodistribuido.py --workers 4 --shards-index shards/agrupados-index.json --model modelo.h5
+    python entrenamientodistribuido.py --benchmark 1 2 4 --dataset Agrupados/ --epochs 2
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from datasetshards import (load_index, split_shards, assign_shards, count_samples, iter_samples,
+                           decode_image, collect_folder_samples)
+
+# --- 1. CONFIGURACIÓN (debe coincidir con clasificadoriluminacion.py) ---
+DATASET_BASE_PATH = "C:/Users/59174/Desktop/Agrupados"
+MODEL_SAVE_PATH = "C:/Users/59174/Desktop/lighting_classifier_model.h5"
+CLASS_MAPPING_FILE = "C:/Users/59174/Desktop/class_mapping.json"
+IMG_HEIGHT, IMG_WIDTH = 128, 128
+BATCH_SIZE = 32 # Por trabajador
+EPOCHS = 15
+BASE_LEARNING_RATE = 0.001 # La de Adam por defecto con un solo proceso
+WARMUP_EPOCHS = 2
+VALIDATION_FRACTION = 0.2
+SHUFFLE_BUFFER = 1000
+SEED = 42
+
+DEFAULT_BENCHMARK_FILE = "benchmark_entrenamiento.json"
+BENCHMARK_SCHEMA_VERSION = 1
+WORKER_POLL_SECONDS = 1.0 # Intervalo de comprobación del estado de los trabajadores
+
+
+# --- 2. DATOS ---
+def history_path_for(model_save_path):
+    return os.path.splitext(model_save_path)[0] + "_history.json"
+
+def list_training_data(args):
+    """
+    Devuelve (clases, nº de muestras de entrenamiento, nº de validación, lector de
+    entrenamiento, lector de validación o None) para el origen indicado. Cada lector
+    recibe (parte, número de partes, barajar, semilla) y devuelve un iterador de
+    (clase, bytes o ruta) con solo esa parte de los datos.
+    """
+    if args.shards_index:
+        index = load_index(args.shards_index)
+        train_shards, validation_shards = split_shards(index, VALIDATION_FRACTION, SEED)
+
+        def reader(shard_ids):
+            def read(part, num_parts, shuffle, seed):
+                # Con fragmentos suficientes, cada trabajador lee los suyos; si no, una de cada N imágenes
+                if len(shard_ids) >= num_parts:
+                    samples = iter_samples(index, assign_shards(shard_ids, num_parts, part), shuffle=shuffle,
+                                           seed=seed, shuffle_buffer=SHUFFLE_BUFFER if shuffle else 0)
+                    return ((class_name, data) for class_name, _, data in samples)
+                samples = iter_samples(index, shard_ids, shuffle=shuffle, seed=seed,
+                                       shuffle_buffer=SHUFFLE_BUFFER if shuffle else 0)
+                return ((class_name, data) for i, (class_name, _, data) in enumerate(samples) if i % num_parts == part)
+            return read
+
+        return (index["classes"], count_samples(index, train_shards), count_samples(index, validation_shards),
+                reader(train_shards), reader(validation_shards) if validation_shards else None)
+
+    samples = collect_folder_samples(args.dataset)
+    random.Random(SEED).shuffle(samples)
+    num_validation = int(len(samples) * VALIDATION_FRACTION)
+    train_samples, validation_samples = samples[num_validation:], samples[:num_validation]
+
+    def reader(sample_list):
+        def read(part, num_parts, shuffle, seed):
+            part_samples = sample_list[part::num_parts]
+            if shuffle:
+                part_samples = list(part_samples)
+                random.Random(seed).shuffle(part_samples)
+            return iter(part_samples)
+        return read
+
+    classes = sorted({class_name for class_name, _ in samples})
+    return (classes, len(train_samples), len(validation_samples),
+            reader(train_samples), reader(validation_samples) if validation_samples else None)
+
+def make_dataset(tf, read, part, num_parts, classes, batch_size, shuffle):
+    """
+    tf.data.Dataset infinito con la parte de los datos de este trabajador, con el
+    preprocesado de flow_from_directory (RGB, 'nearest', 0-1) y etiquetas one-hot.
+    Es infinito para que todos los trabajadores den los mismos pasos por época.
+    """
+    class_indices = {class_name: i for i, class_name in enumerate(classes)}
+
+    def generator():
+        epoch = 0
+        while True:
+            for class_name, source in read(part, num_parts, shuffle, SEED + epoch):
+                img = decode_image(source) if isinstance(source, bytes) else Image.open(source)
+                img = img.convert("RGB").resize((IMG_WIDTH, IMG_HEIGHT), Image.NEAREST)
+                label = np.zeros(len(classes), dtype=np.float32)
+                label[class_indices[class_name]] = 1.0
+                yield np.asarray(img, dtype=np.float32) / 255.0, label
+            epoch += 1
+
+    dataset = tf.data.Dataset.from_generator(
+        generator,
+        output_signature=(tf.TensorSpec((IMG_HEIGHT, IMG_WIDTH, 3), tf.float32),
+                          tf.TensorSpec((len(classes),), tf.float32)))
+    options = tf.data.Options()
+    # El reparto ya se hace en el lector: que tf.distribute no vuelva a dividir los datos
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return dataset.with_options(options).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+# --- 3. MODELO ---
+def build_lighting_model(num_classes):
+    """Misma arquitectura que train_lighting_classifier (Celda 5 de clasificadoriluminacion.py)."""
+    from tensorflow.keras.models import Sequential
+    from tensorflow.keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Dropout
+    return Sequential([
+        Conv2D(16, (3,3), activation='relu', input_shape=(IMG_HEIGHT, IMG_WIDTH, 3)),
+        MaxPooling2D(pool_size=(2,2)),
+        Conv2D(32, (3,3), activation='relu'),
+        MaxPooling2D(pool_size=(2,2)),
+        Conv2D(64, (3,3), activation='relu'),
+        MaxPooling2D(pool_size=(2,2)),
+        Flatten(),
+        Dense(128, activation='relu'),
+        Dropout(0.5),
+        Dense(num_classes, activation='softmax')
+    ])
+
+def scaled_learning_rate(epoch, num_workers, base_learning_rate=BASE_LEARNING_RATE, warmup_epochs=WARMUP_EPOCHS):
+    """Regla lineal: lr = base * N, alcanzada de forma gradual durante las primeras épocas."""
+    target = base_learning_rate * num_workers
+    if num_workers == 1 or epoch >= warmup_epochs:
+        return target
+    return base_learning_rate + (target - base_learning_rate) * (epoch + 1) / warmup_epochs
+
+
+# --- 4. TRABAJADOR ---
+def run_worker(args):
+    """Un proceso de entrenamiento; TF_CONFIG ya viene definido por el lanzador."""
+    import tensorflow as tf
+
+    tf_config = json.loads(os.environ["TF_CONFIG"])
+    num_workers = len(tf_config["cluster"]["worker"])
+    worker_index = tf_config["task"]["index"]
+    is_chief = worker_index == 0
+    # Repartir los núcleos entre los procesos para que no compitan entre sí
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    classes, num_train, num_validation, train_reader, validation_reader = list_training_data(args)
+    global_batch_size = args.batch_size * num_workers
+    steps_per_epoch = max(1, num_train // global_batch_size)
+    validation_steps = max(1, num_validation // global_batch_size) if validation_reader else None
+
+    train_dataset = make_dataset(tf, train_reader, worker_index, num_workers, classes, args.batch_size, shuffle=True)
+    validation_dataset = (make_dataset(tf, validation_reader, worker_index, num_workers, classes,
+                                       args.batch_size, shuffle=False) if validation_reader else None)
+
+    with strategy.scope():
+        model = build_lighting_model(len(classes))
+        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=scaled_learning_rate(0, num_workers)),
+                      loss='categorical_crossentropy',
+                      metrics=['accuracy'])
+
+    epoch_seconds = []
+    epoch_start = [0.0]
+    callbacks = [
+        tf.keras.callbacks.LearningRateScheduler(lambda epoch, lr: scaled_learning_rate(epoch, num_workers)),
+        tf.keras.callbacks.LambdaCallback(
+            on_epoch_begin=lambda epoch, logs: epoch_start.__setitem__(0, time.perf_counter()),
+            on_epoch_end=lambda epoch, logs: epoch_seconds.append(time.perf_counter() - epoch_start[0])),
+    ]
+    if is_chief:
+        print(f"{num_workers} trabajadores, lote global {global_batch_size}, "
+              f"lr {scaled_learning_rate(WARMUP_EPOCHS, num_workers)}, {steps_per_epoch} pasos por época")
+    history = model.fit(train_dataset, epochs=args.epochs, steps_per_epoch=steps_per_epoch,
+                        validation_data=validation_dataset, validation_steps=validation_steps,
+                        callbacks=callbacks, verbose=2 if is_chief else 0)
+
+    # Todos los trabajadores deben guardar (el guardado sincroniza variables);
+    # los que no son chief escriben en una carpeta temporal que se borra
+    if is_chief:
+        model_path = args.model
+    else:
+        temp_dir = tempfile.mkdtemp(prefix=f"lightmood_worker{worker_index}_")
+        model_path = os.path.join(temp_dir, os.path.basename(args.model))
+    model.save(model_path)
+    if not is_chief:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return 0
+
+    with open(args.class_mapping, 'w') as f:
+        json.dump({i: class_name for i, class_name in enumerate(classes)}, f, indent=4)
+    history_data = {
+        "num_workers": num_workers,
+        "global_batch_size": global_batch_size,
+        "steps_per_epoch": steps_per_epoch,
+        "train_samples": num_train,
+        "validation_samples": num_validation,
+        "epoch_seconds": epoch_seconds,
+        "history": {k: [float(v) for v in values] for k, values in history.history.items()},
+    }
+    with open(history_path_for(args.model), 'w') as f:
+        json.dump(history_data, f, indent=4)
+    print(f"Modelo guardado en '{args.model}', mapeo de clases en '{args.class_mapping}'")
+    return 0
+
+
+# --- 5. LANZADOR ---
+def free_ports(count):
+    """Reserva puertos libres de localhost para los trabajadores."""
+    sockets = []
+    try:
+        for _ in range(count):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind(("localhost", 0))
+            sockets.append(s)
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+def worker_arguments(args, model_path, class_mapping_path, epochs):
+    arguments = ["--model", model_path, "--class-mapping", class_mapping_path,
+                 "--epochs", str(epochs), "--batch-size", str(args.batch_size)]
+    if args.shards_index:
+        arguments += ["--shards-index", args.shards_index]
+    else:
+        arguments += ["--dataset", args.dataset]
+    return arguments
+
+def worker_log_tail(log_file, num_lines=5):
+    """Últimas líneas del registro de un trabajador (el chief escribe en la consola)."""
+    if log_file is None:
+        return ["(ver la salida del chief en la consola)"]
+    log_file.seek(0)
+    return log_file.read().strip().splitlines()[-num_lines:]
+
+def launch_workers(args, num_workers, model_path, class_mapping_path, epochs):
+    """
+    Arranca num_workers procesos de este script con su TF_CONFIG y espera a que
+    terminen, comprobándolos todos a la vez: en cuanto uno termina con error se
+    detienen los demás (que, si no, quedarían bloqueados en las operaciones
+    colectivas). Con args.timeout (segundos) se detienen todos al superarlo.
+    Devuelve el historial que escribe el chief.
+    """
+    ports = free_ports(num_workers)
+    cluster = {"worker": [f"localhost:{port}" for port in ports]}
+    processes = []
+    log_files = []
+    for worker_index in range(num_workers):
+        env = dict(os.environ)
+        env["TF_CONFIG"] = json.dumps({"cluster": cluster, "task": {"type": "worker", "index": worker_index}})
+        env["TF_CPP_MIN_LOG_LEVEL"] = env.get("TF_CPP_MIN_LOG_LEVEL", "2")
+        command = [sys.executable, os.path.abspath(__file__), "--worker"] + \
+            worker_arguments(args, model_path, class_mapping_path, epochs)
+        # Solo el chief muestra su salida; la de los demás va a un archivo que se lee si fallan
+        log_file = None if worker_index == 0 else tempfile.TemporaryFile('w+', encoding='utf-8')
+        log_files.append(log_file)
+        processes.append(subprocess.Popen(command, env=env,
+                                          stdout=None if log_file is None else subprocess.DEVNULL,
+                                          stderr=log_file))
+    start = time.perf_counter()
+    error = None
+    try:
+        while error is None:
+            return_codes = [process.poll() for process in processes]
+            failed = [i for i, code in enumerate(return_codes) if code not in (None, 0)]
+            if failed:
+                error = f"Falló el trabajador {failed[0]} (código {return_codes[failed[0]]}): " \
+                        f"{worker_log_tail(log_files[failed[0]])}"
+            elif all(code == 0 for code in return_codes):
+                break
+            elif args.timeout and time.perf_counter() - start > args.timeout:
+                error = f"Tiempo agotado ({args.timeout} s) esperando a los trabajadores"
+            else:
+                time.sleep(WORKER_POLL_SECONDS)
+    finally:
+        for process, log_file in zip(processes, log_files):
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            if log_file is not None:
+                log_file.close()
+    if error is not None:
+        raise RuntimeError(error)
+    with open(history_path_for(model_path), 'r') as f:
+        return json.load(f)
+
+def run_benchmark(args):
+    """Entrena con cada número de trabajadores y compara el tiempo por época."""
+    results = []
+    temp_dir = tempfile.mkdtemp(prefix="lightmood_train_bench_")
+    try:
+        for num_workers in args.benchmark:
+            print(f"Entrenando con {num_workers} trabajadores...")
+            model_path = os.path.join(temp_dir, f"modelo_{num_workers}.h5")
+            start = time.perf_counter()
+            history = launch_workers(args, num_workers, model_path,
+                                     os.path.join(temp_dir, f"class_mapping_{num_workers}.json"), args.epochs)
+            # La primera época incluye la compilación del grafo: se informa aparte
+            steady = history["epoch_seconds"][1:] or history["epoch_seconds"]
+            results.append({
+                "workers": num_workers,
+                "global_batch_size": history["global_batch_size"],
+                "steps_per_epoch": history["steps_per_epoch"],
+                "wall_seconds": time.perf_counter() - start,
+                "first_epoch_seconds": history["epoch_seconds"][0],
+                "epoch_seconds": float(np.mean(steady)),
+                "images_per_second": history["steps_per_epoch"] * history["global_batch_size"] / float(np.mean(steady)),
+                "final_accuracy": history["history"].get("accuracy", [None])[-1],
+                "final_val_accuracy": history["history"].get("val_accuracy", [None])[-1],
+            })
+            print(f"  {results[-1]['epoch_seconds']:.1f} s por época, {results[-1]['images_per_second']:.0f} img/s")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    baseline = next((r for r in results if r["workers"] == 1), results[0])
+    for result in results:
+        result["speedup"] = result["images_per_second"] / baseline["images_per_second"]
+        result["efficiency"] = result["speedup"] * baseline["workers"] / result["workers"]
+
+    report = {
+        "schema_version": BENCHMARK_SCHEMA_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": {"python": platform.python_version(), "machine": platform.machine(),
+                     "system": platform.system(), "cpu_count": os.cpu_count()},
+        "config": {"dataset": args.shards_index or args.dataset, "epochs": args.epochs,
+                   "batch_size_per_worker": args.batch_size},
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Reporte del benchmark guardado en '{args.output}'")
+    return report
+
+
+# --- 6. PUNTO DE ENTRADA ---
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Entrenamiento multiproceso del clasificador de LightMood.")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 4),
+                        help="Procesos trabajadores locales")
+    parser.add_argument("--dataset", default=DATASET_BASE_PATH, help="Carpeta con una subcarpeta por clase")
+    parser.add_argument("--shards-index", default=None, help="Índice de fragmentos (datasetshards.py)")
+    parser.add_argument("--model", default=MODEL_SAVE_PATH)
+    parser.add_argument("--class-mapping", default=CLASS_MAPPING_FILE)
+    parser.add_argument("--epochs", type=int, default=EPOCHS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Lote por trabajador")
+    parser.add_argument("--benchmark", type=int, nargs="+", default=None,
+                        help="Números de trabajadores a comparar (p. ej. 1 2 4)")
+    parser.add_argument("--output", default=DEFAULT_BENCHMARK_FILE, help="Reporte del benchmark")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="Segundos máximos de cada entrenamiento (por defecto, sin límite)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.worker:
+        return run_worker(args)
+    if args.benchmark:
+        run_benchmark(args)
+        return 0
+    history = launch_workers(args, args.workers, args.model, args.class_mapping, args.epochs)
+    print(f"Entrenamiento terminado: {history['num_workers']} trabajadores, "
+          f"{np.mean(history['epoch_seconds']):.1f} s por época. Historial en '{history_path_for(args.model)}'")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
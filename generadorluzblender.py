@@ -1,28 +1,262 @@
 import bpy
+import bpy.utils.previews
 import numpy as np
+import argparse
+import contextlib
+import hashlib
 from PIL import Image
 import os
 import json
+import platform
 import subprocess
+from multiprocessing import shared_memory
 import sys 
+import tempfile
+import threading
+import time
 
 # --- 1. CONFIGURACIÓN ---
 CLASS_PALETTES_FILE = "C:/Users/59174/Desktop/lighting_class_palettes.json" 
+# Artefacto binario generado junto al JSON por clusteringpaleta.py (se carga con prioridad)
+CLASS_PALETTES_NPZ_FILE = os.path.splitext(CLASS_PALETTES_FILE)[0] + ".npz"
+PALETTE_ARTIFACT_SCHEMA_VERSION = 1
 PREDICTION_SCRIPT_PATH = "C:/Users/59174/Desktop/predict_lighting_class.py" 
 PYTHON_EXECUTABLE_PATH = "C:/Users/59174/AppData/Local/Programs/Python/Python310/python.exe" 
 
 WORLD_BACKGROUND_NODE_NAME = "Background" 
+LIGHT_OBJECT_PREFIX = "LightMood_Light_Obj_"
+LIGHT_DATA_PREFIX = "LightMood_Light_"
+LIGHT_RIG_INDEX_PROPERTY = "lightmood_light_index" # Propiedad personalizada que identifica las luces del rig
+LIGHT_RIG_TYPES = ['POINT', 'AREA', 'SUN']
+
+# Rig procedural (anillo, cúpula o rejilla) con decenas o cientos de luces
+RIG_COLLECTION_NAME = "LightMood_Rig"
+RIG_COLLECTION_PROPERTY = "lightmood_rig" # Marca la colección del rig procedural de cada escena
+RIG_LIGHT_OBJECT_PREFIX = "LightMood_RigLight_"
+RIG_LIGHT_INDEX_PROPERTY = "lightmood_rig_index"
+RIG_COLOR_INDEX_PROPERTY = "lightmood_rig_color" # En los datos de luz: índice del color de la paleta
+RIG_TOTAL_ENERGY_SCALE = 3.0 # Energía total del rig = energía base * escala (equivalente al rig clásico)
+
+# Iluminación direccional: la referencia se divide en un mosaico y cada celda se clasifica
+# (en la misma pasada por lotes que la vista global) para estimar de dónde viene la luz
+DIRECTIONAL_GRID_SIZE = 3
+DIRECTIONAL_SAMPLE_SIDE = 64 # Lado de cada celda si no hay modelo en NumPy (solo se mide la luz)
+DIRECTIONAL_HIGHLIGHT_FRACTION = 0.25 # Fracción de píxeles más brillantes de la celda que definen el color de su luz
+DIRECTIONAL_KEY_EMPHASIS = 2.0 # Exponente sobre la luminosidad de cada celda para el reparto de energía
+DIRECTIONAL_SPREAD = 1.7 # Separación lateral de las luces (tangente del ángulo de las celdas del borde)
+
+# Comparación del render o de la vista 3D con la referencia (píxeles en memoria, sin archivos)
+RENDER_VIEWER_NODE_NAME = "LightMood_Viewer" # Nodo Viewer del compositor que expone el resultado del render
+VIEWER_IMAGE_NAME = "Viewer Node"
+VIEWPORT_CAPTURE_MAX_SIDE = 512
+
+# Galería de miniaturas de la paleta (renders EEVEE pequeños, en caché por estado de escena y paleta)
+PALETTE_PREVIEW_DIR = os.path.join(tempfile.gettempdir(), "lightmood_miniaturas")
+PALETTE_PREVIEW_MAX_SIDE = 160
+PALETTE_PREVIEW_SAMPLES = 4
+PALETTE_PREVIEW_COLUMNS = 4
 LIGHT_STRENGTH_MULTIPLIER = 2000 
 WORLD_BACKGROUND_STRENGTH_MULTIPLIER = 1.0 
+# Reparto de la fuerza según la distribución de luminosidad de la clase: las clases con más
+# contraste entre luz principal y relleno (key_fill_ratio) tienen luces más fuertes y fondo
+# más tenue, con la misma media. 0 usa solo la luminosidad promedio.
+LUMINOSITY_CONTRAST_EXPONENT = 0.25
+LUMINOSITY_MAX_KEY_FILL_RATIO = 16.0
+
+# Clasificador rápido por distancia de paletas (sin TensorFlow, dentro de Blender).
+# Solo se consulta el modelo externo cuando su confianza es menor que el umbral.
+FAST_CLASSIFIER_ENABLED = True
+FAST_CLASSIFIER_CONFIDENCE_THRESHOLD = 0.6
+FAST_CLASSIFIER_TEMPERATURE = 4.0 # Escala (en unidades Lab) del softmax sobre las distancias
+FAST_CLASSIFIER_MAX_IMAGE_SIDE = 96 # La imagen se reduce a este lado máximo antes del histograma
+FAST_CLASSIFIER_HISTOGRAM_LEVELS = 16 # Niveles por canal del histograma RGB (16^3 celdas)
+FAST_CLASSIFIER_PALETTE_SIZE = 8
+FAST_CLASSIFIER_LUMINOSITY_WEIGHT = 0.5 # Peso de la diferencia de luminosidad (escala L de Lab)
+
+# Modelo CNN exportado a NumPy (python API_predictor.py --export-npz modelo.npz).
+# Si existe, se evalúa dentro de Blender y el script externo solo queda como respaldo.
+NUMPY_MODEL_FILE = "C:/Users/59174/Desktop/lighting_classifier_model.npz"
+NUMPY_MODEL_SCHEMA_VERSION = 1
+NUMPY_MODEL_CHECK_TOLERANCE = 1e-4 # Diferencia máxima con las salidas de Keras guardadas en el .npz
+
+# Registro de tiempos de cada operación (una línea JSON por operación, con rotación)
+TIMING_LOG_FILE = os.path.join(tempfile.gettempdir(), "lightmood_tiempos.jsonl")
+TIMING_LOG_MAX_BYTES = 1024 * 1024
+TIMING_LOG_BACKUP_COUNT = 3
+TIMING_STDERR_PREFIX = "LIGHTMOOD_TIMING: " # Línea de tiempos que API_predictor.py escribe en stderr
+
+# Umbrales para excluir grises/blancos/negros (deben coincidir con clusteringpaleta.py)
+GRAY_COLOR_THRESHOLD = 15
+MIN_BRIGHTNESS_THRESHOLD = 25
+MAX_BRIGHTNESS_THRESHOLD = 230
 
 
 # --- 2. VARIABLES GLOBALES PARA RECURSOS CARGADOS ---
 CLASS_PALETTES_AND_LUMINOSITY = None 
+CLASS_PALETTES_SOURCE = None # (ruta, mtime_ns, tamaño) del archivo del que se cargaron las paletas
 LAST_PREDICTED_CLASS_COLORS = [] # Almacenar la última paleta de colores para el selector
 LAST_PREDICTED_COLOR_ENUM_ITEMS = [] # Opciones para el EnumProperty
+CURRENT_PALETTE_JSON = None # lightmood_palette_json de la escena cuya paleta está en las variables anteriores
+CLASSIFICATION_JOB = None # Clasificación externa en segundo plano en curso (ver start_background_classification)
+LAST_CLASSIFICATION_MESSAGE = "" # Último resultado/error de la clasificación en segundo plano para el panel
+CLASSIFICATION_POLL_INTERVAL = 0.2 # Segundos entre comprobaciones del temporizador
+CLASSIFICATION_CACHE_MAX_ENTRIES = 64 # Entradas máximas de la caché de clasificaciones por escena
+NUMPY_MODEL = None # Modelo CNN en NumPy cargado (ver get_numpy_model)
+NUMPY_MODEL_SOURCE = None # (ruta, mtime_ns, tamaño) del .npz del que se cargó el modelo
+ACTIVE_OPERATION_TIMING = None # Operación cuyos pasos se están midiendo (ver begin_operation_timing)
+LAST_OPERATION_TIMING = None # Última operación terminada, para la sección de diagnóstico del panel
+PALETTE_PREVIEW_COLLECTION = None # bpy.utils.previews con las miniaturas cargadas (ver get_palette_preview_icons)
+PALETTE_PREVIEW_CURRENT_KEYS = {} # {escena: clave de las miniaturas para su estado actual}, se vacía con cada cambio
+OCIO_MODULE = None # PyOpenColorIO, si Blender lo incluye (ver get_ocio_module); False si no está disponible
 
 
 # --- 3. FUNCIONES DE CARGA DE RECURSOS ---
+
+# Medición de tiempos de las operaciones (sección de diagnóstico del panel y registro rotativo)
+def begin_operation_timing(operation_name):
+    """Empieza a medir una operación; los pasos registrados con timed_step se le asignan."""
+    global ACTIVE_OPERATION_TIMING
+    ACTIVE_OPERATION_TIMING = {
+        "operation": operation_name,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "start_time": time.perf_counter(),
+        "steps": [],
+    }
+    return ACTIVE_OPERATION_TIMING
+
+def suspend_operation_timing():
+    """Deja de asignar pasos a la operación actual (p. ej. mientras espera un proceso externo) y la devuelve."""
+    global ACTIVE_OPERATION_TIMING
+    timing = ACTIVE_OPERATION_TIMING
+    ACTIVE_OPERATION_TIMING = None
+    return timing
+
+def resume_operation_timing(timing):
+    global ACTIVE_OPERATION_TIMING
+    ACTIVE_OPERATION_TIMING = timing
+
+def record_step_timing(step_name, seconds):
+    if ACTIVE_OPERATION_TIMING is not None:
+        ACTIVE_OPERATION_TIMING["steps"].append((step_name, seconds))
+
+@contextlib.contextmanager
+def timed_step(step_name):
+    """Mide el bloque como un paso de la operación activa (sin efecto si no hay ninguna)."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_step_timing(step_name, time.perf_counter() - start_time)
+
+def finish_operation_timing(timing, status="OK"):
+    """Cierra la medición, la muestra en el panel y la añade al registro de tiempos."""
+    global ACTIVE_OPERATION_TIMING, LAST_OPERATION_TIMING
+    if timing is None:
+        return
+    if ACTIVE_OPERATION_TIMING is timing:
+        ACTIVE_OPERATION_TIMING = None
+    timing["status"] = status
+    timing["total_seconds"] = time.perf_counter() - timing["start_time"]
+    LAST_OPERATION_TIMING = timing
+    write_timing_log(timing)
+
+def rotate_timing_log():
+    """Rota el registro cuando supera TIMING_LOG_MAX_BYTES (archivo.1, archivo.2, ...)."""
+    if not os.path.exists(TIMING_LOG_FILE) or os.path.getsize(TIMING_LOG_FILE) < TIMING_LOG_MAX_BYTES:
+        return
+    for i in range(TIMING_LOG_BACKUP_COUNT - 1, 0, -1):
+        if os.path.exists(f"{TIMING_LOG_FILE}.{i}"):
+            os.replace(f"{TIMING_LOG_FILE}.{i}", f"{TIMING_LOG_FILE}.{i + 1}")
+    os.replace(TIMING_LOG_FILE, f"{TIMING_LOG_FILE}.1")
+
+def write_timing_log(timing):
+    record = {
+        "timestamp": timing["timestamp"],
+        "operation": timing["operation"],
+        "status": timing["status"],
+        "total_seconds": round(timing["total_seconds"], 6),
+        "steps": [[step_name, round(seconds, 6)] for step_name, seconds in timing["steps"]],
+        "machine": platform.node(),
+        "blender": bpy.app.version_string,
+    }
+    try:
+        rotate_timing_log()
+        with open(TIMING_LOG_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"No se pudo escribir el registro de tiempos en {TIMING_LOG_FILE}: {e}", file=sys.stderr)
+
+def split_predictor_timings(stderr):
+    """Separa la línea de tiempos de API_predictor.py del resto de stderr. Devuelve (tiempos, stderr)."""
+    timings = {}
+    other_lines = []
+    for line in (stderr or "").splitlines():
+        if line.startswith(TIMING_STDERR_PREFIX):
+            try:
+                timings.update(json.loads(line[len(TIMING_STDERR_PREFIX):]))
+            except ValueError:
+                other_lines.append(line)
+        else:
+            other_lines.append(line)
+    return timings, "\n".join(other_lines)
+
+def record_external_script_timings(wall_seconds, predictor_timings):
+    """
+    Desglosa el tiempo del script externo: arranque del proceso (incluida la
+    importación de TensorFlow), carga del modelo e inferencia.
+    """
+    model_load = predictor_timings.get("model_load_seconds")
+    inference = predictor_timings.get("inference_seconds")
+    if model_load is None or inference is None:
+        record_step_timing("Script externo (total)", wall_seconds)
+        return
+    record_step_timing("Script externo: arranque del proceso", max(wall_seconds - model_load - inference, 0.0))
+    record_step_timing("Script externo: carga del modelo", model_load)
+    record_step_timing("Script externo: inferencia", inference)
+
+# Paletas de colores por clase
+def read_class_palettes_npz(filepath):
+    """Lee el artefacto binario de paletas (colores ya en 0-1, pesos y luminosidad)."""
+    with np.load(filepath) as artifact:
+        schema_version = int(artifact["schema_version"])
+        if schema_version > PALETTE_ARTIFACT_SCHEMA_VERSION:
+            raise ValueError(f"Versión de esquema de paletas no soportada: {schema_version}")
+        class_names = artifact["class_names"].tolist()
+        offsets = artifact["color_offsets"].tolist()
+        colors = artifact["colors"].tolist()
+        weights = artifact["weights"].tolist()
+        luminosity = artifact["luminosity"].tolist()
+        luminosity_fields = artifact["luminosity_fields"].tolist()
+
+    loaded_data = {}
+    for i, class_name in enumerate(class_names):
+        start, end = offsets[i], offsets[i + 1]
+        lum_stats = dict(zip(luminosity_fields, luminosity[i]))
+        loaded_data[class_name] = {
+            "colors": colors[start:end],
+            "weights": weights[start:end],
+            "avg_luminosity": lum_stats["avg"],
+            "luminosity_stats": lum_stats
+        }
+    return loaded_data
+
+def read_class_palettes_json(filepath):
+    """Lee el JSON de exportación de paletas (colores en 0-255)."""
+    with open(filepath, 'r') as f:
+        all_class_data_raw = json.load(f)
+    loaded_data = {}
+    for class_name, data in all_class_data_raw.items():
+        colors = [[c / 255.0 for c in color] for color in data["colors"]]
+        weights = data.get("weights") or [1.0 / max(len(colors), 1)] * len(colors)
+        loaded_data[class_name] = {
+            "colors": colors,
+            "weights": weights,
+            "avg_luminosity": data["avg_luminosity"],
+            "luminosity_stats": {"avg": data["avg_luminosity"],
+                                 "key_fill_ratio": data.get("luminosity_stats", {}).get("key_fill_ratio", 1.0)}
+        }
+    return loaded_data
+
 def load_class_palettes(filepath):
     global CLASS_PALETTES_AND_LUMINOSITY
     if not os.path.exists(filepath):
@@ -30,15 +264,11 @@ def load_class_palettes(filepath):
         CLASS_PALETTES_AND_LUMINOSITY = None
         return False
     try:
-        with open(filepath, 'r') as f:
-            all_class_data_raw = json.load(f)
-            loaded_data = {}
-            for class_name, data in all_class_data_raw.items():
-                loaded_data[class_name] = {
-                    "colors": (np.array(data["colors"]) / 255.0).tolist(), 
-                    "avg_luminosity": data["avg_luminosity"]
-                }
-            CLASS_PALETTES_AND_LUMINOSITY = loaded_data
+        if filepath.lower().endswith(".npz"):
+            CLASS_PALETTES_AND_LUMINOSITY = read_class_palettes_npz(filepath)
+        else:
+            CLASS_PALETTES_AND_LUMINOSITY = read_class_palettes_json(filepath)
+        prepare_fast_classifier_palettes(CLASS_PALETTES_AND_LUMINOSITY)
         print(f"Paletas de colores de clase y luminosidades cargadas exitosamente ({len(CLASS_PALETTES_AND_LUMINOSITY)} clases).")
         return True
     except Exception as e:
@@ -46,35 +276,695 @@ def load_class_palettes(filepath):
         CLASS_PALETTES_AND_LUMINOSITY = None
         return False
 
+def prepare_fast_classifier_palettes(class_palettes):
+    """Precalcula en Lab los colores de cada clase para el clasificador rápido."""
+    for data in class_palettes.values():
+        if data["colors"]:
+            data["colors_lab"] = srgb_to_lab(np.asarray(data["colors"], dtype=np.float32))
+            weights = np.asarray(data["weights"], dtype=np.float32)
+            data["weights_normalized"] = weights / max(float(weights.sum()), 1e-6)
+
+def resolve_class_palettes_path():
+    # El artefacto binario tiene prioridad; el JSON queda como respaldo
+    return CLASS_PALETTES_NPZ_FILE if os.path.exists(CLASS_PALETTES_NPZ_FILE) else CLASS_PALETTES_FILE
+
+def get_class_palettes(force_reload=False):
+    """
+    Registro perezoso de paletas: se cargan en el primer uso y solo se vuelven a
+    leer si el archivo cambió en disco (ruta, fecha de modificación o tamaño).
+    La comprobación es un único os.stat, barata de hacer en cada clasificación.
+    Si la recarga falla, se conservan las paletas ya cargadas.
+    """
+    global CLASS_PALETTES_AND_LUMINOSITY, CLASS_PALETTES_SOURCE
+    palettes_path = resolve_class_palettes_path()
+    try:
+        stat = os.stat(palettes_path)
+    except OSError:
+        if CLASS_PALETTES_AND_LUMINOSITY is None:
+            print(f"Error: Archivo de paletas de clases no encontrado en: {palettes_path}", file=sys.stderr)
+        return CLASS_PALETTES_AND_LUMINOSITY
+
+    source = (palettes_path, stat.st_mtime_ns, stat.st_size)
+    if not force_reload and CLASS_PALETTES_AND_LUMINOSITY is not None and source == CLASS_PALETTES_SOURCE:
+        return CLASS_PALETTES_AND_LUMINOSITY
+
+    previous_palettes = CLASS_PALETTES_AND_LUMINOSITY
+    with timed_step("Carga de paletas"):
+        loaded = load_class_palettes(palettes_path)
+    if loaded:
+        CLASS_PALETTES_SOURCE = source
+    elif previous_palettes is not None:
+        print("Se conservan las paletas cargadas previamente.", file=sys.stderr)
+        CLASS_PALETTES_AND_LUMINOSITY = previous_palettes
+    return CLASS_PALETTES_AND_LUMINOSITY
+
 # --- 4. FUNCIONES DE PREDICCIÓN Y APLICACIÓN DE ILUMINACIÓN ---
 
-def classify_image_lighting_via_external_script(image_path):
+def srgb_to_lab(rgb):
+    """Convierte colores sRGB (N, 3) en 0-1 a CIE Lab (iluminante D65)."""
+    rgb = np.asarray(rgb, dtype=np.float32)
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    rgb_to_xyz = np.array([[0.4124, 0.3576, 0.1805],
+                           [0.2126, 0.7152, 0.0722],
+                           [0.0193, 0.1192, 0.9505]], dtype=np.float32)
+    xyz = linear @ rgb_to_xyz.T / np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16.0 / 116.0)
+    L = 116.0 * f[:, 1] - 16.0
+    a = 500.0 * (f[:, 0] - f[:, 1])
+    b = 200.0 * (f[:, 1] - f[:, 2])
+    return np.stack([L, a, b], axis=1)
+
+def extract_image_palette_histogram(image_path, palette_size=FAST_CLASSIFIER_PALETTE_SIZE):
+    """
+    Extrae una paleta pequeña de la imagen con un histograma RGB cuantizado
+    (sin K-Means). Devuelve (colores 0-1, pesos, luminosidad promedio 0-1).
+    """
+    img = Image.open(image_path)
+    img.draft("RGB", (FAST_CLASSIFIER_MAX_IMAGE_SIDE, FAST_CLASSIFIER_MAX_IMAGE_SIDE)) # Decodificación reducida en JPEG
+    img = img.convert("RGB")
+    img.thumbnail((FAST_CLASSIFIER_MAX_IMAGE_SIDE, FAST_CLASSIFIER_MAX_IMAGE_SIDE))
+    pixels = np.asarray(img, dtype=np.int16).reshape(-1, 3)
+
+    # Misma ponderación que la conversión "L" de PIL
+    luminosity = float(np.mean(pixels @ np.array([0.299, 0.587, 0.114]))) / 255.0
+
+    max_diff = pixels.max(axis=1) - pixels.min(axis=1)
+    brightness = pixels.mean(axis=1)
+    mask_keep = ~((max_diff < GRAY_COLOR_THRESHOLD) |
+                  (brightness < MIN_BRIGHTNESS_THRESHOLD) |
+                  (brightness > MAX_BRIGHTNESS_THRESHOLD))
+    pixels = pixels[mask_keep]
+    if pixels.shape[0] == 0:
+        return np.zeros((0, 3), dtype=np.float32), np.zeros(0, dtype=np.float32), luminosity
+
+    levels = FAST_CLASSIFIER_HISTOGRAM_LEVELS
+    quantized = pixels * levels // 256
+    bin_index = (quantized[:, 0] * levels + quantized[:, 1]) * levels + quantized[:, 2]
+    num_bins = levels ** 3
+    counts = np.bincount(bin_index, minlength=num_bins)
+
+    top_bins = np.argsort(counts)[::-1][:palette_size]
+    top_bins = top_bins[counts[top_bins] > 0]
+    colors = np.stack([np.bincount(bin_index, weights=pixels[:, c], minlength=num_bins)[top_bins]
+                       for c in range(3)], axis=1) / counts[top_bins, np.newaxis] / 255.0
+    weights = counts[top_bins] / counts[top_bins].sum()
+    return colors.astype(np.float32), weights.astype(np.float32), luminosity
+
+def palette_distance(lab_a, weights_a, lab_b, weights_b):
+    """Distancia simétrica ponderada al color más cercano entre dos paletas Lab."""
+    pairwise = np.linalg.norm(lab_a[:, np.newaxis, :] - lab_b[np.newaxis, :, :], axis=2)
+    a_to_b = float(np.dot(weights_a, pairwise.min(axis=1)))
+    b_to_a = float(np.dot(weights_b, pairwise.min(axis=0)))
+    return 0.5 * (a_to_b + b_to_a)
+
+def classify_image_lighting_fast(image_path):
+    """
+    Clasificador rápido: compara la paleta y luminosidad de la imagen con las
+    paletas por clase cargadas. Devuelve (clase, confianza) o (None, 0.0).
+    """
+    if not CLASS_PALETTES_AND_LUMINOSITY:
+        return None, 0.0
+    with timed_step("Clasificador rápido"):
+        return _classify_image_lighting_fast(image_path)
+
+def _classify_image_lighting_fast(image_path):
+    try:
+        colors, weights, luminosity = extract_image_palette_histogram(image_path)
+    except Exception as e:
+        print(f"Error en el clasificador rápido al leer la imagen: {e}", file=sys.stderr)
+        return None, 0.0
+    if colors.shape[0] == 0:
+        return None, 0.0
+
+    image_lab = srgb_to_lab(colors)
+    class_names = []
+    distances = []
+    for class_name, data in CLASS_PALETTES_AND_LUMINOSITY.items():
+        if "colors_lab" not in data:
+            continue
+        distance = palette_distance(image_lab, weights, data["colors_lab"], data["weights_normalized"])
+        distance += FAST_CLASSIFIER_LUMINOSITY_WEIGHT * 100.0 * abs(luminosity - data["avg_luminosity"])
+        class_names.append(class_name)
+        distances.append(distance)
+    if not class_names:
+        return None, 0.0
+
+    logits = -np.asarray(distances) / FAST_CLASSIFIER_TEMPERATURE
+    probabilities = np.exp(logits - logits.max())
+    probabilities /= probabilities.sum()
+    best = int(np.argmax(probabilities))
+    print(f"Clasificador rápido: '{class_names[best]}' (confianza {probabilities[best]:.2f})")
+    return class_names[best], float(probabilities[best])
+
+def load_numpy_model(filepath):
+    """
+    Lee el modelo exportado por API_predictor.py y comprueba que el paso hacia
+    delante en NumPy reproduce las salidas de Keras guardadas en el archivo.
+    """
+    with np.load(filepath) as artifact:
+        schema_version = int(artifact["schema_version"])
+        if schema_version > NUMPY_MODEL_SCHEMA_VERSION:
+            raise ValueError(f"Versión de esquema del modelo no soportada: {schema_version}")
+        layers = []
+        for i, (layer_type, activation) in enumerate(zip(artifact["layer_types"].tolist(),
+                                                         artifact["layer_activations"].tolist())):
+            layer = {"type": layer_type, "activation": activation}
+            if layer_type in ("Conv2D", "Dense"):
+                layer["kernel"] = np.ascontiguousarray(artifact[f"layer_{i}_kernel"], dtype=np.float32)
+                layer["bias"] = artifact[f"layer_{i}_bias"].astype(np.float32)
+            elif layer_type == "MaxPooling2D":
+                layer["pool_size"] = tuple(artifact[f"layer_{i}_pool_size"].tolist())
+            layers.append(layer)
+        model = {
+            "layers": layers,
+            "input_shape": tuple(artifact["input_shape"].tolist()),
+            "class_names": artifact["class_names"].tolist(),
+        }
+        reference_inputs = artifact["reference_inputs"]
+        reference_outputs = artifact["reference_outputs"]
+
+    max_difference = float(np.abs(numpy_model_forward(model, reference_inputs) - reference_outputs).max())
+    if max_difference > NUMPY_MODEL_CHECK_TOLERANCE:
+        raise ValueError(f"El modelo en NumPy no coincide con Keras (diferencia máxima {max_difference:.2e})")
+    return model
+
+def get_numpy_model():
+    """
+    Carga perezosa del modelo en NumPy, como get_class_palettes: se vuelve a leer
+    solo si el .npz cambió. Devuelve None si no existe (el modelo es opcional).
+    """
+    global NUMPY_MODEL, NUMPY_MODEL_SOURCE
+    try:
+        stat = os.stat(NUMPY_MODEL_FILE)
+    except OSError:
+        return NUMPY_MODEL
+
+    source = (NUMPY_MODEL_FILE, stat.st_mtime_ns, stat.st_size)
+    if NUMPY_MODEL is not None and source == NUMPY_MODEL_SOURCE:
+        return NUMPY_MODEL
+    try:
+        with timed_step("Modelo NumPy: carga"):
+            NUMPY_MODEL = load_numpy_model(NUMPY_MODEL_FILE)
+        NUMPY_MODEL_SOURCE = source
+        print(f"Modelo CNN en NumPy cargado desde: {NUMPY_MODEL_FILE}")
+    except Exception as e:
+        print(f"Error al cargar el modelo CNN en NumPy desde {NUMPY_MODEL_FILE}: {e}", file=sys.stderr)
+    return NUMPY_MODEL
+
+def numpy_conv2d(x, kernel, bias):
+    """Conv2D 'valid' con paso 1 (NHWC) mediante im2col: una sola multiplicación de matrices en float32."""
+    kernel_h, kernel_w, channels, filters = kernel.shape
+    # Ventanas (N, H', W', C, kh, kw) sin copia; se ordenan como el kernel (kh, kw, C) al aplanarlas
+    windows = np.lib.stride_tricks.sliding_window_view(x, (kernel_h, kernel_w), axis=(1, 2))
+    n, out_h, out_w = windows.shape[:3]
+    columns = windows.transpose(0, 1, 2, 4, 5, 3).reshape(n * out_h * out_w, kernel_h * kernel_w * channels)
+    out = columns @ kernel.reshape(kernel_h * kernel_w * channels, filters)
+    out += bias
+    return out.reshape(n, out_h, out_w, filters)
+
+def numpy_max_pool(x, pool_size):
+    """MaxPooling2D 'valid' con paso igual al tamaño de la ventana (las filas/columnas sobrantes se descartan)."""
+    pool_h, pool_w = pool_size
+    n, height, width, channels = x.shape
+    out_h, out_w = height // pool_h, width // pool_w
+    x = x[:, :out_h * pool_h, :out_w * pool_w, :]
+    return x.reshape(n, out_h, pool_h, out_w, pool_w, channels).max(axis=(2, 4))
+
+def numpy_activation(x, activation):
+    if activation == "relu":
+        return np.maximum(x, 0.0, out=x)
+    if activation == "softmax":
+        x = np.exp(x - x.max(axis=-1, keepdims=True))
+        return x / x.sum(axis=-1, keepdims=True)
+    if activation == "linear":
+        return x
+    raise ValueError(f"Activación no soportada: {activation}")
+
+def numpy_model_forward(model, batch):
+    """Paso hacia delante del modelo exportado para un lote (N, H, W, C) en 0-1. Devuelve las probabilidades."""
+    x = np.asarray(batch, dtype=np.float32)
+    for layer in model["layers"]:
+        if layer["type"] == "Conv2D":
+            x = numpy_conv2d(x, layer["kernel"], layer["bias"])
+        elif layer["type"] == "MaxPooling2D":
+            x = numpy_max_pool(x, layer["pool_size"])
+        elif layer["type"] == "Flatten":
+            x = x.reshape(x.shape[0], -1) # Orden NHWC, igual que Flatten en Keras (channels_last)
+        elif layer["type"] == "Dense":
+            x = x @ layer["kernel"] + layer["bias"]
+        x = numpy_activation(x, layer["activation"])
+    return x
+
+def load_numpy_model_input(image_path, input_shape):
+    """Mismo preprocesado que load_image_array en API_predictor.py (redimensionado y escala 0-1)."""
+    with Image.open(image_path) as img:
+        img = img.convert("RGB").resize((input_shape[1], input_shape[0]))
+        return np.asarray(img, dtype=np.float32) / 255.0
+
+def pixels_to_model_input(pixels, input_shape):
+    """
+    Mismo preprocesado que pixels_to_image_array en API_predictor.py: píxeles
+    RGB(A) sRGB en 0-1 (primera fila arriba) cuantizados a 8 bits y redimensionados con PIL.
+    """
+    rgb = np.clip(pixels[:, :, :3] * 255.0 + 0.5, 0, 255).astype(np.uint8)
+    img = Image.fromarray(rgb, "RGB").resize((input_shape[1], input_shape[0]))
+    return np.asarray(img, dtype=np.float32) / 255.0
+
+def classify_images_lighting_numpy(image_paths):
+    """
+    Clasifica varias imágenes con el modelo CNN en NumPy en un único lote.
+    Devuelve {ruta: (clase, confianza)}; las imágenes que fallan no aparecen, y si
+    falla el lote completo se devuelve {} para que se use el clasificador externo.
+    """
+    model = get_numpy_model()
+    if model is None or not image_paths:
+        return {}
+    valid_paths = []
+    batch = []
+    with timed_step("Modelo NumPy: lectura de imágenes"):
+        for image_path in image_paths:
+            try:
+                batch.append(load_numpy_model_input(image_path, model["input_shape"]))
+                valid_paths.append(image_path)
+            except Exception as e:
+                print(f"Error en el modelo CNN en NumPy al leer la imagen {image_path}: {e}", file=sys.stderr)
+    if not batch:
+        return {}
+
+    start_time = time.perf_counter()
+    try:
+        probabilities = numpy_model_forward(model, np.stack(batch))
+    except Exception as e:
+        print(f"Error en la inferencia del modelo CNN en NumPy ({len(batch)} imágenes): {e}", file=sys.stderr)
+        return {}
+    inference_seconds = time.perf_counter() - start_time
+    record_step_timing("Modelo NumPy: inferencia", inference_seconds)
+    print(f"Modelo CNN en NumPy: {len(batch)} imágenes en {inference_seconds * 1000:.1f} ms")
+    results = {}
+    for image_path, image_probabilities in zip(valid_paths, probabilities):
+        best = int(np.argmax(image_probabilities))
+        results[image_path] = (model["class_names"][best], float(image_probabilities[best]))
+    return results
+
+def classify_image_lighting_numpy(image_path):
+    """Clasifica una imagen con el modelo CNN en NumPy. Devuelve (clase, confianza) o (None, 0.0)."""
+    return classify_images_lighting_numpy([image_path]).get(image_path, (None, 0.0))
+
+def load_reference_tiles(image_path, grid_size, input_shape):
+    """
+    Lee la referencia una sola vez y devuelve el lote [vista global, celda 0, ...]
+    (celdas por filas, de arriba a la izquierda) redimensionado a input_shape, en 0-1.
+    """
+    with Image.open(image_path) as img:
+        img = img.convert("RGB")
+        width, height = img.size
+        size = (input_shape[1], input_shape[0])
+        batch = [np.asarray(img.resize(size), dtype=np.float32)]
+        for row in range(grid_size):
+            for column in range(grid_size):
+                box = (column * width // grid_size, row * height // grid_size,
+                       (column + 1) * width // grid_size, (row + 1) * height // grid_size)
+                batch.append(np.asarray(img.crop(box).resize(size), dtype=np.float32))
+    return np.stack(batch) / 255.0
+
+def estimate_key_light_direction(tile_luminosity):
+    """
+    Dirección de la luz principal en el plano de la imagen (x a la derecha, y hacia
+    arriba, en -1..1) como centroide del exceso de luminosidad de las celdas, y
+    contraste entre la celda más clara y la más oscura.
+    """
+    grid_size = tile_luminosity.shape[0]
+    offsets = (np.arange(grid_size) + 0.5) / grid_size * 2.0 - 1.0
+    contrast = float(tile_luminosity.max() / max(tile_luminosity.min(), 1e-3))
+    excess = np.maximum(tile_luminosity - tile_luminosity.mean(), 0.0)
+    if excess.sum() <= 0.0:
+        return (0.0, 0.0), contrast
+    x = float(excess.sum(axis=0) @ offsets / excess.sum())
+    y = float(-(excess.sum(axis=1) @ offsets) / excess.sum())
+    return (x, y), contrast
+
+def describe_key_light_direction(direction):
+    x, y = direction
+    vertical = "arriba" if y > 0.2 else "abajo" if y < -0.2 else ""
+    horizontal = "derecha" if x > 0.2 else "izquierda" if x < -0.2 else ""
+    if vertical and horizontal:
+        return f"{vertical} a la {horizontal}"
+    return vertical or (f"a la {horizontal}" if horizontal else "frontal")
+
+def analyze_reference_tiles(image_path, grid_size=DIRECTIONAL_GRID_SIZE):
+    """
+    Divide la referencia en grid_size x grid_size celdas y, con el modelo CNN en
+    NumPy, clasifica la vista global y todas las celdas en una sola pasada por
+    lotes. Mide además la luminosidad y el color de las zonas claras de cada celda.
+    Sin modelo exportado, las clases de las celdas quedan en None.
+    """
+    model = get_numpy_model()
+    input_shape = model["input_shape"] if model is not None else (DIRECTIONAL_SAMPLE_SIDE, DIRECTIONAL_SAMPLE_SIDE, 3)
+    with timed_step("Direccional: lectura de celdas"):
+        batch = load_reference_tiles(image_path, grid_size, input_shape)
+
+    tiles = batch[1:]
+    luminance = tiles @ np.array([0.299, 0.587, 0.114], dtype=np.float32) # (celdas, H, W)
+    flat_luminance = luminance.reshape(len(tiles), -1)
+    threshold = np.quantile(flat_luminance, 1.0 - DIRECTIONAL_HIGHLIGHT_FRACTION, axis=1, keepdims=True)
+    highlight_mask = (flat_luminance >= threshold)[..., np.newaxis]
+    flat_tiles = tiles.reshape(len(tiles), -1, 3)
+    highlight_colors = (flat_tiles * highlight_mask).sum(axis=1) / np.maximum(highlight_mask.sum(axis=1), 1)
+
+    analysis = {
+        "grid_size": grid_size,
+        "global": (None, 0.0),
+        "tile_classes": [None] * len(tiles),
+        "tile_luminosity": flat_luminance.mean(axis=1),
+        "tile_highlight_colors": highlight_colors,
+    }
+    if model is not None:
+        start_time = time.perf_counter()
+        probabilities = numpy_model_forward(model, batch) # Una sola pasada: vista global + celdas
+        record_step_timing("Direccional: inferencia por lotes", time.perf_counter() - start_time)
+        best = probabilities.argmax(axis=1)
+        analysis["global"] = (model["class_names"][best[0]], float(probabilities[0, best[0]]))
+        analysis["tile_classes"] = [model["class_names"][i] for i in best[1:]]
+    return analysis
+
+def directional_lighting_from_analysis(analysis, class_name, image_path):
+    """
+    Color y peso de la luz de cada celda: el color de su paleta (la de la clase de
+    la celda o, si no se conoce, la de la clase global) más cercano en Lab a las
+    zonas claras de la celda; el peso crece con su luminosidad.
+    """
+    class_palettes = get_class_palettes() or {}
+    tile_colors = []
+    for tile_class, highlight_color in zip(analysis["tile_classes"], analysis["tile_highlight_colors"]):
+        palette = class_palettes.get(tile_class) or class_palettes[class_name]
+        palette_lab = palette.get("colors_lab")
+        if palette_lab is None:
+            palette_lab = srgb_to_lab(palette["colors"])
+        distances = np.linalg.norm(palette_lab - srgb_to_lab(highlight_color[np.newaxis, :]), axis=1)
+        tile_colors.append(list(palette["colors"][int(np.argmin(distances))]))
+
+    tile_luminosity = np.asarray(analysis["tile_luminosity"], dtype=np.float64)
+    tile_weights = np.maximum(tile_luminosity, 1e-3) ** DIRECTIONAL_KEY_EMPHASIS
+    grid_size = analysis["grid_size"]
+    key_direction, contrast = estimate_key_light_direction(tile_luminosity.reshape(grid_size, grid_size))
+    return {
+        "image_key": image_cache_key(image_path),
+        "class_name": class_name,
+        "grid_size": grid_size,
+        "tile_classes": analysis["tile_classes"],
+        "tile_colors": tile_colors,
+        "tile_weights": (tile_weights / tile_weights.sum()).tolist(),
+        "key_direction": list(key_direction),
+        "contrast": contrast,
+    }
+
+def store_directional_lighting(scene, image_path, class_name, analysis=None):
+    """Calcula (o reutiliza el análisis ya hecho) y guarda en la escena la iluminación direccional."""
+    try:
+        if analysis is None:
+            analysis = analyze_reference_tiles(image_path)
+        directional = directional_lighting_from_analysis(analysis, class_name, image_path)
+    except Exception as e:
+        print(f"Error al estimar la iluminación direccional de {image_path}: {e}", file=sys.stderr)
+        scene.lightmood_directional_json = ""
+        return None
+    scene.lightmood_directional_json = json.dumps(directional)
+    print(f"Iluminación direccional: luz principal {describe_key_light_direction(directional['key_direction'])} "
+          f"(contraste {directional['contrast']:.1f}), clases por celda {directional['tile_classes']}")
+    return directional
+
+def get_directional_lighting(scene):
+    """
+    Iluminación direccional guardada en la escena si corresponde a la imagen y
+    clase actuales; si no, se recalcula. Devuelve None si no se puede estimar.
+    """
+    image_path = scene.lightmood_image_path
+    class_name = scene.lightmood_last_predicted_class_name
+    if not image_path or not os.path.exists(image_path) or class_name not in (get_class_palettes() or {}):
+        return None
+    if scene.lightmood_directional_json:
+        try:
+            directional = json.loads(scene.lightmood_directional_json)
+            if directional["image_key"] == image_cache_key(image_path) and directional["class_name"] == class_name:
+                return directional
+        except (ValueError, KeyError):
+            pass
+    return store_directional_lighting(scene, image_path, class_name)
+
+def linear_to_srgb(pixels):
+    """Convierte en el sitio los canales RGB de píxeles lineales (float32) a sRGB de pantalla en 0-1."""
+    rgb = pixels[..., :3]
+    np.clip(rgb, 0.0, 1.0, out=rgb)
+    low = rgb <= 0.0031308
+    high = 1.055 * np.power(rgb, 1.0 / 2.4) - 0.055
+    rgb *= 12.92
+    np.copyto(rgb, high, where=~low)
+    return pixels
+
+@contextlib.contextmanager
+def rendered_viewer_image(scene):
+    """
+    Renderiza la escena y da la imagen 'Viewer Node' del compositor, cuyos
+    píxeles sí son accesibles desde Python (los de 'Render Result' no lo son).
+    El nodo Viewer (y el de Render Layers, si no había) solo existe dentro del
+    bloque: al salir se eliminan y se restauran scene.use_nodes y el nodo
+    activo, para que los renders posteriores del usuario no cambien.
+    """
+    saved_use_nodes = scene.use_nodes
+    scene.use_nodes = True
+    node_tree = scene.node_tree
+    saved_active = node_tree.nodes.active
+    created_nodes = []
+    try:
+        render_layers = next((node for node in node_tree.nodes if node.type == 'R_LAYERS'), None)
+        if render_layers is None:
+            render_layers = node_tree.nodes.new("CompositorNodeRLayers")
+            created_nodes.append(render_layers)
+        # Un nodo con este nombre solo puede venir de una comparación anterior: también se elimina al salir
+        viewer = node_tree.nodes.get(RENDER_VIEWER_NODE_NAME)
+        if viewer is None:
+            viewer = node_tree.nodes.new("CompositorNodeViewer")
+            viewer.name = RENDER_VIEWER_NODE_NAME
+            viewer.location = (render_layers.location.x + 300, render_layers.location.y - 300)
+            node_tree.links.new(render_layers.outputs["Image"], viewer.inputs["Image"])
+        created_nodes.append(viewer)
+        node_tree.nodes.active = viewer # Con varios Viewer, la imagen es la del activo
+        bpy.ops.render.render(scene=scene.name)
+        image = bpy.data.images.get(VIEWER_IMAGE_NAME)
+        if image is None or image.size[0] == 0:
+            raise RuntimeError("El render no generó la imagen del nodo Viewer.")
+        yield image
+    finally:
+        for node in created_nodes:
+            node_tree.nodes.remove(node)
+        if saved_active is not None and saved_active.name in node_tree.nodes:
+            node_tree.nodes.active = saved_active
+        scene.use_nodes = saved_use_nodes
+
+@contextlib.contextmanager
+def pixel_buffer(height, width, shared=False):
+    """
+    Buffer float32 (alto, ancho, 4) para los píxeles. Con shared=True vive en
+    memoria compartida, de modo que Blender escribe directamente donde lo lee el
+    script externo. Devuelve (array, nombre del bloque o None).
+    """
+    if not shared:
+        yield np.empty((height, width, 4), dtype=np.float32), None
+        return
+    shm = shared_memory.SharedMemory(create=True, size=height * width * 4 * 4)
+    pixels = np.ndarray((height, width, 4), dtype=np.float32, buffer=shm.buf)
+    try:
+        yield pixels, shm.name
+    finally:
+        pixels = None # Liberar la vista antes de cerrar el bloque
+        shm.close()
+        shm.unlink()
+
+def get_ocio_module():
+    """PyOpenColorIO (incluido en las versiones recientes de Blender) o None. La importación se intenta una vez."""
+    global OCIO_MODULE
+    if OCIO_MODULE is None:
+        try:
+            import PyOpenColorIO
+            OCIO_MODULE = PyOpenColorIO
+        except ImportError:
+            OCIO_MODULE = False
+    return OCIO_MODULE or None
+
+def scene_view_processor(scene):
+    """
+    Procesador de OpenColorIO (CPU) con el look, la transformación de vista y el
+    dispositivo de pantalla de la escena, con la configuración de color de
+    Blender. None si no hay PyOpenColorIO o la configuración no lo admite.
+    """
+    OCIO = get_ocio_module()
+    if OCIO is None:
+        return None
+    view_settings = scene.view_settings
+    try:
+        config = OCIO.Config.CreateFromFile(os.path.join(bpy.utils.resource_path('LOCAL'), "datafiles",
+                                                         "colormanagement", "config.ocio"))
+        transform = OCIO.GroupTransform()
+        if view_settings.look != 'None':
+            transform.appendTransform(OCIO.LookTransform(src=OCIO.ROLE_SCENE_LINEAR, dst=OCIO.ROLE_SCENE_LINEAR,
+                                                         looks=view_settings.look))
+        transform.appendTransform(OCIO.DisplayViewTransform(src=OCIO.ROLE_SCENE_LINEAR,
+                                                            display=scene.display_settings.display_device,
+                                                            view=view_settings.view_transform))
+        return config.getProcessor(transform).getDefaultCPUProcessor()
+    except Exception as e:
+        print(f"Aviso: no se pudo aplicar la vista '{view_settings.view_transform}' con OpenColorIO: {e}", file=sys.stderr)
+        return None
+
+def read_viewer_pixels(image, pixels, scene):
+    """
+    Copia los píxeles de la imagen (de abajo arriba, RGBA lineal) en el buffer y
+    les aplica la gestión de color de la escena (exposición, look, transformación
+    de vista y gamma), como hace la vista 3D con do_color_management=True. Sin
+    PyOpenColorIO se usa la curva sRGB simple (vista 'Standard').
+    """
+    image.pixels.foreach_get(pixels.reshape(-1))
+    view_settings = scene.view_settings
+    rgb = pixels[..., :3]
+    if view_settings.exposure != 0.0:
+        rgb *= 2.0 ** view_settings.exposure # La exposición se aplica en espacio lineal, antes de la vista
+    processor = scene_view_processor(scene)
+    if processor is None:
+        linear_to_srgb(pixels)
+    else:
+        processor.applyRGBA(pixels.reshape(-1))
+        np.clip(rgb, 0.0, 1.0, out=rgb)
+    if view_settings.gamma != 1.0:
+        np.power(rgb, 1.0 / view_settings.gamma, out=rgb)
+    return pixels
+
+def viewport_capture_size(context):
+    region = next(region for region in context.area.regions if region.type == 'WINDOW')
+    scale = min(1.0, VIEWPORT_CAPTURE_MAX_SIDE / max(region.width, region.height))
+    return region, max(int(region.height * scale), 1), max(int(region.width * scale), 1)
+
+def read_viewport_pixels(context, region, pixels):
+    """Dibuja la vista 3D actual en un framebuffer fuera de pantalla y copia sus píxeles (ya en sRGB)."""
+    import gpu # Solo disponible con interfaz gráfica
+    height, width = pixels.shape[:2]
+    region_3d = context.space_data.region_3d
+    offscreen = gpu.types.GPUOffScreen(width, height)
+    try:
+        with offscreen.bind():
+            offscreen.draw_view3d(context.scene, context.view_layer, context.space_data, region,
+                                  region_3d.view_matrix, region_3d.window_matrix, do_color_management=True)
+            buffer = offscreen.texture_color.read() # RGBA8: valores 0-255, filas de abajo arriba
+        buffer.dimensions = width * height * 4
+        pixels.reshape(-1)[:] = np.asarray(buffer, dtype=np.float32)
+        pixels /= 255.0
+    finally:
+        offscreen.free()
+    return pixels
+
+def classify_pixels_numpy(pixels):
+    """Clasifica píxeles en memoria (de abajo arriba) con el modelo CNN en NumPy. Devuelve (clase, confianza)."""
+    model = get_numpy_model()
+    if model is None:
+        return None, 0.0
+    with timed_step("Modelo NumPy: preprocesado de píxeles"):
+        model_input = pixels_to_model_input(pixels[::-1], model["input_shape"])
+    start_time = time.perf_counter()
+    probabilities = numpy_model_forward(model, model_input[np.newaxis])[0]
+    record_step_timing("Modelo NumPy: inferencia", time.perf_counter() - start_time)
+    best = int(np.argmax(probabilities))
+    return model["class_names"][best], float(probabilities[best])
+
+def classify_pixels_via_shared_memory(shm_name, pixels):
+    """Clasifica con el script externo los píxeles que ya están en memoria compartida (sin archivo intermedio)."""
+    if not check_external_script_paths():
+        return "EXTERNAL_SCRIPT_ERROR"
+    height, width, channels = pixels.shape
+    try:
+        start_time = time.perf_counter()
+        process = subprocess.run(
+            [PYTHON_EXECUTABLE_PATH, PREDICTION_SCRIPT_PATH, "--shm", shm_name, str(height), str(width), str(channels)],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        record_external_script_timings(time.perf_counter() - start_time, split_predictor_timings(process.stderr)[0])
+        return parse_external_script_output(process.stdout, process.stderr)
+    except subprocess.CalledProcessError as e:
+        print(f"Error al ejecutar el script externo con memoria compartida: {e}", file=sys.stderr)
+        print(f"STDERR: {e.stderr}", file=sys.stderr)
+        return "EXTERNAL_SCRIPT_ERROR"
+    except Exception as e:
+        print(f"Error general al llamar al script externo con memoria compartida: {e}", file=sys.stderr)
+        return "EXTERNAL_SCRIPT_ERROR"
+
+def classify_scene_pixels(context, source):
+    """
+    Clasifica el render ('RENDER') o la vista 3D ('VIEWPORT') sin escribir
+    archivos: con el modelo en NumPy en el propio proceso o, si no está
+    exportado, con el script externo a través de memoria compartida.
+    Devuelve (clase, origen, confianza).
+    """
+    scene = context.scene
+    use_shared_memory = get_numpy_model() is None
+    with contextlib.ExitStack() as buffer_stack:
+        with contextlib.ExitStack() as render_stack:
+            if source == 'RENDER':
+                with timed_step("Render de la escena"):
+                    image = render_stack.enter_context(rendered_viewer_image(scene))
+                width, height = image.size
+            else:
+                region, height, width = viewport_capture_size(context)
+            pixels, shm_name = buffer_stack.enter_context(pixel_buffer(height, width, shared=use_shared_memory))
+            with timed_step("Lectura de píxeles"):
+                if source == 'RENDER':
+                    read_viewer_pixels(image, pixels, scene)
+                else:
+                    read_viewport_pixels(context, region, pixels)
+        # El nodo Viewer temporal ya se eliminó: se clasifica la copia de los píxeles
+        if not use_shared_memory:
+            class_name, confidence = classify_pixels_numpy(pixels)
+            return class_name, "NUMPY", confidence
+        return classify_pixels_via_shared_memory(shm_name, pixels), "EXTERNAL", 0.0
+
+def check_external_script_paths():
     if not os.path.exists(PREDICTION_SCRIPT_PATH):
         print(f"Error: Script de predicción externo no encontrado: {PREDICTION_SCRIPT_PATH}", file=sys.stderr)
-        return "EXTERNAL_SCRIPT_ERROR"
+        return False
     if not os.path.exists(PYTHON_EXECUTABLE_PATH):
         print(f"Error: Ejecutable de Python externo no encontrado: {PYTHON_EXECUTABLE_PATH}", file=sys.stderr)
+        return False
+    return True
+
+def parse_external_script_output(stdout, stderr):
+    """Interpreta la salida del script externo: devuelve la clase o "EXTERNAL_SCRIPT_ERROR"."""
+    predicted_class_name = stdout.strip()
+    _, stderr = split_predictor_timings(stderr)
+
+    if stderr:
+        print(f"Output STDERR from external script: {stderr}", file=sys.stderr)
+        if "ERROR_LOADING_MODEL_OR_MAPPING" in stderr or "ERROR_PREDICTING" in stderr:
+            return "EXTERNAL_SCRIPT_ERROR"
+
+    print(f"Resultado de la clasificación externa: '{predicted_class_name}'")
+    return predicted_class_name
+
+def classify_image_lighting_via_external_script(image_path):
+    if not check_external_script_paths():
         return "EXTERNAL_SCRIPT_ERROR"
 
     try:
         command = [PYTHON_EXECUTABLE_PATH, PREDICTION_SCRIPT_PATH, image_path]
         
+        start_time = time.perf_counter()
         process = subprocess.run(
             command, 
             capture_output=True, 
             text=True, 
             check=True 
         )
+        record_external_script_timings(time.perf_counter() - start_time, split_predictor_timings(process.stderr)[0])
         
-        predicted_class_name = process.stdout.strip()
-        
-        if process.stderr:
-            print(f"Output STDERR from external script: {process.stderr}", file=sys.stderr)
-            if "ERROR_LOADING_MODEL_OR_MAPPING" in process.stderr or "ERROR_PREDICTING" in process.stderr:
-                return "EXTERNAL_SCRIPT_ERROR" 
-                
-        print(f"Resultado de la clasificación externa: '{predicted_class_name}'")
-        return predicted_class_name
+        return parse_external_script_output(process.stdout, process.stderr)
 
     except subprocess.CalledProcessError as e:
         print(f"Error al ejecutar el script externo (CalledProcessError): {e}", file=sys.stderr)
@@ -86,8 +976,295 @@ def classify_image_lighting_via_external_script(image_path):
         return "EXTERNAL_SCRIPT_ERROR"
 
 
-def set_world_background_color(color_rgb, strength):
-    world = bpy.context.scene.world
+def _run_classification_job(job):
+    """Hilo de trabajo: espera al proceso externo sin bloquear la interfaz de Blender."""
+    try:
+        stdout, stderr = job["process"].communicate()
+        if job["cancelled"]:
+            return
+        job["wall_seconds"] = time.perf_counter() - job["start_time"]
+        job["predictor_timings"] = split_predictor_timings(stderr)[0]
+        if job["process"].returncode != 0:
+            print(f"Error al ejecutar el script externo (código {job['process'].returncode})", file=sys.stderr)
+            print(f"STDOUT: {stdout}", file=sys.stderr)
+            print(f"STDERR: {stderr}", file=sys.stderr)
+            job["result"] = "EXTERNAL_SCRIPT_ERROR"
+        else:
+            job["result"] = parse_external_script_output(stdout, stderr)
+    except Exception as e:
+        print(f"Error general al llamar al script externo: {e}", file=sys.stderr)
+        job["result"] = "EXTERNAL_SCRIPT_ERROR"
+    finally:
+        job["done"] = True
+
+def start_background_classification(scene, image_path):
+    """
+    Lanza el script externo en segundo plano. La finalización se procesa en el
+    hilo principal mediante bpy.app.timers (poll_background_classification).
+    Una nueva solicitud cancela la anterior, cuyo resultado se descarta.
+    """
+    global CLASSIFICATION_JOB, LAST_CLASSIFICATION_MESSAGE
+    if not check_external_script_paths():
+        return False
+
+    cancel_background_classification()
+    start_time = time.perf_counter()
+    try:
+        process = subprocess.Popen(
+            [PYTHON_EXECUTABLE_PATH, PREDICTION_SCRIPT_PATH, image_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+    except Exception as e:
+        print(f"Error general al llamar al script externo: {e}", file=sys.stderr)
+        return False
+    record_step_timing("Script externo: lanzamiento (Popen)", time.perf_counter() - start_time)
+
+    job = {
+        "scene_name": scene.name,
+        "image_path": image_path,
+        "process": process,
+        "start_time": start_time,
+        "result": None,
+        "done": False,
+        "cancelled": False,
+        # La medición de la operación continúa cuando termina el proceso (poll_background_classification)
+        "timing": suspend_operation_timing(),
+        "wall_seconds": None,
+        "predictor_timings": {},
+    }
+    job["thread"] = threading.Thread(target=_run_classification_job, args=(job,), daemon=True)
+    job["thread"].start()
+    CLASSIFICATION_JOB = job
+    LAST_CLASSIFICATION_MESSAGE = ""
+
+    if not bpy.app.timers.is_registered(poll_background_classification):
+        bpy.app.timers.register(poll_background_classification, first_interval=CLASSIFICATION_POLL_INTERVAL)
+    return True
+
+def cancel_background_classification():
+    """Cancela la clasificación en curso (si la hay) terminando el proceso externo."""
+    global CLASSIFICATION_JOB
+    job = CLASSIFICATION_JOB
+    if job is None:
+        return False
+    job["cancelled"] = True
+    if job["process"].poll() is None:
+        job["process"].kill()
+    CLASSIFICATION_JOB = None
+    finish_operation_timing(job["timing"], status="CANCELLED")
+    tag_lightmood_panels_redraw()
+    return True
+
+def classification_elapsed_seconds():
+    if CLASSIFICATION_JOB is None:
+        return 0.0
+    return time.perf_counter() - CLASSIFICATION_JOB["start_time"]
+
+def tag_lightmood_panels_redraw():
+    """Fuerza el redibujado de las vistas 3D para actualizar el progreso del panel."""
+    window_manager = bpy.context.window_manager
+    if window_manager is None:
+        return
+    for window in window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
+
+def poll_background_classification():
+    """Temporizador en el hilo principal: aplica el resultado cuando el proceso termina."""
+    global CLASSIFICATION_JOB, LAST_CLASSIFICATION_MESSAGE
+    job = CLASSIFICATION_JOB
+    if job is None:
+        return None # Sin trabajo pendiente: se desregistra el temporizador
+    tag_lightmood_panels_redraw()
+    if not job["done"]:
+        return CLASSIFICATION_POLL_INTERVAL
+
+    CLASSIFICATION_JOB = None
+    resume_operation_timing(job["timing"])
+    if job["wall_seconds"] is not None:
+        record_external_script_timings(job["wall_seconds"], job["predictor_timings"])
+    scene = bpy.data.scenes.get(job["scene_name"])
+    # Descartar el resultado si la escena ya no existe o la imagen seleccionada cambió
+    if scene is None or scene.lightmood_image_path != job["image_path"]:
+        print("DEBUG_BLENDER: Resultado de clasificación descartado (la escena o la imagen cambiaron).")
+        LAST_CLASSIFICATION_MESSAGE = "Resultado descartado: la escena o la imagen cambiaron."
+        finish_operation_timing(job["timing"], status="DISCARDED")
+        return None
+
+    error_message = apply_predicted_class(scene, job["result"], "EXTERNAL", 0.0, image_path=job["image_path"])
+    finish_operation_timing(job["timing"], status="ERROR" if error_message else "OK")
+    if error_message:
+        print(f"DEBUG_BLENDER: {error_message}", file=sys.stderr)
+        LAST_CLASSIFICATION_MESSAGE = error_message
+    else:
+        LAST_CLASSIFICATION_MESSAGE = f"Imagen clasificada como '{job['result']}' en {time.perf_counter() - job['start_time']:.1f} s."
+    tag_lightmood_panels_redraw()
+    return None
+
+@bpy.app.handlers.persistent
+def cancel_classification_on_load(dummy):
+    """Al abrir otro archivo .blend se descarta la clasificación en curso."""
+    cancel_background_classification()
+
+@bpy.app.handlers.persistent
+def restore_palette_on_load(dummy):
+    """Reconstruye la paleta del Paso 4 a partir de los datos guardados en la escena."""
+    PALETTE_PREVIEW_CURRENT_KEYS.clear() # Las claves eran de las escenas del archivo anterior
+    scene = bpy.context.scene
+    if scene is not None:
+        restore_scene_palette(scene)
+
+def image_cache_key(image_path):
+    """Identidad de la imagen para la caché: ruta absoluta, tamaño y fecha de modificación."""
+    try:
+        stat = os.stat(image_path)
+    except OSError:
+        return None
+    return f"{os.path.normcase(os.path.abspath(image_path))}|{stat.st_size}|{stat.st_mtime_ns}"
+
+def file_signature(path):
+    """Ruta, fecha de modificación y tamaño de un archivo ("" si no existe)."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return ""
+    return f"{os.path.normcase(os.path.abspath(path))}:{stat.st_mtime_ns}:{stat.st_size}"
+
+def classification_cache_key(image_path):
+    """
+    Clave de la caché de clasificaciones: la identidad de la imagen más la de los
+    artefactos que deciden el resultado (paletas, modelo NumPy y script de
+    predicción). Si se regenera la paleta o se reentrena el modelo, las entradas
+    anteriores dejan de coincidir y la imagen se vuelve a clasificar.
+    """
+    image_key = image_cache_key(image_path)
+    if image_key is None:
+        return None
+    sources = "|".join(file_signature(path) for path in
+                       (resolve_class_palettes_path(), NUMPY_MODEL_FILE, PREDICTION_SCRIPT_PATH))
+    return f"{image_key}|{hashlib.sha1(sources.encode('utf-8')).hexdigest()}"
+
+def find_cached_classification(scene, image_path):
+    key = classification_cache_key(image_path)
+    if key is None:
+        return None
+    for entry in scene.lightmood_classification_cache:
+        if entry.key == key:
+            return entry
+    return None
+
+def store_cached_classification(scene, image_path):
+    """Guarda en la caché de la escena la clasificación y paleta actuales de la imagen."""
+    key = classification_cache_key(image_path)
+    if key is None:
+        return
+    cache = scene.lightmood_classification_cache
+    for i, entry in enumerate(cache):
+        if entry.key == key:
+            cache.remove(i)
+            break
+    # Las entradas más antiguas están al principio de la colección
+    while len(cache) >= CLASSIFICATION_CACHE_MAX_ENTRIES:
+        cache.remove(0)
+    entry = cache.add()
+    entry.key = key
+    entry.class_name = scene.lightmood_last_predicted_class_name
+    entry.avg_luminosity = scene.lightmood_avg_luminosity
+    entry.prediction_source = scene.lightmood_last_prediction_source
+    entry.prediction_confidence = scene.lightmood_last_prediction_confidence
+    entry.palette_json = scene.lightmood_palette_json
+
+def restore_cached_classification(scene, entry):
+    """Restaura desde la caché la clase y la paleta, sin clasificar de nuevo."""
+    set_scene_palette(scene, entry.class_name, json.loads(entry.palette_json), entry.avg_luminosity,
+                      entry.prediction_source, entry.prediction_confidence)
+
+def restore_scene_palette(scene):
+    """Rellena las variables globales del Paso 4 con la paleta guardada en la escena."""
+    global CURRENT_PALETTE_JSON
+    LAST_PREDICTED_CLASS_COLORS.clear()
+    LAST_PREDICTED_COLOR_ENUM_ITEMS.clear()
+    CURRENT_PALETTE_JSON = scene.lightmood_palette_json
+    if not scene.lightmood_palette_json:
+        return False
+    colors_for_scene = json.loads(scene.lightmood_palette_json)
+    LAST_PREDICTED_CLASS_COLORS.extend(colors_for_scene)
+    LAST_PREDICTED_COLOR_ENUM_ITEMS.extend(build_color_enum_items(colors_for_scene))
+    return True
+
+def sync_scene_palette(scene):
+    """Recarga las variables globales del Paso 4 si la escena tiene otra paleta (p. ej. al cambiar de escena)."""
+    if scene.lightmood_palette_json != CURRENT_PALETTE_JSON:
+        restore_scene_palette(scene)
+
+def build_color_enum_items(colors_for_scene):
+    # Formato: (identifier, name, description)
+    # El identifier será el índice como string
+    return [(str(i), f"Color {i+1} ({int(color_rgb[0]*255)}, {int(color_rgb[1]*255)}, {int(color_rgb[2]*255)})", f"Color de la paleta: {i+1}")
+            for i, color_rgb in enumerate(colors_for_scene)]
+
+def store_scene_classification(scene, predicted_lighting_class, colors_for_scene, avg_luminosity,
+                               prediction_source, prediction_confidence):
+    """Guarda la clase y su paleta en las propiedades (persistentes) de la escena."""
+    scene.lightmood_last_predicted_class_name = predicted_lighting_class
+    scene.lightmood_avg_luminosity = avg_luminosity
+    scene.lightmood_last_prediction_source = prediction_source
+    scene.lightmood_last_prediction_confidence = prediction_confidence
+    scene.lightmood_palette_json = json.dumps(colors_for_scene)
+
+def set_scene_palette(scene, predicted_lighting_class, colors_for_scene, avg_luminosity,
+                      prediction_source, prediction_confidence):
+    """Guarda la clase y su paleta en la escena (persistente) y en las variables globales del Paso 4."""
+    store_scene_classification(scene, predicted_lighting_class, colors_for_scene, avg_luminosity,
+                               prediction_source, prediction_confidence)
+
+    # Limpiar y rellenar la lista global de colores y las opciones del EnumProperty
+    restore_scene_palette(scene)
+    
+    # Seleccionar el primer color por defecto si la paleta no está vacía
+    if LAST_PREDICTED_COLOR_ENUM_ITEMS:
+        scene.lightmood_world_color_enum = LAST_PREDICTED_COLOR_ENUM_ITEMS[0][0]
+    else:
+        scene.lightmood_world_color_enum = "" # Vacío si no hay colores
+
+def apply_predicted_class(scene, predicted_lighting_class, prediction_source, prediction_confidence, image_path=None):
+    """
+    Guarda la clase predicha y su paleta en la escena y en las variables globales
+    del Paso 4; si se indica image_path, también en la caché de clasificaciones.
+    Devuelve un mensaje de error o None si todo fue bien.
+    """
+    print(f"DEBUG_BLENDER: Clase predicha recibida: '{predicted_lighting_class}' (origen: {prediction_source})") 
+
+    if predicted_lighting_class is None or predicted_lighting_class == "EXTERNAL_SCRIPT_ERROR":
+        return "Fallo al obtener la clasificación del script externo. Revisa la consola de sistema (Window > Toggle System Console) para errores detallados."
+
+    class_palettes = get_class_palettes()
+    if class_palettes is None or predicted_lighting_class not in class_palettes: 
+        print(f"DEBUG_BLENDER: Clase predicha '{predicted_lighting_class}' no encontrada en las paletas de colores cargadas.", file=sys.stderr)
+        return f"Clase '{predicted_lighting_class}' predicha por el modelo, pero no se encontró la paleta de colores asociada. Revisa los nombres de las carpetas de tu dataset y el archivo class_mapping.json."
+
+    class_data = class_palettes[predicted_lighting_class] 
+    colors_for_scene = class_data["colors"]
+    avg_luminosity = class_data["avg_luminosity"]
+
+    print(f"DEBUG_BLENDER: Paleta de colores obtenida para '{predicted_lighting_class}': {colors_for_scene}") 
+    print(f"DEBUG_BLENDER: Luminosidad promedio obtenida para '{predicted_lighting_class}': {avg_luminosity}") 
+
+    # Almacenar los datos en las propiedades de la escena y la variable global para el Paso 4
+    with timed_step("Escena: paleta y caché"):
+        set_scene_palette(scene, predicted_lighting_class, colors_for_scene, avg_luminosity,
+                          prediction_source, prediction_confidence)
+        if image_path:
+            store_cached_classification(scene, image_path)
+    return None
+
+
+def set_world_background_color(color_rgb, strength, scene=None):
+    scene = scene or bpy.context.scene
+    world = scene.world
     if not world:
         print("No se encontró el mundo en la escena.", file=sys.stderr)
         return
@@ -111,53 +1288,759 @@ def set_world_background_color(color_rgb, strength):
         links.new(background_node.outputs['Color'], output_node.inputs['Surface'])
         print("Conectando nodo de Background a World Output Surface.")
     
-    color_rgb_alpha = color_rgb + [1.0] 
+    color_rgb_alpha = list(color_rgb) + [1.0] 
     background_node.inputs['Color'].default_value = color_rgb_alpha
     background_node.inputs['Strength'].default_value = strength
     print(f"Color de fondo del mundo establecido a: {color_rgb_alpha}, Fuerza: {strength}")
 
-def setup_lights_from_colors(colors, base_strength): 
-    lights_to_remove = [obj for obj in bpy.context.scene.objects if obj.type == 'LIGHT' and obj.name.startswith("LightMood_Light_")]
-    for obj in lights_to_remove:
-        bpy.data.objects.remove(obj, do_unlink=True)
-        
-    light_types = ['POINT', 'AREA', 'SUN'] 
-    num_lights_to_create = min(len(colors), len(light_types))
+def get_light_rig_objects(scene):
+    """
+    Devuelve {índice: objeto} con las luces LightMood de la escena. Se identifican
+    por la propiedad personalizada LIGHT_RIG_INDEX_PROPERTY, o por el nombre
+    LightMood_Light_Obj_<i> en archivos creados con versiones anteriores.
+    """
+    rig_objects = {}
+    for obj in scene.objects:
+        if obj.type != 'LIGHT':
+            continue
+        if LIGHT_RIG_INDEX_PROPERTY in obj:
+            rig_objects[int(obj[LIGHT_RIG_INDEX_PROPERTY])] = obj
+        elif obj.name.startswith(LIGHT_OBJECT_PREFIX) and obj.name[len(LIGHT_OBJECT_PREFIX):].isdigit():
+            rig_objects[int(obj.name[len(LIGHT_OBJECT_PREFIX):])] = obj
+    return rig_objects
+
+def remove_light_object(obj):
+    """Elimina un objeto de luz y su datablock si queda sin usuarios."""
+    light_data = obj.data
+    bpy.data.objects.remove(obj, do_unlink=True)
+    if light_data is not None and light_data.users == 0:
+        bpy.data.lights.remove(light_data)
+
+def purge_orphan_rig_lights():
+    """Libera los datablocks de luz LightMood que ya no usa ningún objeto."""
+    orphans = [light for light in bpy.data.lights if light.name.startswith(LIGHT_DATA_PREFIX) and light.users == 0]
+    for light in orphans:
+        bpy.data.lights.remove(light)
+    return len(orphans)
+
+def light_energy_for_color(color, base_strength):
+    """Energía de una luz: la energía base escalada por el brillo medio de su color."""
+    return max(base_strength * ((color[0] + color[1] + color[2]) / 3.0), 0.1)
+
+def light_rig_transform(i, light_type):
+    """Posición y rotación fijas de cada luz del rig clásico."""
+    if light_type == 'POINT':
+        return (i * 3 - 3, i * 3 - 3, 5), (0, 0, 0)
+    if light_type == 'AREA':
+        return (i * 3 - 3, 0, 7), (np.radians(-90), 0, 0)
+    return (0, 0, 10), (np.radians(45), np.radians(-30), 0)
+
+def setup_lights_from_colors(colors, base_strength, scene=None): 
+    """
+    Reconcilia el rig de luces LightMood de la escena con la paleta: reutiliza los
+    objetos y datos de luz existentes cuyo tipo coincide, crea o elimina solo la
+    diferencia y libera los datablocks de luz huérfanos.
+    """
+    scene = scene or bpy.context.scene
+    existing_lights = get_light_rig_objects(scene)
+    num_lights_to_create = min(len(colors), len(LIGHT_RIG_TYPES))
 
     for i in range(num_lights_to_create):
         color = colors[i]
-        light_data = bpy.data.lights.new(name=f"LightMood_Light_{i}", type=light_types[i])
-        
-        light_data.energy = base_strength * ((color[0] + color[1] + color[2]) / 3.0) 
-        if light_data.energy < 0.1: light_data.energy = 0.1 
-        
-        light_data.color = color 
+        light_type = LIGHT_RIG_TYPES[i]
+        light_object = existing_lights.pop(i, None)
 
-        light_object = bpy.data.objects.new(name=f"LightMood_Light_Obj_{i}", object_data=light_data)
-        bpy.context.scene.collection.objects.link(light_object)
-        
-        if light_types[i] == 'POINT':
-            light_object.location = (i * 3 - 3, i * 3 - 3, 5) 
-        elif light_types[i] == 'AREA':
-            light_object.location = (i * 3 - 3, 0, 7)
-            light_object.rotation_euler = (np.radians(-90), 0, 0) 
+        if light_object is not None and light_object.data is not None and light_object.data.type == light_type:
+            light_data = light_object.data
+            action = "actualizada"
+        else:
+            light_data = bpy.data.lights.new(name=f"{LIGHT_DATA_PREFIX}{i}", type=light_type)
+            if light_object is not None:
+                # Mismo índice pero distinto tipo: se cambia el datablock del objeto
+                old_data = light_object.data
+                light_object.data = light_data
+                if old_data is not None and old_data.users == 0:
+                    bpy.data.lights.remove(old_data)
+            else:
+                light_object = bpy.data.objects.new(name=f"{LIGHT_OBJECT_PREFIX}{i}", object_data=light_data)
+                light_object[LIGHT_RIG_INDEX_PROPERTY] = i
+                scene.collection.objects.link(light_object)
+            action = "creada"
+
+        light_data.energy = light_energy_for_color(color, base_strength)
+        light_data.color = color 
+        if light_type == 'AREA':
             light_data.size = 2.0
-        elif light_types[i] == 'SUN':
-            light_object.location = (0, 0, 10) 
-            light_object.rotation_euler = (np.radians(45), np.radians(-30), 0) 
 
-        print(f"Luz {light_types[i]} creada con color: {color}, Energía: {light_data.energy}")
+        location, rotation = light_rig_transform(i, light_type)
+        light_object.location = location
+        light_object.rotation_euler = rotation
+
+        print(f"Luz {light_type} {action} con color: {color}, Energía: {light_data.energy}")
+
+    # Luces sobrantes de una paleta anterior más grande
+    for light_object in existing_lights.values():
+        remove_light_object(light_object)
+
+    purge_orphan_rig_lights()
+
+def rig_layout_transforms(layout, count, radius, height):
+    """
+    Posiciones y rotaciones (Euler XYZ) de `count` luces para una distribución:
+      - RING: anillo horizontal de radio `radius` a la altura `height`
+      - DOME: cúpula (hemisferio de Fibonacci) de radio `radius`
+      - GRID: rejilla en el techo a la altura `height`, apuntando hacia abajo
+    Las luces de RING y DOME apuntan al origen. Devuelve dos arrays (count, 3).
+    """
+    i = np.arange(count, dtype=np.float64)
+    if layout == 'RING':
+        angle = 2.0 * np.pi * i / count
+        positions = np.stack([radius * np.cos(angle), radius * np.sin(angle), np.full(count, height)], axis=1)
+    elif layout == 'DOME':
+        z = (i + 0.5) / count # Altura normalizada en (0, 1): solo el hemisferio superior
+        ring_radius = np.sqrt(1.0 - z * z)
+        angle = i * np.pi * (3.0 - np.sqrt(5.0)) # Ángulo áureo
+        positions = radius * np.stack([ring_radius * np.cos(angle), ring_radius * np.sin(angle), z], axis=1)
+    else: # GRID
+        side = int(np.ceil(np.sqrt(count)))
+        coords = np.linspace(-radius, radius, side) if side > 1 else np.zeros(1)
+        grid_x, grid_y = np.meshgrid(coords, coords)
+        positions = np.stack([grid_x.ravel()[:count], grid_y.ravel()[:count], np.full(count, height)], axis=1)
+        return positions, np.zeros((count, 3))
+
+    return positions, aim_at_origin_rotations(positions)
+
+def aim_at_origin_rotations(positions):
+    """Rotaciones (Euler XYZ) para que luces en `positions` apunten al origen."""
+    # Las luces emiten hacia -Z local; R = Rz(phi) * Rx(theta) lleva -Z a la dirección d
+    direction = -positions / np.maximum(np.linalg.norm(positions, axis=1, keepdims=True), 1e-9)
+    theta = np.arccos(np.clip(-direction[:, 2], -1.0, 1.0))
+    phi = np.arctan2(-direction[:, 0], direction[:, 1])
+    return np.stack([theta, np.zeros(len(positions)), phi], axis=1)
+
+def directional_light_transforms(scene, count, radius):
+    """
+    Una luz por celda del mosaico, en el lado de la cámara: la celda superior
+    izquierda de la referencia queda arriba a la izquierda vista desde la cámara.
+    Sin cámara se usa la vista frontal por defecto (mirando hacia +Y).
+    """
+    grid_size = int(round(np.sqrt(count)))
+    offsets = ((np.arange(grid_size) + 0.5) / grid_size * 2.0 - 1.0) * DIRECTIONAL_SPREAD
+    column_offsets, row_offsets = np.meshgrid(offsets, offsets)
+    # Espacio de la cámara: X a la derecha, Y hacia arriba, +Z hacia la cámara
+    local = np.stack([column_offsets.ravel(), -row_offsets.ravel(), np.ones(count)], axis=1)
+    local = radius * local / np.linalg.norm(local, axis=1, keepdims=True)
+    if scene.camera is not None:
+        camera_rotation = np.array(scene.camera.matrix_world.to_3x3(), dtype=np.float64)
+        camera_rotation /= np.maximum(np.linalg.norm(camera_rotation, axis=0, keepdims=True), 1e-9)
+    else:
+        camera_rotation = np.array([[1.0, 0.0, 0.0], [0.0, 0.0, -1.0], [0.0, 1.0, 0.0]])
+    positions = local @ camera_rotation.T
+    return positions, aim_at_origin_rotations(positions)
+
+def allocate_lights_to_colors(weights, count):
+    """
+    Reparte `count` luces entre los colores de forma proporcional a sus pesos
+    (resto mayor) e intercala los colores para que se distribuyan por todo el rig.
+    Devuelve (índice de color por luz, número de luces por color).
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    weights = weights / weights.sum() if weights.sum() > 0 else np.full(len(weights), 1.0 / len(weights))
+    quotas = weights * count
+    lights_per_color = np.floor(quotas).astype(int)
+    remainder = count - lights_per_color.sum()
+    lights_per_color[np.argsort(quotas - lights_per_color)[::-1][:remainder]] += 1
+
+    color_index = np.repeat(np.arange(len(weights)), lights_per_color)
+    # Posición relativa de cada luz dentro de su color, para intercalarlas
+    slot = np.concatenate([(np.arange(n) + 0.5) / n for n in lights_per_color if n > 0])
+    return color_index[np.argsort(slot, kind='stable')], lights_per_color
+
+def get_procedural_rig_collection(scene, create=False):
+    for collection in scene.collection.children:
+        if collection.get(RIG_COLLECTION_PROPERTY):
+            return collection
+    if not create:
+        return None
+    collection = bpy.data.collections.new(RIG_COLLECTION_NAME)
+    collection[RIG_COLLECTION_PROPERTY] = True
+    scene.collection.children.link(collection)
+    return collection
+
+def remove_procedural_light_rig(scene):
+    """Elimina el rig procedural de la escena (objetos, colección y datos huérfanos)."""
+    collection = get_procedural_rig_collection(scene)
+    if collection is None:
+        return
+    bpy.data.batch_remove(list(collection.objects) + [collection])
+    purge_orphan_rig_lights()
+
+def procedural_rig_light_data(collection):
+    """Datos de luz compartidos del rig, indexados por color de la paleta."""
+    light_data = {}
+    for obj in collection.objects:
+        if obj.data is not None and RIG_COLOR_INDEX_PROPERTY in obj.data:
+            light_data[int(obj.data[RIG_COLOR_INDEX_PROPERTY])] = obj.data
+    return light_data
+
+def set_procedural_rig_light_data(light_data, colors, weights, lights_per_color, base_strength):
+    """Color y energía de cada dato de luz: la energía total de cada color es proporcional a su peso."""
+    total_energy = base_strength * RIG_TOTAL_ENERGY_SCALE
+    weight_sum = sum(weights) or 1.0
+    for color_index, data in light_data.items():
+        data.color = colors[color_index]
+        data.energy = max(total_energy * (weights[color_index] / weight_sum) / max(int(lights_per_color[color_index]), 1), 0.1)
+
+def build_procedural_light_rig(scene, colors, weights, base_strength, layout, count, radius, height, light_type='POINT'):
+    """
+    Genera (o actualiza) un rig de `count` luces en la distribución `layout`. Se crea un
+    único dato de luz por color de la paleta, compartido por todas sus luces, y las
+    transformaciones se escriben en bloque con foreach_set.
+    """
+    if not colors:
+        remove_procedural_light_rig(scene)
+        return
+    start_time = time.perf_counter()
+    collection = get_procedural_rig_collection(scene, create=True)
+    if layout == 'DIRECTIONAL':
+        # Una luz por celda del mosaico, cada una con su propio color
+        color_of_light, lights_per_color = np.arange(count), np.ones(count, dtype=int)
+    else:
+        color_of_light, lights_per_color = allocate_lights_to_colors(weights, count)
+
+    # Un dato de luz por color con luces asignadas, reutilizando los existentes si el tipo coincide
+    existing_data = procedural_rig_light_data(collection)
+    light_data = {}
+    for color_index in np.flatnonzero(lights_per_color).tolist():
+        data = existing_data.get(color_index)
+        if data is None or data.type != light_type:
+            data = bpy.data.lights.new(name=f"{LIGHT_DATA_PREFIX}Rig_{color_index}", type=light_type)
+            data[RIG_COLOR_INDEX_PROPERTY] = color_index
+        light_data[color_index] = data
+    set_procedural_rig_light_data(light_data, colors, weights, lights_per_color, base_strength)
+
+    # Objetos: se reutilizan si el número coincide; si no, se recrean en bloque
+    rig_objects = list(collection.objects)
+    if len(rig_objects) != count:
+        if rig_objects:
+            bpy.data.batch_remove(rig_objects)
+        rig_objects = []
+        for i in range(count):
+            obj = bpy.data.objects.new(f"{RIG_LIGHT_OBJECT_PREFIX}{i}", light_data[int(color_of_light[i])])
+            obj[RIG_LIGHT_INDEX_PROPERTY] = i
+            collection.objects.link(obj)
+    else:
+        for obj in rig_objects:
+            obj.data = light_data[int(color_of_light[int(obj[RIG_LIGHT_INDEX_PROPERTY])])]
+
+    # Transformaciones en bloque, en el orden de collection.objects
+    if layout == 'DIRECTIONAL':
+        positions, rotations = directional_light_transforms(scene, count, radius)
+    else:
+        positions, rotations = rig_layout_transforms(layout, count, radius, height)
+    order = np.array([obj[RIG_LIGHT_INDEX_PROPERTY] for obj in collection.objects], dtype=np.int64)
+    collection.objects.foreach_set("location", positions[order].astype(np.float32).ravel())
+    collection.objects.foreach_set("rotation_euler", rotations[order].astype(np.float32).ravel())
+
+    purge_orphan_rig_lights()
+    print(f"Rig procedural {layout} de {count} luces ({len(light_data)} datos de luz compartidos) "
+          f"generado en {time.perf_counter() - start_time:.3f} s")
+
+def update_procedural_rig_lights(scene, colors, weights, base_strength):
+    """
+    Actualiza solo el color y la energía de los datos de luz compartidos del rig
+    procedural. Devuelve False si el rig no existe o no coincide con la paleta.
+    """
+    collection = get_procedural_rig_collection(scene)
+    if collection is None or len(collection.objects) != scene.lightmood_rig_light_count:
+        return False
+    _, lights_per_color = allocate_lights_to_colors(weights, len(collection.objects))
+    light_data = procedural_rig_light_data(collection)
+    if sorted(light_data) != np.flatnonzero(lights_per_color).tolist():
+        return False
+    set_procedural_rig_light_data(light_data, colors, weights, lights_per_color, base_strength)
+    return True
+
+def luminosity_levels(avg_luminosity, luminosity_stats=None):
+    """
+    Niveles de luminosidad (luces, fondo) de una clase. Con el contraste
+    principal/relleno de su distribución, las luces suben y el fondo baja en la
+    misma proporción; sin él, ambos son la luminosidad promedio.
+    """
+    key_fill_ratio = (luminosity_stats or {}).get("key_fill_ratio")
+    if not key_fill_ratio:
+        return avg_luminosity, avg_luminosity
+    balance = min(max(float(key_fill_ratio), 1.0), LUMINOSITY_MAX_KEY_FILL_RATIO) ** LUMINOSITY_CONTRAST_EXPONENT
+    return avg_luminosity * balance, avg_luminosity / balance
+
+def compute_scene_lighting(colors_for_scene, current_index, avg_luminosity, luminosity_stats=None):
+    """
+    Calcula los parámetros de iluminación para un color de fondo de la paleta:
+    (color de fondo, fuerza del fondo, colores de las luces, energía base de las luces).
+    """
+    light_luminosity, world_luminosity = luminosity_levels(avg_luminosity, luminosity_stats)
+    world_strength = world_luminosity * WORLD_BACKGROUND_STRENGTH_MULTIPLIER
+    if world_strength < 0.01: world_strength = 0.01 
+
+    light_base_strength = light_luminosity * LIGHT_STRENGTH_MULTIPLIER
+    if light_base_strength < 10: light_base_strength = 10 
+    
+    # Usar el color del índice seleccionado para el World Shader
+    world_bg_color = [0.8, 0.8, 0.8] # Gris claro por defecto
+    if current_index < len(colors_for_scene):
+        world_bg_color = colors_for_scene[current_index]
+    else: 
+        print(f"Advertencia: El índice de color seleccionado ({current_index}) está fuera de rango para la paleta actual de {len(colors_for_scene)} colores. Usando el primer color o gris por defecto.", file=sys.stderr)
+        if colors_for_scene: world_bg_color = colors_for_scene[0] # Fallback al primer color
+
+    # Lógica para las luces: excluir el color usado para el fondo
+    lights_colors_list = exclude_world_color(colors_for_scene, current_index)
+
+    return world_bg_color, world_strength, lights_colors_list, light_base_strength
+
+def exclude_world_color(items, current_index):
+    """Elementos de la paleta para las luces: todos menos el del fondo (o todos si no queda ninguno)."""
+    lights_items = [c for i, c in enumerate(items) if i != current_index]
+    if not lights_items and items: 
+        lights_items = list(items) 
+    return lights_items
+
+def palette_weights_for_scene(scene, colors_for_scene):
+    """Pesos de la paleta de la clase actual de la escena (uniformes si no están disponibles)."""
+    class_data = (CLASS_PALETTES_AND_LUMINOSITY or {}).get(scene.lightmood_last_predicted_class_name)
+    if class_data is not None and len(class_data.get("weights", [])) == len(colors_for_scene):
+        return list(class_data["weights"])
+    return [1.0 / max(len(colors_for_scene), 1)] * len(colors_for_scene)
+
+def luminosity_stats_for_scene(scene):
+    """Estadísticas de luminosidad de la clase actual de la escena (None si no están disponibles)."""
+    class_data = (CLASS_PALETTES_AND_LUMINOSITY or {}).get(scene.lightmood_last_predicted_class_name)
+    return class_data.get("luminosity_stats") if class_data is not None else None
+
+def apply_scene_lighting(scene, colors_for_scene, current_index, avg_luminosity, weights=None):
+    """Aplica el fondo del mundo y el rig de luces completo (clásico o procedural) a una escena."""
+    world_bg_color, world_strength, lights_colors_list, light_base_strength = compute_scene_lighting(
+        colors_for_scene, current_index, avg_luminosity, luminosity_stats_for_scene(scene))
+    with timed_step("Escena: fondo del mundo"):
+        set_world_background_color(world_bg_color, world_strength, scene=scene) 
+
+    directional = get_directional_lighting(scene) if scene.lightmood_rig_layout == 'DIRECTIONAL' else None
+    with timed_step("Escena: luces"):
+        if directional is not None:
+            setup_lights_from_colors([], light_base_strength, scene=scene) # Quita el rig clásico
+            build_procedural_light_rig(scene, directional["tile_colors"], directional["tile_weights"],
+                                       light_base_strength, 'DIRECTIONAL', len(directional["tile_colors"]),
+                                       scene.lightmood_rig_radius, scene.lightmood_rig_height,
+                                       scene.lightmood_rig_light_type)
+        elif scene.lightmood_rig_layout in ('CLASSIC', 'DIRECTIONAL'):
+            remove_procedural_light_rig(scene)
+            setup_lights_from_colors(lights_colors_list, light_base_strength, scene=scene) 
+        else:
+            setup_lights_from_colors([], light_base_strength, scene=scene) # Quita el rig clásico
+            if weights is None:
+                weights = palette_weights_for_scene(scene, colors_for_scene)
+            build_procedural_light_rig(scene, lights_colors_list, exclude_world_color(weights, current_index),
+                                       light_base_strength, scene.lightmood_rig_layout,
+                                       scene.lightmood_rig_light_count, scene.lightmood_rig_radius,
+                                       scene.lightmood_rig_height, scene.lightmood_rig_light_type)
+
+def update_lighting_preview(scene, color_index=None):
+    """
+    Ruta ligera para la previsualización al recorrer la paleta: solo cambia en el
+    sitio el color/fuerza del nodo Background y el color/energía de las luces,
+    sin pasar por un operador ni añadir pasos de deshacer. Si el mundo o el rig
+    aún no existen (o no coinciden), recurre a la aplicación completa.
+    color_index permite previsualizar otro color sin cambiar la selección.
+    """
+    sync_scene_palette(scene)
+    current_index_str = scene.lightmood_world_color_enum if color_index is None else str(color_index)
+    if not LAST_PREDICTED_CLASS_COLORS or not current_index_str:
+        return
+    world_bg_color, world_strength, lights_colors_list, light_base_strength = compute_scene_lighting(
+        LAST_PREDICTED_CLASS_COLORS, int(current_index_str), scene.lightmood_avg_luminosity,
+        luminosity_stats_for_scene(scene))
+
+    world = scene.world
+    background_node = world.node_tree.nodes.get(WORLD_BACKGROUND_NODE_NAME) if world and world.use_nodes else None
+    if background_node is not None:
+        background_node.inputs['Color'].default_value = list(world_bg_color) + [1.0]
+        background_node.inputs['Strength'].default_value = world_strength
+    else:
+        set_world_background_color(world_bg_color, world_strength, scene=scene)
+
+    if scene.lightmood_rig_layout == 'DIRECTIONAL':
+        # Las luces direccionales no dependen del color de fondo elegido
+        if get_procedural_rig_collection(scene) is None and not get_light_rig_objects(scene):
+            apply_scene_lighting(scene, LAST_PREDICTED_CLASS_COLORS, int(current_index_str), scene.lightmood_avg_luminosity)
+        return
+
+    if scene.lightmood_rig_layout != 'CLASSIC':
+        light_weights = exclude_world_color(palette_weights_for_scene(scene, LAST_PREDICTED_CLASS_COLORS), int(current_index_str))
+        if not update_procedural_rig_lights(scene, lights_colors_list, light_weights, light_base_strength):
+            apply_scene_lighting(scene, LAST_PREDICTED_CLASS_COLORS, int(current_index_str), scene.lightmood_avg_luminosity)
+        return
+
+    num_lights = min(len(lights_colors_list), len(LIGHT_RIG_TYPES))
+    rig_objects = get_light_rig_objects(scene)
+    rig_matches = (sorted(rig_objects) == list(range(num_lights)) and
+                   all(rig_objects[i].data is not None and rig_objects[i].data.type == LIGHT_RIG_TYPES[i]
+                       for i in range(num_lights)))
+    if not rig_matches:
+        setup_lights_from_colors(lights_colors_list, light_base_strength, scene=scene)
+        return
+    for i in range(num_lights):
+        color = lights_colors_list[i]
+        light_data = rig_objects[i].data
+        light_data.color = color
+        light_data.energy = light_energy_for_color(color, light_base_strength)
+
+def classify_images_lighting_via_external_script(image_paths):
+    """
+    Clasifica varias imágenes con una sola ejecución del script externo (un solo
+    arranque de TensorFlow y un único lote de predicción). Devuelve {ruta: clase};
+    las imágenes que fallan no aparecen en el resultado.
+    """
+    if not image_paths or not check_external_script_paths():
+        return {}
+    list_file = tempfile.NamedTemporaryFile('w', suffix=".txt", delete=False, encoding='utf-8')
+    try:
+        with list_file:
+            list_file.write("\n".join(image_paths))
+        start_time = time.perf_counter()
+        process = subprocess.run(
+            [PYTHON_EXECUTABLE_PATH, PREDICTION_SCRIPT_PATH, "--batch-file", list_file.name],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        predictor_timings, stderr = split_predictor_timings(process.stderr)
+        record_external_script_timings(time.perf_counter() - start_time, predictor_timings)
+        if stderr:
+            print(f"Output STDERR from external script: {stderr}", file=sys.stderr)
+        predictions = json.loads(process.stdout.strip().splitlines()[-1])
+    except subprocess.CalledProcessError as e:
+        print(f"Error al ejecutar el script externo en modo lote: {e}", file=sys.stderr)
+        print(f"STDERR: {e.stderr}", file=sys.stderr)
+        return {}
+    except Exception as e:
+        print(f"Error general al llamar al script externo en modo lote: {e}", file=sys.stderr)
+        return {}
+    finally:
+        os.remove(list_file.name)
+    return {path: class_name for path, class_name in predictions.items() if class_name != "ERROR_PREDICTING_IMAGE"}
+
+def classify_images_lighting(image_paths):
+    """
+    Clasifica un conjunto de imágenes: primero con el clasificador rápido y, para
+    las de baja confianza, con el modelo CNN en NumPy o, si no está exportado,
+    con una sola llamada por lotes al modelo externo.
+    Devuelve {ruta: (clase, origen, confianza)}.
+    """
+    results = {}
+    pending_paths = []
+    for image_path in image_paths:
+        if FAST_CLASSIFIER_ENABLED:
+            fast_class, fast_confidence = classify_image_lighting_fast(image_path)
+            if fast_class is not None and fast_confidence >= FAST_CLASSIFIER_CONFIDENCE_THRESHOLD:
+                results[image_path] = (fast_class, "FAST", fast_confidence)
+                continue
+        pending_paths.append(image_path)
+
+    for image_path, (class_name, confidence) in classify_images_lighting_numpy(pending_paths).items():
+        results[image_path] = (class_name, "NUMPY", confidence)
+    pending_paths = [image_path for image_path in pending_paths if image_path not in results]
+
+    for image_path, class_name in classify_images_lighting_via_external_script(pending_paths).items():
+        results[image_path] = (class_name, "EXTERNAL", 0.0)
+    return results
+
+def read_shot_list(shot_list_path):
+    """
+    Lee una lista de planos que asocia escenas con imágenes de referencia. Formatos:
+      - JSON: {"escena": "imagen.png", ...} o [{"scene": ..., "image": ..., "color_index": 0}, ...]
+      - CSV/texto: una línea "escena,imagen[,color_index]" por plano
+    Las rutas relativas se resuelven respecto a la carpeta de la lista.
+    Devuelve una lista de (escena, ruta de imagen, índice de color o None).
+    """
+    base_dir = os.path.dirname(os.path.abspath(shot_list_path))
+    shots = []
+    if shot_list_path.lower().endswith(".json"):
+        with open(shot_list_path, 'r', encoding='utf-8') as f:
+            raw_shots = json.load(f)
+        if isinstance(raw_shots, dict):
+            raw_shots = [{"scene": scene_name, "image": image} for scene_name, image in raw_shots.items()]
+        for shot in raw_shots:
+            shots.append((shot["scene"], shot["image"], shot.get("color_index")))
+    else:
+        with open(shot_list_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = [field.strip() for field in line.split(",")]
+                if len(fields) < 2 or not fields[0] or fields[0].startswith("#"):
+                    continue
+                color_index = int(fields[2]) if len(fields) > 2 and fields[2] else None
+                shots.append((fields[0], fields[1], color_index))
+    return [(scene_name, os.path.join(base_dir, image) if not os.path.isabs(image) else image, color_index)
+            for scene_name, image, color_index in shots]
+
+def apply_shot_list(shot_list_path, color_index=0):
+    """
+    Aplica la iluminación LightMood a todas las escenas de una lista de planos:
+    clasifica todas las imágenes en un solo lote y aplica el fondo y las luces a
+    cada escena directamente, sin cambiar la escena activa.
+    Devuelve una lista de dicts con el estado de cada plano.
+    """
+    return apply_shots(read_shot_list(shot_list_path), color_index)
+
+def apply_shots(shots, color_index=0, known_classes=None):
+    """
+    Aplica la iluminación a una lista de (escena, imagen, índice de color o None).
+    known_classes permite pasar clases ya calculadas {imagen: clase} (p. ej. por el
+    clasificador compartido de lightmoodgranja.py) para no clasificar de nuevo.
+    """
+    if get_class_palettes() is None:
+        raise RuntimeError("No se pudieron cargar las paletas de colores de LightMood.")
+
+    report = []
+    valid_shots = []
+    for scene_name, image_path, shot_color_index in shots:
+        if bpy.data.scenes.get(scene_name) is None:
+            report.append({"scene": scene_name, "image": image_path, "status": "ERROR", "message": "Escena no encontrada"})
+        elif not os.path.exists(image_path):
+            report.append({"scene": scene_name, "image": image_path, "status": "ERROR", "message": "Imagen no encontrada"})
+        else:
+            valid_shots.append((scene_name, image_path, shot_color_index))
+
+    # Reutilizar las clases conocidas y la caché de cada escena, y clasificar el resto de imágenes de una vez
+    classifications = {image_path: (class_name, "EXTERNAL", 0.0) for image_path, class_name in (known_classes or {}).items()}
+    for scene_name, image_path, _ in valid_shots:
+        if image_path in classifications:
+            continue
+        cached_entry = find_cached_classification(bpy.data.scenes[scene_name], image_path)
+        if cached_entry is not None and cached_entry.class_name in CLASS_PALETTES_AND_LUMINOSITY:
+            classifications[image_path] = (cached_entry.class_name, cached_entry.prediction_source,
+                                           cached_entry.prediction_confidence)
+    pending_images = sorted({image_path for _, image_path, _ in valid_shots if image_path not in classifications})
+    classifications.update(classify_images_lighting(pending_images))
+
+    active_scene = bpy.context.scene
+    for scene_name, image_path, shot_color_index in valid_shots:
+        scene = bpy.data.scenes[scene_name]
+        class_name, source, confidence = classifications.get(image_path, (None, "", 0.0))
+        if class_name not in CLASS_PALETTES_AND_LUMINOSITY:
+            report.append({"scene": scene_name, "image": image_path, "status": "ERROR",
+                           "message": f"Sin clasificación o sin paleta para la clase '{class_name}'"})
+            continue
+
+        class_data = CLASS_PALETTES_AND_LUMINOSITY[class_name]
+        index = color_index if shot_color_index is None else shot_color_index
+        scene.lightmood_image_path = image_path
+        store_scene_classification(scene, class_name, class_data["colors"], class_data["avg_luminosity"], source, confidence)
+        store_cached_classification(scene, image_path)
+        apply_scene_lighting(scene, class_data["colors"], index, class_data["avg_luminosity"], weights=class_data["weights"])
+        report.append({"scene": scene_name, "image": image_path, "status": "OK", "class": class_name, "source": source})
+        print(f"Plano '{scene_name}': clase '{class_name}' ({source}) aplicada desde {image_path}")
+
+    if active_scene is not None:
+        restore_scene_palette(active_scene)
+    return report
+
+def node_tree_signature(node_tree, skip_node_name=None):
+    """
+    Firma barata de un árbol de nodos (material o mundo): tipo de cada nodo,
+    imagen asignada, valores de las entradas sin conectar y enlaces. Las entradas
+    de skip_node_name no se incluyen (el addon las cambia al previsualizar).
+    """
+    if node_tree is None:
+        return ""
+    parts = []
+    for node in node_tree.nodes:
+        image = getattr(node, "image", None)
+        parts.append(f"{node.name}:{node.bl_idname}:{image.filepath if image is not None else ''}")
+        if node.name == skip_node_name:
+            continue
+        for socket in node.inputs:
+            if socket.is_linked or not hasattr(socket, "default_value"):
+                continue
+            value = socket.default_value
+            if hasattr(value, "__len__") and not isinstance(value, str):
+                value = tuple(value)
+            parts.append(f"{socket.identifier}={value}")
+    for link in node_tree.links:
+        parts.append(f"{link.from_node.name}.{link.from_socket.identifier}>{link.to_node.name}.{link.to_socket.identifier}")
+    return "|".join(parts)
+
+def is_lightmood_rig_light(obj, rig_collection=None):
+    """True si el objeto es una luz del rig clásico o del rig procedural de LightMood."""
+    if obj.type != 'LIGHT':
+        return False
+    if LIGHT_RIG_INDEX_PROPERTY in obj or RIG_LIGHT_INDEX_PROPERTY in obj:
+        return True
+    if obj.name.startswith(LIGHT_OBJECT_PREFIX) and obj.name[len(LIGHT_OBJECT_PREFIX):].isdigit():
+        return True
+    return rig_collection is not None and obj.name in rig_collection.objects
+
+def palette_preview_key(scene, depsgraph=None):
+    """
+    Clave de caché de las miniaturas: paleta de la escena, ajustes del rig,
+    cámara, gestión de color, mundo (salvo el color y la fuerza del fondo, que
+    pone el addon), las luces del usuario (transformación, tipo, color y
+    energía) y, por cada objeto visible, su transformación, modificadores,
+    materiales y una firma de la malla evaluada (número de vértices y caras y
+    caja envolvente). Las luces del rig no cuentan: dependen del color
+    previsualizado. No se recorren los vértices: una edición que no cambie nada
+    de eso requiere "Forzar Re-render".
+    """
+    depsgraph = depsgraph if depsgraph is not None else bpy.context.evaluated_depsgraph_get()
+    digest = hashlib.sha1()
+    digest.update(f"{bpy.data.filepath}|{scene.name}|{scene.lightmood_palette_json}".encode('utf-8'))
+    # La fuerza de luces y fondo depende de la distribución de luminosidad de la clase
+    light_luminosity, world_luminosity = luminosity_levels(scene.lightmood_avg_luminosity, luminosity_stats_for_scene(scene))
+    digest.update(f"{light_luminosity:.6f}|{world_luminosity:.6f}".encode('utf-8'))
+    digest.update(f"{scene.lightmood_rig_layout}|{scene.lightmood_rig_light_count}|{scene.lightmood_rig_radius}|"
+                  f"{scene.lightmood_rig_height}|{scene.lightmood_rig_light_type}|{scene.lightmood_directional_json}".encode('utf-8'))
+    view_settings = scene.view_settings
+    digest.update(f"{view_settings.view_transform}|{view_settings.look}|{view_settings.exposure}|"
+                  f"{view_settings.gamma}|{scene.render.film_transparent}".encode('utf-8'))
+    if scene.world is not None:
+        world_nodes = scene.world.node_tree if scene.world.use_nodes else None
+        digest.update(f"{scene.world.name}|{node_tree_signature(world_nodes, WORLD_BACKGROUND_NODE_NAME)}".encode('utf-8'))
+    if scene.camera is not None:
+        digest.update(np.array(scene.camera.matrix_world, dtype=np.float32).tobytes())
+        if scene.camera.type == 'CAMERA':
+            camera = scene.camera.data
+            digest.update(f"{camera.type}|{camera.lens}|{camera.ortho_scale}|{camera.shift_x}|{camera.shift_y}".encode('utf-8'))
+
+    materials = {}
+    rig_collection = get_procedural_rig_collection(scene)
+    for obj in sorted(scene.objects, key=lambda obj: obj.name):
+        if obj.hide_render or is_lightmood_rig_light(obj, rig_collection):
+            continue
+        data_name = obj.data.name if obj.data is not None else ""
+        digest.update(f"{obj.name}|{data_name}".encode('utf-8'))
+        digest.update(np.array(obj.matrix_world, dtype=np.float32).tobytes())
+        if obj.type == 'LIGHT':
+            light = obj.data
+            digest.update(f"{light.type}|{tuple(light.color)}|{light.energy}".encode('utf-8'))
+            continue
+        digest.update("|".join(f"{modifier.name}:{modifier.type}:{modifier.show_render}"
+                               for modifier in obj.modifiers).encode('utf-8'))
+        slot_materials = [slot.material for slot in obj.material_slots]
+        digest.update("|".join(material.name if material is not None else "" for material in slot_materials).encode('utf-8'))
+        materials.update((material.name, material) for material in slot_materials if material is not None)
+        if obj.type == 'MESH':
+            evaluated = obj.evaluated_get(depsgraph)
+            mesh = evaluated.data
+            digest.update(f"{len(mesh.vertices)}|{len(mesh.polygons)}".encode('utf-8'))
+            digest.update(np.array([tuple(corner) for corner in evaluated.bound_box], dtype=np.float32).tobytes())
+    # Cada material se firma una sola vez aunque lo compartan varios objetos
+    for name in sorted(materials):
+        material = materials[name]
+        node_tree = material.node_tree if material.use_nodes else None
+        digest.update(f"{name}|{tuple(material.diffuse_color)}|{node_tree_signature(node_tree)}".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def current_palette_preview_key(scene, depsgraph):
+    """Clave de las miniaturas para el estado actual de la escena; solo se recalcula tras un cambio."""
+    key = PALETTE_PREVIEW_CURRENT_KEYS.get(scene.name)
+    if key is None:
+        key = palette_preview_key(scene, depsgraph)
+        PALETTE_PREVIEW_CURRENT_KEYS[scene.name] = key
+    return key
+
+@bpy.app.handlers.persistent
+def invalidate_palette_preview_key(scene, depsgraph=None):
+    """Cualquier cambio en la escena obliga a recalcular su clave en el próximo dibujado del panel."""
+    PALETTE_PREVIEW_CURRENT_KEYS.pop(scene.name, None)
+
+def palette_preview_path(key, color_index):
+    return os.path.join(PALETTE_PREVIEW_DIR, f"{key}_{color_index}.png")
+
+def get_palette_preview_icons(key, count):
+    """Iconos de las miniaturas en caché (se cargan desde disco la primera vez). None si falta alguna."""
+    if PALETTE_PREVIEW_COLLECTION is None or not key:
+        return None
+    icons = []
+    for color_index in range(count):
+        name = f"{key}_{color_index}"
+        preview = PALETTE_PREVIEW_COLLECTION.get(name)
+        if preview is None:
+            path = palette_preview_path(key, color_index)
+            if not os.path.exists(path):
+                return None
+            preview = PALETTE_PREVIEW_COLLECTION.load(name, path, 'IMAGE')
+        icons.append(preview.icon_id)
+    return icons
+
+def eevee_engine_identifier(scene):
+    """Identificador de EEVEE según la versión de Blender (BLENDER_EEVEE o BLENDER_EEVEE_NEXT)."""
+    engines = {item.identifier for item in scene.render.bl_rna.properties['engine'].enum_items}
+    return next((engine for engine in ("BLENDER_EEVEE_NEXT", "BLENDER_EEVEE") if engine in engines), scene.render.engine)
+
+def render_palette_previews(scene, key, window_manager=None):
+    """
+    Renderiza en un solo lote una miniatura por color de la paleta. La escena se
+    reutiliza: entre renders solo cambian en el sitio el fondo del mundo y las
+    luces (update_lighting_preview). Los ajustes de render se restauran al final.
+    """
+    render = scene.render
+    saved_settings = {
+        "engine": render.engine, "resolution_x": render.resolution_x, "resolution_y": render.resolution_y,
+        "resolution_percentage": render.resolution_percentage, "filepath": render.filepath,
+        "use_file_extension": render.use_file_extension, "use_compositing": render.use_compositing,
+        "use_sequencer": render.use_sequencer, "file_format": render.image_settings.file_format,
+    }
+    saved_samples = scene.eevee.taa_render_samples
+    aspect = (render.resolution_x * render.pixel_aspect_x) / max(render.resolution_y * render.pixel_aspect_y, 1e-6)
+    os.makedirs(PALETTE_PREVIEW_DIR, exist_ok=True)
+    try:
+        render.engine = eevee_engine_identifier(scene)
+        render.resolution_x = PALETTE_PREVIEW_MAX_SIDE if aspect >= 1.0 else max(int(PALETTE_PREVIEW_MAX_SIDE * aspect), 1)
+        render.resolution_y = PALETTE_PREVIEW_MAX_SIDE if aspect < 1.0 else max(int(PALETTE_PREVIEW_MAX_SIDE / aspect), 1)
+        render.resolution_percentage = 100
+        render.use_file_extension = False
+        render.use_compositing = False
+        render.use_sequencer = False
+        render.image_settings.file_format = 'PNG'
+        scene.eevee.taa_render_samples = PALETTE_PREVIEW_SAMPLES
+
+        if window_manager is not None:
+            window_manager.progress_begin(0, len(LAST_PREDICTED_CLASS_COLORS))
+        for color_index in range(len(LAST_PREDICTED_CLASS_COLORS)):
+            with timed_step("Miniaturas: escena"):
+                update_lighting_preview(scene, color_index=color_index)
+            with timed_step("Miniaturas: render"):
+                render.filepath = palette_preview_path(key, color_index)
+                bpy.ops.render.render(write_still=True, scene=scene.name)
+            if window_manager is not None:
+                window_manager.progress_update(color_index + 1)
+    finally:
+        for attribute, value in saved_settings.items():
+            if attribute == "file_format":
+                render.image_settings.file_format = value
+            else:
+                setattr(render, attribute, value)
+        scene.eevee.taa_render_samples = saved_samples
+        update_lighting_preview(scene) # Volver al color seleccionado
+        if window_manager is not None:
+            window_manager.progress_end()
+
+def on_world_color_enum_changed(self, context):
+    # Previsualización inmediata; el botón "Aplicar Iluminación Ahora" confirma con un paso de deshacer
+    update_lighting_preview(self)
 
 # --- 5. CLASES DE OPERADORES DE BLENDER ---
 
 class LightMoodLoadResources(bpy.types.Operator):
-    """Operador para cargar las paletas de colores de clase."""
+    """Fuerza la recarga de las paletas de colores de clase (normalmente se cargan solas)."""
     bl_idname = "scene.light_mood_load_resources"
-    bl_label = "Cargar Paletas de Colores de Iluminación"
-    bl_options = {'REGISTER', 'UNDO'}
+    bl_label = "Recargar Paletas de Colores de Iluminación"
+    bl_options = {'REGISTER'}
 
     def execute(self, context):
-        if load_class_palettes(CLASS_PALETTES_FILE):
+        timing = begin_operation_timing("Recargar paletas")
+        class_palettes = get_class_palettes(force_reload=True)
+        finish_operation_timing(timing, status="OK" if class_palettes is not None else "ERROR")
+        if class_palettes is not None:
             self.report({'INFO'}, "Paletas de colores de LightMood cargadas exitosamente!")
             return {'FINISHED'}
         else:
@@ -175,6 +2058,13 @@ class LightMoodSelectImage(bpy.types.Operator):
 
     def execute(self, context):
         context.scene.lightmood_image_path = self.filepath
+        # Si la imagen ya se clasificó antes, se restaura su resultado al instante
+        # (las paletas se cargan antes para que las estadísticas de luminosidad estén disponibles)
+        cached_entry = find_cached_classification(context.scene, self.filepath)
+        if cached_entry is not None and cached_entry.class_name in (get_class_palettes() or {}):
+            restore_cached_classification(context.scene, cached_entry)
+            self.report({'INFO'}, f"Imagen seleccionada: {self.filepath} (clasificación en caché: '{cached_entry.class_name}')")
+            return {'FINISHED'}
         self.report({'INFO'}, f"Imagen seleccionada: {self.filepath}")
         return {'FINISHED'}
 
@@ -190,65 +2080,88 @@ class LightMoodGeneratePrediction(bpy.types.Operator):
     bl_options = {'REGISTER', 'UNDO'}
 
     def execute(self, context):
-        global LAST_PREDICTED_CLASS_COLORS # Acceder a la variable global
-        global LAST_PREDICTED_COLOR_ENUM_ITEMS # Acceder a la variable global para el EnumProperty
-
+        timing = begin_operation_timing("Clasificar imagen")
+        result = self.classify_image(context)
+        # Si quedó una clasificación en segundo plano, la medición se cierra al terminar esta
+        if CLASSIFICATION_JOB is None or CLASSIFICATION_JOB["timing"] is not timing:
+            finish_operation_timing(timing, status="OK" if result == {'FINISHED'} else "ERROR")
+        return result
+
+    def classify_image(self, context):
         image_path = context.scene.lightmood_image_path 
 
         print(f"DEBUG_BLENDER: image_path recibido: '{image_path}'")
-        print(f"DEBUG_BLENDER: ¿Existe la ruta? {os.path.exists(image_path)}")
-
-        if CLASS_PALETTES_AND_LUMINOSITY is None: 
-            self.report({'ERROR'}, "Por favor, carga las paletas de colores primero usando 'Cargar Paletas de Colores de Iluminación'.")
+        with timed_step("Validación de imagen"):
+            image_exists = bool(image_path) and os.path.exists(image_path)
+        print(f"DEBUG_BLENDER: ¿Existe la ruta? {image_exists}")
+
+        # Carga perezosa: solo lee el archivo la primera vez o si cambió en disco.
+        # Va antes de la caché para que una entrada restaurada tenga sus estadísticas de luminosidad
+        if get_class_palettes() is None: 
+            self.report({'ERROR'}, f"No se pudieron cargar las paletas de colores desde '{resolve_class_palettes_path()}'. Revisa la consola de sistema.")
             return {'CANCELLED'}
 
-        if not image_path or not os.path.exists(image_path):
+        # Una imagen ya clasificada (misma imagen, paletas y modelo) se restaura sin subproceso
+        with timed_step("Caché de clasificaciones"):
+            cached_entry = find_cached_classification(context.scene, image_path) if image_exists else None
+        if cached_entry is not None and cached_entry.class_name in CLASS_PALETTES_AND_LUMINOSITY:
+            cancel_background_classification()
+            restore_cached_classification(context.scene, cached_entry)
+            self.report({'INFO'}, f"Imagen clasificada como '{cached_entry.class_name}' (desde la caché). Paleta de colores lista para selección en Paso 4.")
+            return {'FINISHED'}
+
+        if not image_exists:
             self.report({'ERROR'}, "Por favor, selecciona una imagen válida usando el botón 'Seleccionar Imagen de Entrada'.")
             return {'CANCELLED'}
 
-        print(f"DEBUG_BLENDER: Solicitando clasificación externa para: {image_path}")
-        predicted_lighting_class = classify_image_lighting_via_external_script(image_path)
-        print(f"DEBUG_BLENDER: Clase predicha recibida: '{predicted_lighting_class}'") 
-
-        if predicted_lighting_class is None or predicted_lighting_class == "EXTERNAL_SCRIPT_ERROR":
-            self.report({'ERROR'}, f"Fallo al obtener la clasificación del script externo. Revisa la consola de sistema (Window > Toggle System Console) para errores detallados.")
-            return {'CANCELLED'}
+        # Una nueva solicitud reemplaza a la clasificación en segundo plano anterior
+        cancel_background_classification()
+
+        if FAST_CLASSIFIER_ENABLED:
+            fast_class, fast_confidence = classify_image_lighting_fast(image_path)
+            if fast_class is not None and fast_confidence >= FAST_CLASSIFIER_CONFIDENCE_THRESHOLD:
+                error_message = apply_predicted_class(context.scene, fast_class, "FAST", fast_confidence, image_path=image_path)
+                if error_message:
+                    self.report({'ERROR'}, error_message)
+                    return {'CANCELLED'}
+                self.report({'INFO'}, f"Imagen clasificada como '{fast_class}'. Paleta de colores lista para selección en Paso 4.")
+                return {'FINISHED'}
+
+        # Baja confianza: el modelo CNN exportado a NumPy se evalúa aquí mismo, sin subproceso.
+        # En modo direccional, la vista global y las celdas del mosaico van en la misma pasada.
+        tile_analysis = None
+        if context.scene.lightmood_rig_layout == 'DIRECTIONAL' and get_numpy_model() is not None:
+            tile_analysis = analyze_reference_tiles(image_path)
+            numpy_class, numpy_confidence = tile_analysis["global"]
+        else:
+            numpy_class, numpy_confidence = classify_image_lighting_numpy(image_path)
+        if numpy_class is not None:
+            error_message = apply_predicted_class(context.scene, numpy_class, "NUMPY", numpy_confidence, image_path=image_path)
+            if error_message:
+                self.report({'ERROR'}, error_message)
+                return {'CANCELLED'}
+            if tile_analysis is not None:
+                store_directional_lighting(context.scene, image_path, numpy_class, tile_analysis)
+            self.report({'INFO'}, f"Imagen clasificada como '{numpy_class}'. Paleta de colores lista para selección en Paso 4.")
+            return {'FINISHED'}
 
-        if predicted_lighting_class not in CLASS_PALETTES_AND_LUMINOSITY: 
-            print(f"DEBUG_BLENDER: Clase predicha '{predicted_lighting_class}' no encontrada en las paletas de colores cargadas.", file=sys.stderr)
-            self.report({'ERROR'}, f"Clase '{predicted_lighting_class}' predicha por el modelo, pero no se encontró la paleta de colores asociada. Revisa los nombres de las carpetas de tu dataset y el archivo class_mapping.json.")
+        # Sin modelo en NumPy: se consulta el modelo CNN externo en segundo plano sin bloquear la interfaz
+        print(f"DEBUG_BLENDER: Solicitando clasificación externa para: {image_path}")
+        if not start_background_classification(context.scene, image_path):
+            self.report({'ERROR'}, "No se pudo iniciar el script externo de clasificación. Revisa la consola de sistema (Window > Toggle System Console) para errores detallados.")
             return {'CANCELLED'}
+        self.report({'INFO'}, "Clasificación en segundo plano iniciada. Puedes seguir trabajando mientras tanto.")
+        return {'FINISHED'}
 
-        class_data = CLASS_PALETTES_AND_LUMINOSITY[predicted_lighting_class] 
-        colors_for_scene = class_data["colors"]
-        avg_luminosity = class_data["avg_luminosity"]
-
-        print(f"DEBUG_BLENDER: Paleta de colores obtenida para '{predicted_lighting_class}': {colors_for_scene}") 
-        print(f"DEBUG_BLENDER: Luminosidad promedio obtenida para '{predicted_lighting_class}': {avg_luminosity}") 
 
-        # Almacenar los datos en las propiedades de la escena y la variable global para el Paso 4
-        context.scene.lightmood_last_predicted_class_name = predicted_lighting_class
-        context.scene.lightmood_avg_luminosity = avg_luminosity
-        
-        LAST_PREDICTED_CLASS_COLORS.clear() # Limpiar la lista global de colores
-        LAST_PREDICTED_CLASS_COLORS.extend(colors_for_scene) # Añadir los nuevos colores
-
-        # Generar las opciones para el EnumProperty del selector de color
-        LAST_PREDICTED_COLOR_ENUM_ITEMS.clear()
-        for i, color_rgb in enumerate(colors_for_scene):
-            # Formato: (identifier, name, description)
-            # El identifier será el índice como string
-            LAST_PREDICTED_COLOR_ENUM_ITEMS.append(
-                (str(i), f"Color {i+1} ({int(color_rgb[0]*255)}, {int(color_rgb[1]*255)}, {int(color_rgb[2]*255)})", f"Color de la paleta: {i+1}")
-            )
-        
-        # Seleccionar el primer color por defecto si la paleta no está vacía
-        if LAST_PREDICTED_COLOR_ENUM_ITEMS:
-            context.scene.lightmood_world_color_enum = LAST_PREDICTED_COLOR_ENUM_ITEMS[0][0]
-        else:
-            context.scene.lightmood_world_color_enum = "" # Vacío si no hay colores
+class LightMoodCancelPrediction(bpy.types.Operator):
+    """Cancela la clasificación en segundo plano en curso."""
+    bl_idname = "scene.light_mood_cancel_prediction"
+    bl_label = "Cancelar Clasificación"
 
-        self.report({'INFO'}, f"Imagen clasificada como '{predicted_lighting_class}'. Paleta de colores lista para selección en Paso 4.")
+    def execute(self, context):
+        if cancel_background_classification():
+            self.report({'INFO'}, "Clasificación cancelada.")
         return {'FINISHED'}
 
 
@@ -259,6 +2172,7 @@ class LightMoodApplyLighting(bpy.types.Operator):
     bl_options = {'REGISTER', 'UNDO'}
 
     def execute(self, context):
+        sync_scene_palette(context.scene)
         # Verificar si hay una paleta de colores clasificada
         if not LAST_PREDICTED_CLASS_COLORS:
             self.report({'ERROR'}, "Primero clasifica una imagen en el Paso 3 para obtener una paleta de colores.")
@@ -272,39 +2186,171 @@ class LightMoodApplyLighting(bpy.types.Operator):
         
         current_index = int(current_index_str) # Convertir el identificador de vuelta a int
 
-        colors_for_scene = LAST_PREDICTED_CLASS_COLORS
-        avg_luminosity = context.scene.lightmood_avg_luminosity
         predicted_lighting_class = context.scene.lightmood_last_predicted_class_name # Para el mensaje de reporte
 
-        world_strength = avg_luminosity * WORLD_BACKGROUND_STRENGTH_MULTIPLIER
-        if world_strength < 0.01: world_strength = 0.01 
+        timing = begin_operation_timing("Aplicar iluminación")
+        apply_scene_lighting(context.scene, LAST_PREDICTED_CLASS_COLORS, current_index, context.scene.lightmood_avg_luminosity)
+        finish_operation_timing(timing)
 
-        light_base_strength = avg_luminosity * LIGHT_STRENGTH_MULTIPLIER
-        if light_base_strength < 10: light_base_strength = 10 
-        
-        # Usar el color del índice seleccionado para el World Shader
-        world_bg_color = [0.8, 0.8, 0.8] # Gris claro por defecto
-        if current_index < len(colors_for_scene):
-            world_bg_color = colors_for_scene[current_index]
-        else: 
-            print(f"Advertencia: El índice de color seleccionado ({current_index}) está fuera de rango para la paleta actual de {len(colors_for_scene)} colores. Usando el primer color o gris por defecto.", file=sys.stderr)
-            if colors_for_scene: world_bg_color = colors_for_scene[0] # Fallback al primer color
-
-        set_world_background_color(world_bg_color, world_strength) 
-        
-        # Lógica para las luces: excluir el color usado para el fondo
-        lights_colors_list = [c for i, c in enumerate(colors_for_scene) if i != current_index]
-        if not lights_colors_list and colors_for_scene: 
-            lights_colors_list = list(colors_for_scene) 
+        self.report({'INFO'}, f"Iluminación aplicada para '{predicted_lighting_class}', color de fondo: {LAST_PREDICTED_COLOR_ENUM_ITEMS[current_index][1]}!")
+        return {'FINISHED'}
 
-        setup_lights_from_colors(lights_colors_list, light_base_strength) 
 
-        self.report({'INFO'}, f"Iluminación aplicada para '{predicted_lighting_class}', color de fondo: {LAST_PREDICTED_COLOR_ENUM_ITEMS[current_index][1]}!")
+class LightMoodCompareRender(bpy.types.Operator):
+    """Clasifica el render o la vista 3D actual y lo compara con la clase de la imagen de referencia."""
+    bl_idname = "scene.light_mood_compare_render"
+    bl_label = "Comparar con la Referencia"
+
+    source: bpy.props.EnumProperty(
+        name="Origen",
+        items=[
+            ('RENDER', "Render", "Renderiza la escena y clasifica el resultado"),
+            ('VIEWPORT', "Vista 3D", "Clasifica la vista 3D actual tal como se ve en pantalla"),
+        ],
+        default='RENDER'
+    )
+
+    def execute(self, context):
+        if self.source == 'VIEWPORT' and (context.area is None or context.area.type != 'VIEW_3D'):
+            self.report({'ERROR'}, "La comparación con la vista 3D debe lanzarse desde una vista 3D.")
+            return {'CANCELLED'}
+        timing = begin_operation_timing("Comparar con la referencia")
+        try:
+            class_name, source, confidence = classify_scene_pixels(context, self.source)
+        except Exception as e:
+            finish_operation_timing(timing, status="ERROR")
+            self.report({'ERROR'}, f"No se pudo clasificar la imagen de la escena: {e}")
+            return {'CANCELLED'}
+        if class_name is None or class_name == "EXTERNAL_SCRIPT_ERROR":
+            finish_operation_timing(timing, status="ERROR")
+            self.report({'ERROR'}, "Fallo al clasificar la imagen de la escena. Revisa la consola de sistema.")
+            return {'CANCELLED'}
+        finish_operation_timing(timing)
+
+        scene = context.scene
+        scene.lightmood_render_class_name = class_name
+        scene.lightmood_render_confidence = confidence
+        reference_class = scene.lightmood_last_predicted_class_name
+        if not reference_class:
+            self.report({'INFO'}, f"La escena se clasifica como '{class_name}' (sin referencia clasificada para comparar).")
+        elif class_name == reference_class:
+            self.report({'INFO'}, f"La escena coincide con la referencia: '{class_name}'.")
+        else:
+            self.report({'WARNING'}, f"La escena se clasifica como '{class_name}', pero la referencia es '{reference_class}'.")
+        return {'FINISHED'}
+
+
+class LightMoodRenderPalettePreviews(bpy.types.Operator):
+    """Renderiza una miniatura por cada color de la paleta para elegir el fondo visualmente."""
+    bl_idname = "scene.light_mood_render_palette_previews"
+    bl_label = "Generar Miniaturas de la Paleta"
+
+    force: bpy.props.BoolProperty(
+        name="Forzar Re-render",
+        description="Renderiza las miniaturas aunque haya unas en caché para la escena actual",
+        default=False
+    )
+
+    def execute(self, context):
+        scene = context.scene
+        sync_scene_palette(scene)
+        if not LAST_PREDICTED_CLASS_COLORS:
+            self.report({'ERROR'}, "Primero clasifica una imagen en el Paso 3 para obtener una paleta de colores.")
+            return {'CANCELLED'}
+
+        timing = begin_operation_timing("Miniaturas de la paleta")
+        key = palette_preview_key(scene, context.evaluated_depsgraph_get())
+        PALETTE_PREVIEW_CURRENT_KEYS[scene.name] = key
+        scene.lightmood_palette_preview_key = key
+        if not self.force and get_palette_preview_icons(key, len(LAST_PREDICTED_CLASS_COLORS)) is not None:
+            finish_operation_timing(timing)
+            self.report({'INFO'}, "Miniaturas de la paleta recuperadas de la caché.")
+            return {'FINISHED'}
+        try:
+            render_palette_previews(scene, key, context.window_manager)
+        except Exception as e:
+            finish_operation_timing(timing, status="ERROR")
+            self.report({'ERROR'}, f"Fallo al renderizar las miniaturas: {e}")
+            return {'CANCELLED'}
+        # Forzar la lectura de las nuevas imágenes aunque hubiera iconos con el mismo nombre
+        for color_index in range(len(LAST_PREDICTED_CLASS_COLORS)):
+            name = f"{key}_{color_index}"
+            if name in PALETTE_PREVIEW_COLLECTION:
+                PALETTE_PREVIEW_COLLECTION[name].reload()
+        get_palette_preview_icons(key, len(LAST_PREDICTED_CLASS_COLORS))
+        finish_operation_timing(timing)
+        self.report({'INFO'}, f"{len(LAST_PREDICTED_CLASS_COLORS)} miniaturas de la paleta generadas.")
         return {'FINISHED'}
 
 
+class LightMoodSelectPaletteColor(bpy.types.Operator):
+    """Usa este color de la paleta para el fondo del mundo."""
+    bl_idname = "scene.light_mood_select_palette_color"
+    bl_label = "Seleccionar Color de la Paleta"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    color_index: bpy.props.IntProperty(default=0, min=0)
+
+    def execute(self, context):
+        sync_scene_palette(context.scene)
+        if self.color_index >= len(LAST_PREDICTED_CLASS_COLORS):
+            return {'CANCELLED'}
+        context.scene.lightmood_world_color_enum = str(self.color_index) # El update previsualiza el color
+        return {'FINISHED'}
+
+
+class LightMoodApplyShotList(bpy.types.Operator):
+    """Clasifica en lote las referencias de una lista de planos y aplica la iluminación a cada escena."""
+    bl_idname = "scene.light_mood_apply_shot_list"
+    bl_label = "Aplicar Lista de Planos"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    filepath: bpy.props.StringProperty(
+        subtype="FILE_PATH",
+    )
+    color_index: bpy.props.IntProperty(
+        name="Índice de Color de Fondo",
+        description="Color de la paleta usado para el fondo cuando el plano no indica uno",
+        default=0,
+        min=0
+    )
+
+    def execute(self, context):
+        if not self.filepath or not os.path.exists(self.filepath):
+            self.report({'ERROR'}, "Selecciona un archivo de lista de planos válido (.json o .csv).")
+            return {'CANCELLED'}
+        timing = begin_operation_timing("Aplicar lista de planos")
+        try:
+            report = apply_shot_list(self.filepath, self.color_index)
+        except Exception as e:
+            finish_operation_timing(timing, status="ERROR")
+            self.report({'ERROR'}, f"Fallo al aplicar la lista de planos: {e}")
+            return {'CANCELLED'}
+        finish_operation_timing(timing, status="OK" if all(shot["status"] == "OK" for shot in report) else "ERROR")
+
+        failed = [shot for shot in report if shot["status"] != "OK"]
+        for shot in failed:
+            print(f"Plano '{shot['scene']}' con errores: {shot['message']}", file=sys.stderr)
+        level = {'WARNING'} if failed else {'INFO'}
+        self.report(level, f"Lista de planos aplicada: {len(report) - len(failed)} correctos, {len(failed)} con errores.")
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+
 # --- 6. REGISTRO Y DEREGISTRO DE CLASES Y PROPIEDADES ---
 
+class LightMoodCacheEntry(bpy.types.PropertyGroup):
+    """Resultado de clasificación guardado en la escena para una imagen concreta."""
+    key: bpy.props.StringProperty(default="") # imagen y artefactos de clasificación (ver classification_cache_key)
+    class_name: bpy.props.StringProperty(default="")
+    avg_luminosity: bpy.props.FloatProperty(default=0.5)
+    prediction_source: bpy.props.StringProperty(default="")
+    prediction_confidence: bpy.props.FloatProperty(default=0.0)
+    palette_json: bpy.props.StringProperty(default="[]")
+
 # Propiedad para almacenar la ruta de la imagen seleccionada
 bpy.types.Scene.lightmood_image_path = bpy.props.StringProperty(
     name="Ruta de Imagen Seleccionada",
@@ -316,6 +2362,7 @@ bpy.types.Scene.lightmood_image_path = bpy.props.StringProperty(
 def get_world_color_enum_items(self, context):
     # Esta función se llama para poblar las opciones del desplegable.
     # Necesita devolver una lista de tuplas: (identifier, name, description)
+    sync_scene_palette(self)
     return LAST_PREDICTED_COLOR_ENUM_ITEMS
 
 
@@ -324,25 +2371,85 @@ bpy.types.Scene.lightmood_world_color_enum = bpy.props.EnumProperty(
     name="Color de Fondo (Paleta)",
     description="Selecciona un color de la paleta para el fondo del mundo",
     items=get_world_color_enum_items,
-    update=lambda s,c: bpy.ops.scene.light_mood_apply_lighting() # Aplica la iluminación al cambiar la selección
+    update=on_world_color_enum_changed # Previsualiza la iluminación al cambiar la selección
 )
 
 # Propiedades para almacenar datos temporales de la clasificación
 bpy.types.Scene.lightmood_last_predicted_class_name = bpy.props.StringProperty(default="")
 bpy.types.Scene.lightmood_avg_luminosity = bpy.props.FloatProperty(default=0.5)
+# Origen de la última clasificación ("FAST", "NUMPY" o "EXTERNAL") y confianza del clasificador
+bpy.types.Scene.lightmood_last_prediction_source = bpy.props.StringProperty(default="")
+bpy.types.Scene.lightmood_last_prediction_confidence = bpy.props.FloatProperty(default=0.0)
+# Paleta actual serializada, para recuperar el Paso 4 al reabrir el archivo .blend
+bpy.types.Scene.lightmood_palette_json = bpy.props.StringProperty(default="")
+
+# Configuración del rig de luces (clásico de 3 luces o procedural)
+bpy.types.Scene.lightmood_rig_layout = bpy.props.EnumProperty(
+    name="Distribución del Rig",
+    items=[
+        ('CLASSIC', "Clásico (3 luces)", "Punto, área y sol en posiciones fijas"),
+        ('RING', "Anillo", "Luces en un anillo horizontal apuntando al centro"),
+        ('DOME', "Cúpula", "Luces repartidas en una cúpula apuntando al centro"),
+        ('GRID', "Rejilla", "Luces en una rejilla en el techo apuntando hacia abajo"),
+        ('DIRECTIONAL', "Direccional (mosaico)", "Una luz por celda del mosaico de la referencia, con la dirección y el color estimados"),
+    ],
+    default='CLASSIC'
+)
+bpy.types.Scene.lightmood_rig_light_count = bpy.props.IntProperty(name="Número de Luces", default=24, min=1, max=2000)
+bpy.types.Scene.lightmood_rig_radius = bpy.props.FloatProperty(name="Radio", default=8.0, min=0.1, subtype='DISTANCE')
+bpy.types.Scene.lightmood_rig_height = bpy.props.FloatProperty(name="Altura", default=5.0, subtype='DISTANCE')
+bpy.types.Scene.lightmood_rig_light_type = bpy.props.EnumProperty(
+    name="Tipo de Luz",
+    items=[('POINT', "Punto", ""), ('SPOT', "Foco", ""), ('AREA', "Área", "")],
+    default='POINT'
+)
+
+# Iluminación direccional estimada del mosaico de la referencia (ver get_directional_lighting)
+bpy.types.Scene.lightmood_directional_json = bpy.props.StringProperty(default="")
+
+# Última clasificación del render o de la vista 3D (comparación con la referencia)
+bpy.types.Scene.lightmood_render_class_name = bpy.props.StringProperty(default="")
+bpy.types.Scene.lightmood_render_confidence = bpy.props.FloatProperty(default=0.0)
+
+# Clave de caché de las miniaturas de la paleta de la escena (ver palette_preview_key)
+bpy.types.Scene.lightmood_palette_preview_key = bpy.props.StringProperty(default="")
+
+# Estado de la sección plegable de diagnóstico de tiempos del panel
+bpy.types.Scene.lightmood_show_timings = bpy.props.BoolProperty(name="Mostrar Tiempos", default=False)
 
 
 def register():
+    bpy.utils.register_class(LightMoodCacheEntry)
+    # La colección necesita que el PropertyGroup esté registrado
+    bpy.types.Scene.lightmood_classification_cache = bpy.props.CollectionProperty(type=LightMoodCacheEntry)
     bpy.utils.register_class(LightMoodLoadResources)
     bpy.utils.register_class(LightMoodSelectImage) 
     bpy.utils.register_class(LightMoodGeneratePrediction) 
+    bpy.utils.register_class(LightMoodCancelPrediction)
     bpy.utils.register_class(LightMoodApplyLighting)     
+    bpy.utils.register_class(LightMoodApplyShotList)
+    bpy.utils.register_class(LightMoodCompareRender)
+    bpy.utils.register_class(LightMoodRenderPalettePreviews)
+    bpy.utils.register_class(LightMoodSelectPaletteColor)
     
     # Propiedades personalizadas
     bpy.types.Scene.lightmood_image_path
     bpy.types.Scene.lightmood_world_color_enum
     bpy.types.Scene.lightmood_last_predicted_class_name
     bpy.types.Scene.lightmood_avg_luminosity
+    bpy.types.Scene.lightmood_last_prediction_source
+    bpy.types.Scene.lightmood_last_prediction_confidence
+    bpy.types.Scene.lightmood_palette_json
+    bpy.types.Scene.lightmood_rig_layout
+    bpy.types.Scene.lightmood_rig_light_count
+    bpy.types.Scene.lightmood_rig_radius
+    bpy.types.Scene.lightmood_rig_height
+    bpy.types.Scene.lightmood_rig_light_type
+    bpy.types.Scene.lightmood_show_timings
+    bpy.types.Scene.lightmood_directional_json
+    bpy.types.Scene.lightmood_render_class_name
+    bpy.types.Scene.lightmood_render_confidence
+    bpy.types.Scene.lightmood_palette_preview_key
 
 
     class LIGHTMOOD_CLASSIFIED_PT_panel(bpy.types.Panel):
@@ -354,10 +2461,14 @@ def register():
 
         def draw(self, context):
             layout = self.layout
+            sync_scene_palette(context.scene)
             
-            # Paso 1: Cargar Paletas
-            layout.label(text="Paso 1: Cargar Paletas de Colores")
-            layout.operator("scene.light_mood_load_resources")
+            # Paso 1: Paletas (se cargan automáticamente al clasificar)
+            if CLASS_PALETTES_AND_LUMINOSITY is None:
+                layout.label(text="Paso 1: Paletas de Colores (se cargan al clasificar)")
+            else:
+                layout.label(text=f"Paso 1: Paletas de Colores ({len(CLASS_PALETTES_AND_LUMINOSITY)} clases cargadas)")
+            layout.operator("scene.light_mood_load_resources", icon='FILE_REFRESH')
             layout.separator()
 
             # Paso 2: Seleccionar Imagen
@@ -368,7 +2479,22 @@ def register():
 
             # Paso 3: Clasificar Imagen y Obtener Paleta
             layout.label(text="Paso 3: Clasificar Imagen")
-            layout.operator("scene.light_mood_generate_prediction", text="Clasificar y Obtener Paleta")
+            if CLASSIFICATION_JOB is not None:
+                row = layout.row(align=True)
+                row.label(text=f"Clasificando... {classification_elapsed_seconds():.1f} s", icon='TIME')
+                row.operator("scene.light_mood_cancel_prediction", text="", icon='CANCEL')
+            else:
+                layout.operator("scene.light_mood_generate_prediction", text="Clasificar y Obtener Paleta")
+            if LAST_CLASSIFICATION_MESSAGE:
+                layout.label(text=LAST_CLASSIFICATION_MESSAGE)
+            if context.scene.lightmood_last_predicted_class_name:
+                if context.scene.lightmood_last_prediction_source == "FAST":
+                    source_text = f"rápido, confianza {context.scene.lightmood_last_prediction_confidence:.2f}"
+                elif context.scene.lightmood_last_prediction_source == "NUMPY":
+                    source_text = f"modelo CNN en NumPy, confianza {context.scene.lightmood_last_prediction_confidence:.2f}"
+                else:
+                    source_text = "modelo CNN"
+                layout.label(text=f"Clase: {context.scene.lightmood_last_predicted_class_name} ({source_text})")
             
             # Paso 4: Seleccionar Color de Fondo y Aplicar Iluminación
             # Solo mostrar si hay una paleta de colores disponible
@@ -392,20 +2518,129 @@ def register():
                 row.label(text="Color Actual:")
                 row.prop(current_selected_color, "color", text="", event="NONE") # Mostrar el color (no editable)
 
+                # Galería de miniaturas: un clic selecciona el color de fondo
+                preview_icons = get_palette_preview_icons(context.scene.lightmood_palette_preview_key,
+                                                          len(LAST_PREDICTED_CLASS_COLORS))
+                if preview_icons is not None:
+                    # Las miniaturas se generaron para otro estado de la escena (objetos, luces, materiales...)
+                    if current_palette_preview_key(context.scene, context.evaluated_depsgraph_get()) != \
+                            context.scene.lightmood_palette_preview_key:
+                        box.label(text="Miniaturas desactualizadas: la escena cambió. Vuelve a generarlas.", icon='ERROR')
+                    grid = box.grid_flow(columns=PALETTE_PREVIEW_COLUMNS, even_columns=True, align=True)
+                    for color_index, icon_id in enumerate(preview_icons):
+                        column = grid.column(align=True)
+                        column.template_icon(icon_value=icon_id, scale=4.0)
+                        operator = column.operator("scene.light_mood_select_palette_color", text=f"Color {color_index + 1}",
+                                                   depress=(str(color_index) == current_selected_index_str))
+                        operator.color_index = color_index
+                row = box.row(align=True)
+                row.operator("scene.light_mood_render_palette_previews", icon='IMAGE_DATA')
+                row.operator("scene.light_mood_render_palette_previews", text="", icon='FILE_REFRESH').force = True
+
+                # Configuración del rig de luces
+                box.prop(context.scene, "lightmood_rig_layout")
+                if context.scene.lightmood_rig_layout == 'DIRECTIONAL':
+                    box.prop(context.scene, "lightmood_rig_light_type")
+                    box.prop(context.scene, "lightmood_rig_radius")
+                    if context.scene.lightmood_directional_json:
+                        directional = json.loads(context.scene.lightmood_directional_json)
+                        box.label(text=f"Luz principal: {describe_key_light_direction(directional['key_direction'])} "
+                                       f"(contraste {directional['contrast']:.1f})", icon='LIGHT_SUN')
+                elif context.scene.lightmood_rig_layout != 'CLASSIC':
+                    box.prop(context.scene, "lightmood_rig_light_count")
+                    box.prop(context.scene, "lightmood_rig_light_type")
+                    row = box.row(align=True)
+                    row.prop(context.scene, "lightmood_rig_radius")
+                    row.prop(context.scene, "lightmood_rig_height")
+
                 # Botón explícito para aplicar la iluminación (por si el update no funciona al mover el slider o para aplicar manualmente)
                 box.operator("scene.light_mood_apply_lighting", text="Aplicar Iluminación Ahora")
+
+                # Comparar el resultado con la referencia (sin guardar imágenes en disco)
+                row = box.row(align=True)
+                row.operator("scene.light_mood_compare_render", text="Comparar Render", icon='RENDER_STILL').source = 'RENDER'
+                row.operator("scene.light_mood_compare_render", text="Comparar Vista 3D", icon='VIEW3D').source = 'VIEWPORT'
+                view_settings = context.scene.view_settings
+                if get_ocio_module() is None and (view_settings.view_transform != 'Standard' or view_settings.look != 'None'):
+                    # Sin OpenColorIO el render se pasa a sRGB simple: no coincide con la vista 3D ni con la referencia
+                    box.label(text=f"Comparar Render usa la vista 'Standard', no '{view_settings.view_transform}'", icon='INFO')
+                render_class = context.scene.lightmood_render_class_name
+                if render_class:
+                    matches = render_class == context.scene.lightmood_last_predicted_class_name
+                    box.label(text=f"Escena: {render_class} ({'coincide' if matches else 'no coincide'} con la referencia)",
+                              icon='CHECKMARK' if matches else 'ERROR')
             else:
                 layout.separator()
                 layout.label(text="Clasifica una imagen en el Paso 3 para el Paso 4.")
+
+            # Lote: aplicar una lista de planos (escena -> imagen) a varias escenas de una vez
+            layout.separator()
+            layout.label(text="Lote: Lista de Planos")
+            layout.operator("scene.light_mood_apply_shot_list", text="Aplicar Lista de Planos...")
+
+            # Diagnóstico: tiempos de la última operación (sección plegable)
+            layout.separator()
+            show_timings = context.scene.lightmood_show_timings
+            layout.prop(context.scene, "lightmood_show_timings", text="Diagnóstico de Tiempos",
+                        icon='TRIA_DOWN' if show_timings else 'TRIA_RIGHT', emboss=False)
+            if show_timings:
+                box = layout.box()
+                if LAST_OPERATION_TIMING is None:
+                    box.label(text="Aún no se ha medido ninguna operación.")
+                else:
+                    box.label(text=f"{LAST_OPERATION_TIMING['operation']} ({LAST_OPERATION_TIMING['status']}): "
+                                   f"{LAST_OPERATION_TIMING['total_seconds'] * 1000:.1f} ms", icon='TIME')
+                    column = box.column(align=True)
+                    for step_name, seconds in LAST_OPERATION_TIMING["steps"]:
+                        row = column.row()
+                        row.label(text=step_name)
+                        row.label(text=f"{seconds * 1000:.1f} ms")
+                box.label(text=f"Registro: {TIMING_LOG_FILE}")
     
     bpy.utils.register_class(LIGHTMOOD_CLASSIFIED_PT_panel)
 
+    global PALETTE_PREVIEW_COLLECTION
+    if PALETTE_PREVIEW_COLLECTION is None:
+        PALETTE_PREVIEW_COLLECTION = bpy.utils.previews.new()
+
+    if cancel_classification_on_load not in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.append(cancel_classification_on_load)
+    if restore_palette_on_load not in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.append(restore_palette_on_load)
+    if invalidate_palette_preview_key not in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.append(invalidate_palette_preview_key)
+
+    # Recuperar la paleta de la escena actual si el addon se recarga
+    scene = getattr(bpy.context, "scene", None)
+    if scene is not None:
+        restore_scene_palette(scene)
+
 def unregister():
+    cancel_background_classification()
+    if bpy.app.timers.is_registered(poll_background_classification):
+        bpy.app.timers.unregister(poll_background_classification)
+    if cancel_classification_on_load in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.remove(cancel_classification_on_load)
+    if restore_palette_on_load in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(restore_palette_on_load)
+    if invalidate_palette_preview_key in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(invalidate_palette_preview_key)
+
     bpy.utils.unregister_class(LightMoodLoadResources)
     bpy.utils.unregister_class(LightMoodSelectImage) 
     bpy.utils.unregister_class(LightMoodGeneratePrediction) 
+    bpy.utils.unregister_class(LightMoodCancelPrediction)
     bpy.utils.unregister_class(LightMoodApplyLighting)     
+    bpy.utils.unregister_class(LightMoodApplyShotList)
+    bpy.utils.unregister_class(LightMoodCompareRender)
+    bpy.utils.unregister_class(LightMoodRenderPalettePreviews)
+    bpy.utils.unregister_class(LightMoodSelectPaletteColor)
     bpy.utils.unregister_class(LIGHTMOOD_CLASSIFIED_PT_panel)
+
+    global PALETTE_PREVIEW_COLLECTION
+    if PALETTE_PREVIEW_COLLECTION is not None:
+        bpy.utils.previews.remove(PALETTE_PREVIEW_COLLECTION)
+        PALETTE_PREVIEW_COLLECTION = None
     
     # Eliminar todas las propiedades personalizadas al desregistrar
     if hasattr(bpy.types.Scene, "lightmood_image_path"):
@@ -416,8 +2651,80 @@ def unregister():
         del bpy.types.Scene.lightmood_last_predicted_class_name
     if hasattr(bpy.types.Scene, "lightmood_avg_luminosity"):
         del bpy.types.Scene.lightmood_avg_luminosity
+    if hasattr(bpy.types.Scene, "lightmood_last_prediction_source"):
+        del bpy.types.Scene.lightmood_last_prediction_source
+    if hasattr(bpy.types.Scene, "lightmood_last_prediction_confidence"):
+        del bpy.types.Scene.lightmood_last_prediction_confidence
+    if hasattr(bpy.types.Scene, "lightmood_palette_json"):
+        del bpy.types.Scene.lightmood_palette_json
+    for prop_name in ("lightmood_rig_layout", "lightmood_rig_light_count", "lightmood_rig_radius",
+                      "lightmood_rig_height", "lightmood_rig_light_type", "lightmood_show_timings",
+                      "lightmood_directional_json", "lightmood_render_class_name", "lightmood_render_confidence",
+                      "lightmood_palette_preview_key"):
+        if hasattr(bpy.types.Scene, prop_name):
+            delattr(bpy.types.Scene, prop_name)
+    if hasattr(bpy.types.Scene, "lightmood_classification_cache"):
+        del bpy.types.Scene.lightmood_classification_cache
+    bpy.utils.unregister_class(LightMoodCacheEntry)
+
+
+# --- 7. MODO SIN INTERFAZ (LÍNEA DE COMANDOS) ---
+
+def parse_headless_args(argv):
+    """Lee los argumentos que siguen a "--" en la línea de comandos de Blender."""
+    argv = argv[argv.index("--") + 1:] if "--" in argv else []
+    parser = argparse.ArgumentParser(
+        prog="blender -b archivo.blend --python generadorluzblender.py --",
+        description="Aplica la iluminación LightMood sin interfaz.")
+    parser.add_argument("--shot-list", help="Lista de planos (.json o .csv) que asocia escenas con imágenes")
+    parser.add_argument("--image", help="Imagen de referencia para las escenas indicadas en --scene")
+    parser.add_argument("--scene", nargs="*", default=None,
+                        help="Escenas a iluminar con --image (por defecto, la escena activa)")
+    parser.add_argument("--class-name", help="Clase ya calculada para --image (omite la clasificación)")
+    parser.add_argument("--stamp", help="Sello de versión que se guarda en las escenas procesadas")
+    parser.add_argument("--color-index", type=int, default=0, help="Color de la paleta usado para el fondo")
+    parser.add_argument("--save", action="store_true", help="Guardar el archivo .blend al terminar")
+    parser.add_argument("--report", help="Ruta de un JSON donde escribir el estado de cada plano")
+    return parser.parse_args(argv)
+
+def run_headless(argv):
+    """Punto de entrada para `blender -b archivo.blend --python generadorluzblender.py -- ...`."""
+    args = parse_headless_args(argv)
+    timing = begin_operation_timing("Modo sin interfaz")
+    report = []
+    if args.shot_list:
+        report.extend(apply_shot_list(args.shot_list, args.color_index))
+    if args.image:
+        image_path = os.path.abspath(args.image)
+        scene_names = args.scene or [bpy.context.scene.name]
+        known_classes = {image_path: args.class_name} if args.class_name else None
+        report.extend(apply_shots([(scene_name, image_path, None) for scene_name in scene_names],
+                                  args.color_index, known_classes=known_classes))
+    for shot in report:
+        print(f"LIGHTMOOD_SHOT: {json.dumps(shot)}")
+        scene = bpy.data.scenes.get(shot["scene"])
+        if args.stamp and shot["status"] == "OK" and scene is not None:
+            scene["lightmood_farm_stamp"] = args.stamp
+    failed = [shot for shot in report if shot["status"] != "OK"]
+    finish_operation_timing(timing, status="ERROR" if failed else "OK")
+    step_totals = {}
+    for step_name, seconds in timing["steps"]:
+        step_totals[step_name] = step_totals.get(step_name, 0.0) + seconds # Un paso por plano: se suman
+    print(f"{TIMING_STDERR_PREFIX}{json.dumps(dict(step_totals, total_seconds=timing['total_seconds']))}")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+
+    if args.save and report and not failed:
+        bpy.ops.wm.save_mainfile()
+    if failed:
+        # Con --python-exit-code, Blender termina con error y el driver lo registra
+        raise RuntimeError(f"LightMood: {len(failed)} plano(s) con errores; el archivo no se guardó.")
+    return report
 
 
 if __name__ == "__main__":
     register()
-    print("LightMood Clasificación de Iluminación: Scripts registrados.")
\ No newline at end of file
+    print("LightMood Clasificación de Iluminación: Scripts registrados.")
+    if bpy.app.background and "--" in sys.argv:
+        run_headless(sys.argv)
\ No newline at end of file
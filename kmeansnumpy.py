@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Motor K-Means (Lloyd) vectorizado en NumPy para las paletas de LightMood.
+
+Se ejecuta una sola vez y expone los centroides y etiquetas de cada iteración
+mediante un callback, de modo que la visualización del proceso no necesita
+reentrenar varios modelos con distintos max_iter. Las distancias se calculan
+por bloques en float32 para acotar la memoria y se admite arranque en caliente
+(warm start) a partir de una paleta previa.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+# Tamaño por defecto de los bloques de puntos para el cálculo de distancias
+DEFAULT_CHUNK_SIZE = 65536
+
+KMeansResult = namedtuple("KMeansResult", ["centroids", "labels", "counts", "inertia", "n_iter"])
+
+
+def assign_labels(X, centroids, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Asigna cada punto al centroide más cercano calculando las distancias por bloques.
+    Devuelve las etiquetas y la distancia cuadrada mínima de cada punto.
+    """
+    n_points = X.shape[0]
+    labels = np.empty(n_points, dtype=np.int32)
+    min_dist_sq = np.empty(n_points, dtype=np.float32)
+    centroids_sq = np.einsum("ij,ij->i", centroids, centroids)
+
+    for start in range(0, n_points, chunk_size):
+        chunk = X[start:start + chunk_size]
+        # ||x - c||^2 = ||x||^2 - 2 x·c + ||c||^2 (||x||^2 no cambia el argmin)
+        dist = centroids_sq[np.newaxis, :] - 2.0 * (chunk @ centroids.T)
+        chunk_labels = np.argmin(dist, axis=1)
+        labels[start:start + chunk_size] = chunk_labels
+        chunk_min = dist[np.arange(chunk.shape[0]), chunk_labels] + np.einsum("ij,ij->i", chunk, chunk)
+        min_dist_sq[start:start + chunk_size] = np.maximum(chunk_min, 0.0)
+
+    return labels, min_dist_sq
+
+
+def kmeans_plusplus_init(X, n_clusters, rng, initial_centroids=None):
+    """
+    Inicialización k-means++. Si se pasan centroides iniciales (paleta previa),
+    se conservan y sólo se completan los que falten.
+    """
+    if initial_centroids is not None and len(initial_centroids) > 0:
+        centroids = [np.asarray(c, dtype=np.float32) for c in initial_centroids[:n_clusters]]
+    else:
+        centroids = [X[rng.integers(X.shape[0])]]
+
+    diff = X - centroids[0]
+    min_dist_sq = np.einsum("ij,ij->i", diff, diff)
+    for centroid in centroids[1:]:
+        diff = X - centroid
+        np.minimum(min_dist_sq, np.einsum("ij,ij->i", diff, diff), out=min_dist_sq)
+
+    while len(centroids) < n_clusters:
+        total = float(min_dist_sq.sum(dtype=np.float64))
+        if total <= 0.0:
+            # Todos los puntos coinciden con algún centroide: se elige uno al azar
+            new_index = rng.integers(X.shape[0])
+        else:
+            probabilities = min_dist_sq.astype(np.float64) / total
+            new_index = rng.choice(X.shape[0], p=probabilities)
+        centroids.append(X[new_index])
+        diff = X - X[new_index]
+        np.minimum(min_dist_sq, np.einsum("ij,ij->i", diff, diff), out=min_dist_sq)
+
+    return np.vstack(centroids).astype(np.float32)
+
+
+def kmeans_lloyd(X, n_clusters, max_iter=100, tol=1e-4, init=None, random_state=42,
+                 chunk_size=DEFAULT_CHUNK_SIZE, callback=None):
+    """
+    Ejecuta K-Means (algoritmo de Lloyd) en float32.
+
+    - init: paleta previa (lista o array de colores) para arranque en caliente;
+      si tiene menos de n_clusters colores, el resto se inicializa con k-means++.
+    - callback(iteration, centroids, labels): se llama tras cada iteración con los
+      centroides actualizados y las etiquetas usadas para calcularlos.
+
+    Devuelve un KMeansResult con centroides, etiquetas finales, número de puntos
+    por cluster, inercia y número de iteraciones ejecutadas.
+    """
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    if X.ndim != 2 or X.shape[0] == 0:
+        raise ValueError("X debe ser un array 2D con al menos un punto.")
+    n_clusters = min(n_clusters, X.shape[0])
+    if n_clusters < 1:
+        raise ValueError("n_clusters debe ser al menos 1.")
+
+    rng = np.random.default_rng(random_state)
+    centroids = kmeans_plusplus_init(X, n_clusters, rng, initial_centroids=init)
+
+    # Tolerancia relativa a la varianza de los datos (como en scikit-learn)
+    tol_abs = tol * float(np.mean(np.var(X, axis=0)))
+
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        labels, min_dist_sq = assign_labels(X, centroids, chunk_size)
+
+        counts = np.bincount(labels, minlength=n_clusters)
+        new_centroids = np.empty_like(centroids)
+        for dim in range(X.shape[1]):
+            new_centroids[:, dim] = np.bincount(labels, weights=X[:, dim], minlength=n_clusters)
+        non_empty = counts > 0
+        new_centroids[non_empty] /= counts[non_empty, np.newaxis]
+
+        # Clusters vacíos: se reubican en los puntos más alejados de su centroide
+        empty_clusters = np.flatnonzero(~non_empty)
+        if empty_clusters.size > 0:
+            farthest = np.argsort(min_dist_sq)[::-1][:empty_clusters.size]
+            new_centroids[empty_clusters] = X[farthest]
+
+        shift = float(np.sum((new_centroids - centroids) ** 2))
+        centroids = new_centroids
+
+        if callback is not None:
+            callback(n_iter, centroids, labels)
+
+        if shift <= tol_abs:
+            break
+
+    labels, min_dist_sq = assign_labels(X, centroids, chunk_size)
+    counts = np.bincount(labels, minlength=n_clusters)
+    inertia = float(min_dist_sq.sum(dtype=np.float64))
+
+    return KMeansResult(centroids, labels, counts, inertia, n_iter)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""Driver de granja de render para aplicar la iluminación LightMood a muchos .blend.
+
+Clasifica una sola vez, con un único proceso del clasificador (API_predictor.py
+en modo --batch-file), todas las imágenes de referencia pendientes. Después
+reparte los archivos .blend entre un número fijo de procesos de Blender en modo
+sin interfaz, que solo aplican el fondo y las luces con la clase ya calculada y
+guardan el archivo. Los archivos ya actualizados (misma referencia, clase y
+parámetros, y sin cambios desde el último guardado) se omiten.
+
+Uso:
+    python lightmoodgranja.py --blender blender --image referencia.png escenas/*.blend
+    python lightmoodgranja.py --blender blender --manifest trabajos.json --jobs 8
+
+El manifiesto es un JSON {"archivo.blend": "referencia.png", ...}.
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# --- 1. CONFIGURACIÓN (debe coincidir con generadorluzblender.py) ---
+ADDON_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generadorluzblender.py")
+PREDICTION_SCRIPT_PATH = "C:/Users/59174/Desktop/predict_lighting_class.py"
+PYTHON_EXECUTABLE_PATH = "C:/Users/59174/AppData/Local/Programs/Python/Python310/python.exe"
+CLASS_PALETTES_FILE = "C:/Users/59174/Desktop/lighting_class_palettes.json"
+
+DEFAULT_STATE_FILE = "lightmood_granja_estado.json"
+DEFAULT_REPORT_FILE = "lightmood_granja_reporte.json"
+DEFAULT_JOB_TIMEOUT = 600 # Segundos máximos por archivo .blend
+
+
+# --- 2. TRABAJOS Y ESTADO ---
+def collect_jobs(args):
+    """Devuelve una lista de (archivo .blend, imagen de referencia) en rutas absolutas."""
+    jobs = []
+    if args.manifest:
+        with open(args.manifest, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(args.manifest))
+        for blend_path, image_path in manifest.items():
+            jobs.append((os.path.abspath(os.path.join(base_dir, blend_path)),
+                         os.path.abspath(os.path.join(base_dir, image_path))))
+    if args.blend_files:
+        if not args.image:
+            raise ValueError("Se necesita --image para los archivos .blend pasados por línea de comandos.")
+        for pattern in args.blend_files:
+            for blend_path in sorted(glob.glob(pattern)) or [pattern]:
+                jobs.append((os.path.abspath(blend_path), os.path.abspath(args.image)))
+    return jobs
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def job_stamp(image_path, color_index, palettes_path):
+    """Sello que cambia si cambia la referencia, el índice de color o las paletas."""
+    palettes_npz = os.path.splitext(palettes_path)[0] + ".npz"
+    parts = [image_path, file_signature(image_path), str(color_index),
+             file_signature(palettes_npz) or file_signature(palettes_path)]
+    return hashlib.sha1("|".join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_state(state, state_path):
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_path, state_path)
+
+def is_up_to_date(state, blend_path, stamp):
+    """Un .blend está al día si se procesó con el mismo sello y no se modificó después."""
+    entry = state.get(blend_path)
+    return (entry is not None and entry.get("stamp") == stamp and
+            entry.get("blend_signature") == file_signature(blend_path))
+
+
+# --- 3. CLASIFICADOR COMPARTIDO ---
+def classify_references(image_paths, python_executable, prediction_script):
+    """Clasifica todas las referencias con un solo arranque del modelo. Devuelve {ruta: clase}."""
+    if not image_paths:
+        return {}
+    list_file = tempfile.NamedTemporaryFile('w', suffix=".txt", delete=False, encoding='utf-8')
+    try:
+        with list_file:
+            list_file.write("\n".join(image_paths))
+        process = subprocess.run(
+            [python_executable, prediction_script, "--batch-file", list_file.name],
+            capture_output=True,
+            text=True,
+            check=True
+        )
+    finally:
+        os.remove(list_file.name)
+    predictions = json.loads(process.stdout.strip().splitlines()[-1])
+    return {path: class_name for path, class_name in predictions.items() if class_name != "ERROR_PREDICTING_IMAGE"}
+
+
+# --- 4. EJECUCIÓN EN BLENDER ---
+def run_blender_job(blender_executable, blend_path, image_path, class_name, color_index, stamp, timeout):
+    """Procesa un archivo .blend en un proceso de Blender sin interfaz."""
+    command = [blender_executable, "-b", blend_path, "--python-exit-code", "1",
+               "--python", ADDON_SCRIPT_PATH, "--",
+               "--image", image_path, "--color-index", str(color_index),
+               "--stamp", stamp, "--save"]
+    if class_name:
+        command += ["--class-name", class_name]
+
+    start = time.perf_counter()
+    result = {"blend": blend_path, "image": image_path, "class": class_name}
+    try:
+        process = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+        shots = [json.loads(line[len("LIGHTMOOD_SHOT: "):]) for line in process.stdout.splitlines()
+                 if line.startswith("LIGHTMOOD_SHOT: ")]
+        result["shots"] = shots
+        timings = [json.loads(line[len("LIGHTMOOD_TIMING: "):]) for line in process.stdout.splitlines()
+                   if line.startswith("LIGHTMOOD_TIMING: ")]
+        if timings:
+            result["timings"] = timings[-1] # Desglose por pasos medido dentro de Blender
+        if process.returncode == 0 and shots and all(shot["status"] == "OK" for shot in shots):
+            result["status"] = "OK"
+            result["class"] = shots[0].get("class", class_name)
+        else:
+            result["status"] = "ERROR"
+            result["message"] = (process.stderr or process.stdout).strip().splitlines()[-5:]
+    except subprocess.TimeoutExpired:
+        result["status"] = "ERROR"
+        result["message"] = f"Tiempo agotado ({timeout} s)"
+    except Exception as e:
+        result["status"] = "ERROR"
+        result["message"] = str(e)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+# --- 5. PUNTO DE ENTRADA ---
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Aplica LightMood a muchos archivos .blend en paralelo.")
+    parser.add_argument("blend_files", nargs="*", help="Archivos .blend (admite comodines)")
+    parser.add_argument("--image", help="Imagen de referencia común para los .blend de la línea de comandos")
+    parser.add_argument("--manifest", help="JSON {archivo.blend: referencia} para referencias por archivo")
+    parser.add_argument("--blender", default="blender", help="Ejecutable de Blender")
+    parser.add_argument("--jobs", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Número de procesos de Blender simultáneos")
+    parser.add_argument("--color-index", type=int, default=0)
+    parser.add_argument("--python", default=PYTHON_EXECUTABLE_PATH, help="Python con TensorFlow para el clasificador")
+    parser.add_argument("--predictor", default=PREDICTION_SCRIPT_PATH, help="Script de predicción (API_predictor.py)")
+    parser.add_argument("--no-shared-classifier", action="store_true",
+                        help="Dejar que cada proceso de Blender clasifique por su cuenta")
+    parser.add_argument("--palettes", default=CLASS_PALETTES_FILE)
+    parser.add_argument("--state", default=DEFAULT_STATE_FILE)
+    parser.add_argument("--report", default=DEFAULT_REPORT_FILE)
+    parser.add_argument("--timeout", type=int, default=DEFAULT_JOB_TIMEOUT)
+    parser.add_argument("--force", action="store_true", help="Procesar también los archivos ya actualizados")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    jobs = collect_jobs(args)
+    state = load_state(args.state)
+    report = []
+
+    pending = []
+    for blend_path, image_path in jobs:
+        stamp = job_stamp(image_path, args.color_index, args.palettes)
+        if not os.path.exists(blend_path) or not os.path.exists(image_path):
+            report.append({"blend": blend_path, "image": image_path, "status": "ERROR",
+                           "message": "Archivo .blend o imagen no encontrados"})
+        elif not args.force and is_up_to_date(state, blend_path, stamp):
+            report.append({"blend": blend_path, "image": image_path, "status": "SKIPPED",
+                           "class": state[blend_path].get("class")})
+        else:
+            pending.append((blend_path, image_path, stamp))
+    print(f"{len(jobs)} archivos: {len(pending)} por procesar, "
+          f"{sum(r['status'] == 'SKIPPED' for r in report)} ya actualizados.")
+
+    classes = {}
+    if pending and not args.no_shared_classifier:
+        start = time.perf_counter()
+        try:
+            classes = classify_references(sorted({image for _, image, _ in pending}), args.python, args.predictor)
+            print(f"Referencias clasificadas en {time.perf_counter() - start:.1f} s: {classes}")
+        except Exception as e:
+            print(f"Aviso: fallo del clasificador compartido ({e}); cada Blender clasificará por su cuenta.",
+                  file=sys.stderr)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(run_blender_job, args.blender, blend_path, image_path,
+                                   classes.get(image_path), args.color_index, stamp, args.timeout)
+                   for blend_path, image_path, stamp in pending]
+        stamps = {blend_path: stamp for blend_path, _, stamp in pending}
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            report.append(result)
+            print(f"[{result['status']}] {result['blend']} ({result['seconds']:.1f} s)")
+            if result["status"] == "OK":
+                state[result["blend"]] = {"stamp": stamps[result["blend"]], "class": result["class"],
+                                          "blend_signature": file_signature(result["blend"]),
+                                          "updated": time.strftime("%Y-%m-%dT%H:%M:%S")}
+                save_state(state, args.state)
+
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    failed = sum(r["status"] == "ERROR" for r in report)
+    print(f"Reporte guardado en '{args.report}': {len(report) - failed} correctos/omitidos, {failed} con errores.")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Resumen fusionable de la distribución de luminosidad de cada clase de LightMood.
+
+En lugar de guardar una lista con la luminosidad media de cada imagen, cada
+clase acumula un histograma de 256 niveles de la luminancia de sus píxeles (el
+canal "L" de PIL es de 8 bits, así que el histograma es exacto) y otro de las
+medias por imagen, más la suma, suma de cuadrados, mínimo y máximo de esas
+medias. La memoria no depende del número de imágenes y dos resúmenes se
+fusionan sumándolos, de modo que los resultados de varios procesos o de una
+reconstrucción incremental se combinan sin volver a leer las imágenes.
+
+Del resumen se obtienen la media y desviación por imagen (idénticas a las que se
+calculaban antes), percentiles de la luminancia de los píxeles y el contraste
+entre luz principal y de relleno (percentiles KEY_PERCENTILE y FILL_PERCENTILE,
+comparados en luz lineal), que el addon de Blender usa para repartir la fuerza
+entre las luces y el fondo.
+
+Uso:
+    python sketchluminosidad.py resumen paletas_luminosidad.npz
+    python sketchluminosidad.py fusionar trabajador1.npz trabajador2.npz --output paletas_luminosidad.npz
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+NUM_LEVELS = 256
+SKETCH_SCHEMA_VERSION = 1
+EXPORTED_PERCENTILES = (5, 25, 50, 75, 95)
+KEY_PERCENTILE = 90 # Zonas iluminadas por la luz principal
+FILL_PERCENTILE = 25 # Sombras, iluminadas por el relleno y el entorno
+MIN_LINEAR_LUMINANCE = 1.0 / 255.0 # Evita dividir por cero en imágenes con sombras negras
+
+
+# --- 1. RESUMEN ---
+def new_sketch():
+    """Resumen vacío: histogramas de píxeles y de medias por imagen más momentos de las medias."""
+    return {
+        "pixel_histogram": np.zeros(NUM_LEVELS, dtype=np.int64),
+        "image_histogram": np.zeros(NUM_LEVELS, dtype=np.int64),
+        "image_count": 0,
+        "image_sum": 0.0,
+        "image_sum_sq": 0.0,
+        "image_min": np.inf,
+        "image_max": -np.inf,
+    }
+
+def add_image(sketch, luminance):
+    """Añade una imagen a partir de su canal L de 8 bits (array uint8 de cualquier forma)."""
+    levels = np.asarray(luminance, dtype=np.uint8).ravel()
+    if levels.size == 0:
+        return sketch
+    histogram = np.bincount(levels, minlength=NUM_LEVELS)
+    sketch["pixel_histogram"] += histogram
+    # La media se obtiene del histograma: no hace falta recorrer otra vez los píxeles
+    image_mean = float(histogram @ np.arange(NUM_LEVELS)) / levels.size / 255.0
+    sketch["image_histogram"][min(int(round(image_mean * 255.0)), NUM_LEVELS - 1)] += 1
+    sketch["image_count"] += 1
+    sketch["image_sum"] += image_mean
+    sketch["image_sum_sq"] += image_mean * image_mean
+    sketch["image_min"] = min(sketch["image_min"], image_mean)
+    sketch["image_max"] = max(sketch["image_max"], image_mean)
+    return sketch
+
+def merge_sketches(*sketches):
+    """Fusiona resúmenes de la misma clase (p. ej. de varios procesos o ejecuciones)."""
+    merged = new_sketch()
+    for sketch in sketches:
+        merged["pixel_histogram"] += sketch["pixel_histogram"]
+        merged["image_histogram"] += sketch["image_histogram"]
+        merged["image_count"] += sketch["image_count"]
+        merged["image_sum"] += sketch["image_sum"]
+        merged["image_sum_sq"] += sketch["image_sum_sq"]
+        merged["image_min"] = min(merged["image_min"], sketch["image_min"])
+        merged["image_max"] = max(merged["image_max"], sketch["image_max"])
+    return merged
+
+def merge_class_sketches(*class_sketches):
+    """Fusiona diccionarios {clase: resumen}; las clases que faltan en alguno se conservan."""
+    merged = {}
+    for sketches in class_sketches:
+        for class_name, sketch in sketches.items():
+            merged[class_name] = merge_sketches(merged[class_name], sketch) if class_name in merged else merge_sketches(sketch)
+    return merged
+
+
+# --- 2. ESTADÍSTICAS ---
+def histogram_percentiles(histogram, percentiles):
+    """Percentiles (0-100) de un histograma de niveles de 8 bits, en 0-1."""
+    histogram = np.asarray(histogram, dtype=np.float64)
+    total = histogram.sum()
+    if total <= 0:
+        return [0.5 for _ in percentiles]
+    cumulative = np.cumsum(histogram) / total
+    levels = np.searchsorted(cumulative, np.asarray(percentiles, dtype=np.float64) / 100.0, side="left")
+    return (np.minimum(levels, NUM_LEVELS - 1) / 255.0).tolist()
+
+def srgb_to_linear(value):
+    value = np.asarray(value, dtype=np.float64)
+    return np.where(value <= 0.04045, value / 12.92, ((value + 0.055) / 1.055) ** 2.4)
+
+def summarize_sketch(sketch):
+    """
+    Estadísticas de una clase (luminosidad 0-1, sRGB):
+      - avg/std/min/max de la luminosidad media por imagen (como antes)
+      - percentiles EXPORTED_PERCENTILES de la luminancia de los píxeles
+      - key/fill: percentiles KEY_PERCENTILE y FILL_PERCENTILE, y su cociente en luz lineal
+    """
+    count = sketch["image_count"]
+    if count == 0:
+        return {"avg": 0.5, "std": 0.0, "min": 0.5, "max": 0.5,
+                "percentiles": {str(p): 0.5 for p in EXPORTED_PERCENTILES},
+                "key": 0.5, "fill": 0.5, "key_fill_ratio": 1.0, "images": 0}
+    mean = sketch["image_sum"] / count
+    variance = max(sketch["image_sum_sq"] / count - mean * mean, 0.0)
+    percentile_values = histogram_percentiles(sketch["pixel_histogram"],
+                                              list(EXPORTED_PERCENTILES) + [KEY_PERCENTILE, FILL_PERCENTILE])
+    key, fill = percentile_values[-2:]
+    key_linear, fill_linear = np.maximum(srgb_to_linear([key, fill]), MIN_LINEAR_LUMINANCE)
+    return {
+        "avg": float(mean),
+        "std": float(np.sqrt(variance)),
+        "min": float(sketch["image_min"]),
+        "max": float(sketch["image_max"]),
+        "percentiles": {str(p): v for p, v in zip(EXPORTED_PERCENTILES, percentile_values)},
+        "key": key,
+        "fill": fill,
+        "key_fill_ratio": float(key_linear / fill_linear),
+        "images": int(count),
+    }
+
+
+# --- 3. ARCHIVO ---
+def save_class_sketches(class_sketches, filepath):
+    """Guarda {clase: resumen} en un .npz (escritura atómica) para fusionarlo más adelante."""
+    class_names = list(class_sketches.keys())
+    sketches = [class_sketches[c] for c in class_names]
+    moments = np.array([[s["image_count"], s["image_sum"], s["image_sum_sq"], s["image_min"], s["image_max"]]
+                        for s in sketches], dtype=np.float64).reshape(-1, 5)
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 schema_version=np.int32(SKETCH_SCHEMA_VERSION),
+                 class_names=np.array(class_names, dtype=np.str_),
+                 pixel_histograms=np.array([s["pixel_histogram"] for s in sketches], dtype=np.int64).reshape(-1, NUM_LEVELS),
+                 image_histograms=np.array([s["image_histogram"] for s in sketches], dtype=np.int64).reshape(-1, NUM_LEVELS),
+                 moments=moments)
+    os.replace(tmp_path, filepath)
+
+def load_class_sketches(filepath):
+    """Lee un .npz escrito por save_class_sketches. Devuelve {clase: resumen}."""
+    with np.load(filepath) as artifact:
+        schema_version = int(artifact["schema_version"])
+        if schema_version > SKETCH_SCHEMA_VERSION:
+            raise ValueError(f"Versión de esquema del resumen de luminosidad no soportada: {schema_version}")
+        class_names = artifact["class_names"].tolist()
+        pixel_histograms = artifact["pixel_histograms"]
+        image_histograms = artifact["image_histograms"]
+        moments = artifact["moments"]
+    class_sketches = {}
+    for i, class_name in enumerate(class_names):
+        count, total, total_sq, minimum, maximum = moments[i]
+        class_sketches[class_name] = {
+            "pixel_histogram": pixel_histograms[i].copy(),
+            "image_histogram": image_histograms[i].copy(),
+            "image_count": int(count),
+            "image_sum": float(total),
+            "image_sum_sq": float(total_sq),
+            "image_min": float(minimum),
+            "image_max": float(maximum),
+        }
+    return class_sketches
+
+
+# --- 4. PUNTO DE ENTRADA ---
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Resúmenes de luminosidad por clase de LightMood.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary = subparsers.add_parser("resumen", help="Muestra las estadísticas de cada clase")
+    summary.add_argument("sketches")
+    merge = subparsers.add_parser("fusionar", help="Fusiona resúmenes de varios procesos o ejecuciones")
+    merge.add_argument("sketches", nargs="+")
+    merge.add_argument("--output", required=True)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "fusionar":
+        merged = merge_class_sketches(*(load_class_sketches(path) for path in args.sketches))
+        save_class_sketches(merged, args.output)
+        print(f"{len(args.sketches)} resúmenes fusionados ({len(merged)} clases) en '{args.output}'")
+        return 0
+    for class_name, sketch in load_class_sketches(args.sketches).items():
+        stats = summarize_sketch(sketch)
+        percentiles = ", ".join(f"p{p}={v:.2f}" for p, v in stats["percentiles"].items())
+        print(f"{class_name}: {stats['images']} imágenes, media {stats['avg']:.3f} ± {stats['std']:.3f}, "
+              f"{percentiles}, principal/relleno {stats['key_fill_ratio']:.1f}:1")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())